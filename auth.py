@@ -0,0 +1,118 @@
+from fastapi import Depends, HTTPException
+from fastapi.security import OAuth2PasswordBearer
+from collections import OrderedDict
+import hashlib
+import os
+import time
+
+import metrics
+
+# JWT signing and verification shared by every authenticated endpoint.
+#
+# Keys are preloaded by key id ("kid") so they can be rotated: the active key
+# signs new tokens and every loaded key verifies. A verified token is cached by
+# its SHA-256 digest until its own `exp`, so repeat requests with the same
+# token skip signature verification. jose is imported on first use so pods
+# that never see a token do not pay for it at startup.
+
+JWT_ALGORITHM = "HS256"
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "100000"))
+
+# JWT_SIGNING_KEYS="kid1:secret1,kid2:secret2"; JWT_ACTIVE_KEY_ID picks the signing key
+def load_signing_keys():
+    configured = os.environ.get("JWT_SIGNING_KEYS")
+    if not configured:
+        return {"default": "your-secret-key"}
+    return dict(entry.split(":", 1) for entry in configured.split(",") if entry)
+
+signing_keys = load_signing_keys()
+active_key_id = os.environ.get("JWT_ACTIVE_KEY_ID") or next(iter(signing_keys))
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+
+class VerifiedTokenCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # digest -> (subject, exp, kid)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, digest: bytes, now: float):
+        entry = self.entries.get(digest)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[1] <= now:
+            del self.entries[digest]
+            self.evictions += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(digest)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, digest: bytes, subject: str, exp: float, kid: str):
+        self.entries[digest] = (subject, exp, kid)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    # Forget tokens signed with keys that are no longer loaded
+    def retain_keys(self, kids):
+        for digest in [digest for digest, entry in self.entries.items() if entry[2] not in kids]:
+            del self.entries[digest]
+            self.evictions += 1
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+token_cache = VerifiedTokenCache(TOKEN_CACHE_SIZE)
+metrics.register("auth.token_cache", token_cache.stats)
+
+# Replace the loaded keys (e.g. from a rotation job); tokens of dropped keys stop verifying at once
+def set_signing_keys(keys: dict, active: str):
+    global signing_keys, active_key_id
+    if active not in keys:
+        raise ValueError("Active key id must be one of the loaded keys")
+    signing_keys = dict(keys)
+    active_key_id = active
+    token_cache.retain_keys(set(keys))
+
+# Sign claims with the active key
+def encode_token(claims: dict):
+    from jose import jwt
+
+    return jwt.encode(claims, signing_keys[active_key_id], algorithm=JWT_ALGORITHM, headers={"kid": active_key_id})
+
+# Verify a token's signature and expiry and return (claims, kid); raises 401
+def verify_token(token: str):
+    from jose import JWTError, jwt
+
+    try:
+        kid = jwt.get_unverified_header(token).get("kid", active_key_id)
+        key = signing_keys.get(kid)
+        if key is None:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        return jwt.decode(token, key, algorithms=[JWT_ALGORITHM]), kid
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+# Subject of a token, served from the verified-token cache when possible
+def token_identity(token: str):
+    digest = hashlib.sha256(token.encode()).digest()
+    now = time.time()
+    subject = token_cache.get(digest, now)
+    if subject is not None:
+        return subject
+
+    claims, kid = verify_token(token)
+    subject = claims.get("sub")
+    if not subject or "exp" not in claims:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    token_cache.set(digest, subject, float(claims["exp"]), kid)
+    return subject
+
+# Dependency returning the email of the authenticated user
+async def get_jwt_identity(token: str = Depends(oauth2_scheme)):
+    return token_identity(token)
@@ -0,0 +1,271 @@
+from datetime import datetime
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+
+import metrics
+
+# In-process write-behind queue with a background batching writer.
+#
+# put() appends the item to a local spool file and enqueues it; it only waits
+# when max_pending items are already queued (backpressure). The writer task
+# hands batches of up to max_batch items, or whatever arrived within
+# max_delay_ms of the first one, to write_batch, which persists them with one
+# multi-row insert.
+#
+# A batch that fails with a transient error (lost connection, timeout) is
+# retried with backoff until it succeeds. A permanent error (constraint
+# violation, bad data) would fail the same way on every retry, so the batch is
+# split in halves until the failing items are isolated; those go to the dead
+# letter file <spool_path>.dead with their error, and the rest is written.
+#
+# Every spooled item carries a sequence number; after each successful batch
+# the highest written sequence is recorded in <spool>.ack. Each process
+# spools to its own <spool_path>.<pid>. On start, the writer claims the spools
+# of processes that are gone (a worker that crashed, or this pid's previous
+# life), copies their unacknowledged items into its own spool and replays
+# them, so a crash loses nothing that put() accepted. The spool is truncated
+# whenever the queue drains. Spool directories must be local to the host:
+# liveness is checked by pid.
+
+logger = logging.getLogger(__name__)
+
+RETRY_DELAY_SECONDS = 1.0
+MAX_RETRY_DELAY_SECONDS = 30.0
+
+# Errors that writing the same items again cannot fix
+def permanent_error(error: Exception):
+    from sqlalchemy.exc import DataError, IntegrityError
+    return isinstance(error, (IntegrityError, DataError, KeyError, TypeError, ValueError))
+
+def process_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class BatchWriter:
+    def __init__(self, name: str, write_batch, max_batch: int = 500, max_delay_ms: int = 50,
+                 max_pending: int = 100000, spool_path: str = None, fsync: bool = False,
+                 is_permanent=permanent_error):
+        self.name = name
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.max_pending = max_pending
+        self.spool_base = spool_path
+        self.spool_path = None  # <spool_base>.<pid>, set on start (after any fork)
+        self.dead_letter_path = spool_path + ".dead" if spool_path else None
+        self.fsync = fsync
+        self.is_permanent = is_permanent
+        self.queue = None
+        self.task = None
+        self.spool = None
+        self.sequence = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.dead_letters = 0
+        metrics.register(f"batch_writer.{name}", self.stats)
+
+    async def start(self):
+        replay = []
+        if self.spool_base:
+            self.spool_path = f"{self.spool_base}.{os.getpid()}"
+            claimed = []
+            for path in self.orphaned_spools():
+                claimed_path = self.claim(path)
+                if claimed_path is not None:
+                    claimed.append(claimed_path)
+                    replay.extend(self.read_spool(claimed_path))
+            if os.path.exists(self.spool_path + ".ack"):
+                os.remove(self.spool_path + ".ack")
+
+            # The claimed items are durable in our own spool before the claimed files go
+            self.spool = open(self.spool_path, "w", encoding="utf-8")
+            replay = [(self.spool_item(item), item) for item in replay]
+            self.spool.flush()
+            os.fsync(self.spool.fileno())
+            for path in claimed:
+                os.remove(path)
+                if os.path.exists(path + ".ack"):
+                    os.remove(path + ".ack")
+            if replay:
+                logger.info("Replaying %s spooled %s items", len(replay), self.name)
+
+        # Room for every replayed item: start() cannot wait on a writer that is not running yet
+        self.queue = asyncio.Queue(maxsize=max(self.max_pending, len(replay)))
+        for entry in replay:
+            self.queue.put_nowait(entry)
+        self.task = asyncio.create_task(self.run())
+
+    # Stop accepting work and write out everything still queued
+    async def stop(self):
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        self.task = None
+        if self.spool is not None:
+            # Everything was written: nothing for the next start to replay
+            self.spool.close()
+            self.spool = None
+            for path in (self.spool_path, self.spool_path + ".ack"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    # Spools of this writer whose process is gone: <base>.<pid> and
+    # <base>.<pid>.claimed.<claimer pid> left by a claim that did not finish
+    def orphaned_spools(self):
+        orphans = []
+        for path in glob.glob(glob.escape(self.spool_base) + ".*"):
+            parts = path[len(self.spool_base) + 1:].split(".")
+            if len(parts) == 1 and parts[0].isdigit():
+                owner = int(parts[0])
+            elif len(parts) == 3 and parts[0].isdigit() and parts[1] == "claimed" and parts[2].isdigit():
+                owner = int(parts[2])
+            else:
+                continue  # .ack, .dead and temporary files
+            if owner == os.getpid() or not process_alive(owner):
+                orphans.append(path)
+        return orphans
+
+    # Take over an orphaned spool and its ack by renaming them; None if another process got there first
+    def claim(self, path: str):
+        original = path[len(self.spool_base) + 1:].split(".")[0]
+        claimed = f"{self.spool_base}.{original}.claimed.{os.getpid()}"
+        if path != claimed:
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                return None
+            if os.path.exists(path + ".ack"):
+                os.replace(path + ".ack", claimed + ".ack")
+        return claimed
+
+    # Items of a spool file that were never acknowledged as written
+    def read_spool(self, path: str):
+        acked = 0
+        if os.path.exists(path + ".ack"):
+            with open(path + ".ack") as ack:
+                acked = int(ack.read() or 0)
+        pending = []
+        with open(path, encoding="utf-8") as spool:
+            for line in spool:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # torn last line from a crash mid-write
+                if record["seq"] > acked:
+                    pending.append(record["item"])
+        return pending
+
+    def spool_item(self, item: dict):
+        self.sequence += 1
+        if self.spool is not None:
+            self.spool.write(json.dumps({"seq": self.sequence, "item": item}, default=str) + "\n")
+        return self.sequence
+
+    async def put(self, item: dict):
+        if self.queue is None:
+            raise RuntimeError(f"{self.name} writer is not started")
+        sequence = self.spool_item(item)
+        if self.spool is not None:
+            self.spool.flush()
+            if self.fsync:
+                os.fsync(self.spool.fileno())
+        await self.queue.put((sequence, item))
+
+    # Collect up to max_batch items, waiting at most max_delay after the first
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self.next_batch()
+            await self.write(batch)
+            self.batches += 1
+            self.acknowledge(batch[-1][0])
+            for _ in batch:
+                self.queue.task_done()
+
+    # Write a batch, retrying transient errors and isolating the items behind permanent ones
+    async def write(self, batch: list):
+        delay = RETRY_DELAY_SECONDS
+        while True:
+            try:
+                await self.write_batch([item for _, item in batch])
+                self.written += len(batch)
+                return
+            except Exception as error:
+                self.failures += 1
+                if not self.is_permanent(error):
+                    logger.exception("Writing a batch of %s %s items failed; retrying", len(batch), self.name)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, MAX_RETRY_DELAY_SECONDS)
+                    continue
+                if len(batch) == 1:
+                    self.dead_letter(batch[0][1], error)
+                    return
+                logger.warning("A batch of %s %s items was rejected (%s); splitting it", len(batch), self.name, error)
+                middle = len(batch) // 2
+                await self.write(batch[:middle])
+                await self.write(batch[middle:])
+                return
+
+    def dead_letter(self, item: dict, error: Exception):
+        self.dead_letters += 1
+        logger.error("Dropping a %s item the database rejects: %s", self.name, error)
+        if self.dead_letter_path is None:
+            logger.error("Dropped %s item: %s", self.name, json.dumps(item, default=str))
+            return
+        with open(self.dead_letter_path, "a", encoding="utf-8") as dead:
+            dead.write(json.dumps({"pid": os.getpid(), "error": repr(error), "item": item}, default=str) + "\n")
+
+    def acknowledge(self, sequence: int):
+        if self.spool is None:
+            return
+        if self.queue.empty():
+            # Everything spooled has been written: start a fresh spool. Without
+            # the seek the next write would land at the old offset, after a
+            # run of NUL bytes that read_spool cannot parse
+            self.spool.seek(0)
+            self.spool.truncate()
+            sequence = 0
+            self.sequence = 0
+        with open(self.spool_path + ".ack.tmp", "w") as ack:
+            ack.write(str(sequence))
+        os.replace(self.spool_path + ".ack.tmp", self.spool_path + ".ack")
+
+    def stats(self):
+        return {
+            "pending": self.queue.qsize() if self.queue is not None else 0,
+            "written": self.written,
+            "batches": self.batches,
+            "failures": self.failures,
+            "dead_letters": self.dead_letters,
+            "avg_batch": self.written / self.batches if self.batches else 0,
+        }
+
+# JSON-safe timestamp for spooled items, and back
+def timestamp(value: datetime = None):
+    return (value or datetime.now()).isoformat()
+
+def parse_timestamp(value: str):
+    return datetime.fromisoformat(value)
@@ -0,0 +1,89 @@
+# Throughput benchmark for bill_scheduler.
+#
+# Seeds recurring bills that are all due at once (every bill is scheduled for
+# midnight of its due date, so a day's bills arrive together), runs several
+# scheduler workers against them concurrently and reports paid bills/sec, the
+# time a day of 1M bills would take to drain, and whether any period was paid
+# twice. Uses the DATABASE_URL of database.py, defaulting to a local SQLite
+# file (no SKIP LOCKED there: the workers serialize on the database lock).
+# Payments go to the in-process fake payee server.
+#
+#   python bench_bill_scheduler.py --bills 100000 --workers 4 --concurrency 64
+#   DATABASE_URL=mysql+aiomysql://... python bench_bill_scheduler.py --bills 1000000
+import argparse
+import asyncio
+import os
+import random
+import time
+from datetime import date, datetime, timedelta
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./bench_bills.db")
+
+import httpx
+from sqlalchemy import delete, func, insert, select
+
+import database
+import fake_payee
+from bill_payment_gateway import Base, BillPayment
+from bill_scheduler import BillScheduler
+from payee_gateway import PayeeGatewayClient
+from users import seed_users
+
+DAILY_BILLS = 1_000_000
+
+BENCH_USERS = 100000
+
+async def seed(bills: int):
+    await database.create_all(Base)
+    due = date.today()
+    async with database.engine.begin() as conn:
+        await seed_users(conn, BENCH_USERS)
+        await conn.execute(delete(BillPayment.__table__))
+        for start in range(0, bills, 10000):
+            await conn.execute(insert(BillPayment.__table__), [
+                {"user_id": random.randint(1, BENCH_USERS), "payee": f"payee-{index % 500}", "amount": 50.0,
+                 "due_date": due, "is_recurring": True, "payment_status": "pending",
+                 "date": datetime.now(), "next_run_at": datetime.combine(due, datetime.min.time())}
+                for index in range(start, min(start + 10000, bills))
+            ])
+
+async def run(args):
+    await seed(args.bills)
+
+    fake_payee.FAKE_PAYEE_LATENCY_MS = args.payee_latency_ms
+    gateway = PayeeGatewayClient("http://fake-payee", transport=httpx.ASGITransport(app=fake_payee.app))
+    await gateway.start()
+    schedulers = [BillScheduler(owner=f"bench-{index}", concurrency=args.concurrency, notify=False, gateway=gateway)
+                  for index in range(args.workers)]
+    start = time.perf_counter()
+    await asyncio.gather(*(scheduler.run(until_idle=True) for scheduler in schedulers))
+    elapsed = time.perf_counter() - start
+    await gateway.stop()
+
+    async with database.SessionLocal() as db:
+        paid = await db.scalar(select(func.count()).select_from(BillPayment).where(BillPayment.is_recurring == False))
+        pending = await db.scalar(select(func.count()).select_from(BillPayment)
+                                  .where(BillPayment.next_run_at <= datetime.now()))
+
+    rate = paid / elapsed
+    print(f"backend            {database.engine.dialect.name}")
+    print(f"workers            {args.workers} x {args.concurrency}")
+    print(f"bills paid         {paid} of {args.bills}")
+    print(f"still due          {pending}")
+    print(f"paid twice         {paid - args.bills + pending}")
+    print(f"lost claims        {sum(scheduler.lost_claims for scheduler in schedulers)}")
+    print(f"payee payments     {len(fake_payee.confirmations)}")
+    print(f"bills/sec          {rate:,.0f}")
+    print(f"1M bills drain in  {timedelta(seconds=round(DAILY_BILLS / rate))}")
+    await database.dispose_engine()
+
+def main():
+    parser = argparse.ArgumentParser(description="Pay a day's worth of recurring bills with concurrent scheduler workers")
+    parser.add_argument("--bills", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=4, help="scheduler instances")
+    parser.add_argument("--concurrency", type=int, default=64, help="bills in flight per scheduler")
+    parser.add_argument("--payee-latency-ms", type=float, default=50, help="mean fake payee response time")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+# Latency benchmark for the card authorization engine.
+#
+# Sends authorizations open-loop at a fixed target rate (each one is timed from
+# its scheduled start, so queueing delay counts against the engine) across a
+# set of cards, and reports p50/p99/p99.9 decision latency. By default the
+# engine runs against the DATABASE_URL of database.py (a local SQLite file
+# unless set): --cards users with an active card and a funded wallet are
+# seeded, card states are loaded from the database, every approval takes its
+# real hold-and-counters transaction, and the write-behind log posts the
+# batches. Declines decided from the in-memory table never touch the
+# database; approvals always pay for one short transaction, which the numbers
+# include. --simulate swaps the database for stand-ins with fixed delays
+# (--load-ms, --reserve-ms, --write-ms) to isolate the engine's own overhead.
+#
+#   python bench_card_authorization.py --tps 500 --seconds 10 --cards 10000
+#   DATABASE_URL=mysql+aiomysql://... python bench_card_authorization.py --tps 5000 --cards 100000
+#   python bench_card_authorization.py --simulate --tps 5000 --cards 100000
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./bench_cards.db")
+
+from sqlalchemy import delete, insert, update
+
+import card_services
+import database
+import digital_wallet
+import spending_limits
+from card_authorization import CardAuthorizer, CardState, load_card_state, post_authorizations, reserve_authorization
+from users import seed_users, users
+
+# Users 1..cards with an active card and a wallet holding `balance`
+async def seed(cards: int, balance: int):
+    await database.create_all(card_services.Base, digital_wallet.Base, spending_limits)
+    async with database.engine.begin() as conn:
+        await seed_users(conn, cards)
+        await conn.execute(update(users).where(users.c.id <= cards).values(has_virtual_card=True, card_activated=True))
+        for table in (card_services.CardTransaction.__table__, digital_wallet.WalletHold.__table__,
+                      digital_wallet.WalletBalanceSnapshot.__table__, digital_wallet.WalletTransaction.__table__,
+                      spending_limits.spending_counters):
+            await conn.execute(delete(table))
+        for start in range(1, cards + 1, 10000):
+            await conn.execute(insert(digital_wallet.WalletTransaction.__table__), [
+                {"user_id": user_id, "amount": balance, "transaction_type": "deposit", "date": datetime.now()}
+                for user_id in range(start, min(start + 10000, cards + 1))
+            ])
+
+async def run(args):
+    posted = 0
+    if args.simulate:
+        async def load_state(user_id):
+            await asyncio.sleep(args.load_ms / 1000)
+            return CardState(user_id, True, args.balance, 0)
+
+        async def reserve(user_id, authorization_id, amount):
+            await asyncio.sleep(args.reserve_ms / 1000)
+            return None
+
+        async def write_batch(items):
+            nonlocal posted
+            await asyncio.sleep(args.write_ms / 1000)
+            posted += len(items)
+    else:
+        await seed(args.cards, args.balance)
+        load_state, reserve = load_card_state, reserve_authorization
+
+        async def write_batch(items):
+            nonlocal posted
+            await post_authorizations(items)
+            posted += len(items)
+
+    spool = os.path.join(tempfile.mkdtemp(), "card_authorizations.spool")
+    authorizer = CardAuthorizer(load_state=load_state, write_batch=write_batch, reserve=reserve, spool_path=spool,
+                                feed=False)
+    await authorizer.start()
+
+    # Warm the card table so the run measures steady-state decisions
+    if args.warm:
+        await asyncio.gather(*(authorizer.card(user_id) for user_id in range(1, args.cards + 1)))
+
+    latencies = []
+
+    async def authorize(scheduled: float):
+        await authorizer.authorize(random.randint(1, args.cards), random.randint(100, 10_000))
+        latencies.append(time.perf_counter() - scheduled)
+
+    total = int(args.tps * args.seconds)
+    tasks = []
+    start = time.perf_counter()
+    for index in range(total):
+        scheduled = start + index / args.tps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(authorize(scheduled)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    await authorizer.stop()
+
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=1000)
+    print(f"backend            {'simulated' if args.simulate else database.engine.dialect.name}")
+    print(f"authorizations     {total} ({authorizer.approved} approved, {authorizer.declined} declined)")
+    print(f"achieved TPS       {total / elapsed:,.0f} (target {args.tps:,})")
+    print(f"p50                {quantiles[499] * 1000:.3f} ms")
+    print(f"p99                {quantiles[989] * 1000:.3f} ms")
+    print(f"p99.9              {quantiles[998] * 1000:.3f} ms")
+    print(f"max                {latencies[-1] * 1000:.3f} ms")
+    print(f"card loads         {authorizer.loads}")
+    print(f"posted             {posted}")
+    if not args.simulate:
+        await database.dispose_engine()
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure card authorization latency at a target rate")
+    parser.add_argument("--tps", type=int, default=5000)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--cards", type=int, default=100000)
+    parser.add_argument("--balance", type=int, default=10_000_000, help="starting balance in minor units")
+    parser.add_argument("--simulate", action="store_true", help="replace the database with fixed-delay stand-ins")
+    parser.add_argument("--load-ms", type=float, default=2, help="simulated card state load time")
+    parser.add_argument("--reserve-ms", type=float, default=1, help="simulated hold reservation time")
+    parser.add_argument("--write-ms", type=float, default=10, help="simulated batch posting time")
+    parser.add_argument("--no-warm", dest="warm", action="store_false", help="start with an empty card table")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
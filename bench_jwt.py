@@ -0,0 +1,41 @@
+# Microbenchmark: full JWT verification per request vs the verified-token cache.
+#
+# Replays a request stream in which each active user sends many requests with
+# the same token, then reports the cost per request of both paths and the
+# share of one core each would take at the target request rate.
+#
+#   python bench_jwt.py --users 2000 --requests 100000 --rps 10000
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+import auth
+
+def make_tokens(users: int):
+    expire = datetime.utcnow() + timedelta(minutes=30)
+    return [auth.encode_token({"sub": f"user{user}@example.com", "exp": expire}) for user in range(users)]
+
+def measure(label, stream, check, rps: int):
+    start = time.perf_counter()
+    for token in stream:
+        check(token)
+    per_request = (time.perf_counter() - start) / len(stream)
+    print(f"{label:<20} {per_request * 1e6:8.1f} us/request   {per_request * rps:7.1%} of one core at {rps:,} RPS")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare verify-per-request with the cached JWT path")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--rps", type=int, default=10000)
+    args = parser.parse_args()
+
+    tokens = make_tokens(args.users)
+    stream = [random.choice(tokens) for _ in range(args.requests)]
+
+    measure("verify per request", stream, auth.verify_token, args.rps)
+    measure("cached", stream, auth.token_identity, args.rps)
+    print(f"cache                {auth.token_cache.stats()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# Latency benchmark for lot matching.
+#
+# Seeds users holding thousands of open lots of one symbol, then sells small
+# quantities with each matching method and reports p50/p99 sale latency
+# (match, decrement, realized gains, commit). The same sales are also run the
+# way a naive implementation would: load every lot of the holding, sort in
+# Python, then match, to show what the holdings index saves. Uses the
+# DATABASE_URL of database.py, defaulting to a local SQLite file.
+#
+#   python bench_lot_matching.py --users 20 --lots 5000 --sales 500
+#   DATABASE_URL=mysql+aiomysql://... python bench_lot_matching.py --lots 20000
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./bench_lots.db")
+
+from sqlalchemy import delete, insert, select
+
+import database
+from investments import Base, Investment, RealizedGain
+from lot_matching import sell_lots
+from users import seed_users
+
+SYMBOL = "BENCH"
+
+async def seed(users: int, lots: int):
+    await database.create_all(Base)
+    start = datetime.now() - timedelta(days=lots)
+    async with database.engine.begin() as conn:
+        await seed_users(conn, users)
+        await conn.execute(delete(RealizedGain.__table__))
+        await conn.execute(delete(Investment.__table__))
+        for user_id in range(1, users + 1):
+            await conn.execute(insert(Investment.__table__), [
+                {"user_id": user_id, "investment_type": "stock", "symbol": SYMBOL, "quantity": 10.0,
+                 "purchase_price": random.uniform(50, 150), "purchase_date": start + timedelta(days=index),
+                 "is_open": True}
+                for index in range(lots)
+            ])
+
+# Naive matching: every lot of the holding, sorted in Python
+async def sell_full_scan(db, user_id: int, quantity: float, price: float, method: str):
+    lots = (await db.scalars(select(Investment).where(Investment.user_id == user_id, Investment.symbol == SYMBOL))).all()
+    lots = sorted((lot for lot in lots if lot.is_open), key=lambda lot: (lot.purchase_date, lot.id),
+                  reverse=method == "lifo")
+    remaining = quantity
+    for lot in lots:
+        take = min(lot.quantity, remaining)
+        lot.quantity -= take
+        lot.is_open = lot.quantity > 0
+        db.add(RealizedGain(user_id=user_id, investment_id=lot.id, symbol=SYMBOL, method=method, quantity=take,
+                            purchase_price=lot.purchase_price, selling_price=price,
+                            gain=take * (price - lot.purchase_price), purchase_date=lot.purchase_date,
+                            sale_date=datetime.now()))
+        remaining -= take
+        if not remaining:
+            break
+
+async def timed_sales(args, method: str, full_scan: bool):
+    latencies = []
+    for _ in range(args.sales):
+        user_id = random.randint(1, args.users)
+        quantity = random.choice((5.0, 10.0, 25.0))
+        lot_ids = None
+        if method == "specific":
+            async with database.SessionLocal() as db:
+                lot_ids = (await db.scalars(
+                    select(Investment.id).where(Investment.user_id == user_id, Investment.is_open == True).limit(200)
+                )).all()
+            lot_ids = random.sample(lot_ids, min(5, len(lot_ids)))
+            quantity = 5.0
+        before = time.perf_counter()
+        async with database.SessionLocal() as db:
+            if full_scan:
+                await sell_full_scan(db, user_id, quantity, 100.0, method)
+            else:
+                await sell_lots(db, user_id, SYMBOL, quantity, 100.0, method, lot_ids)
+            await db.commit()
+        latencies.append(time.perf_counter() - before)
+    return latencies
+
+def report(label: str, latencies: list):
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{label:<22} p50 {quantiles[49] * 1000:8.2f} ms   p99 {quantiles[98] * 1000:8.2f} ms")
+
+async def run(args):
+    await seed(args.users, args.lots)
+    print(f"backend            {database.engine.dialect.name}")
+    print(f"holdings           {args.users} users x {args.lots} lots of {SYMBOL}")
+    for method in ("fifo", "lifo", "specific"):
+        report(f"indexed {method}", await timed_sales(args, method, full_scan=False))
+    for method in ("fifo", "lifo"):
+        report(f"full scan {method}", await timed_sales(args, method, full_scan=True))
+    await database.dispose_engine()
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure sale latency for holdings with many lots")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--lots", type=int, default=5000, help="open lots per user")
+    parser.add_argument("--sales", type=int, default=500, help="sales per method")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
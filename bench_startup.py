@@ -0,0 +1,58 @@
+# Cold-start benchmark for the application factory.
+#
+# Every sample runs in a fresh interpreter so imports are not cached, and
+# measures the time from interpreter start to a fully built app. Uses the
+# DATABASE_URL of database.py, defaulting to a local SQLite file (building the
+# app creates the engine but does not connect).
+#
+#   python bench_startup.py                      # all modules, then each module alone
+#   python bench_startup.py --runs 20 --modules registration,money_transfer
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./bench_startup.db")
+
+PROBE = """
+import time
+start = time.perf_counter()
+import index
+index.create_app({modules})
+print(time.perf_counter() - start)
+"""
+
+# Start one interpreter and return the seconds it took to build the app
+def measure(modules):
+    probe = PROBE.format(modules=repr(modules))
+    output = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if output.returncode:
+        raise SystemExit(f"Building the app with {modules} failed:\n{output.stderr}")
+    return float(output.stdout.strip().splitlines()[-1])
+
+def report(label, samples):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{label:<32} median {statistics.median(samples) * 1000:8.1f} ms   p95 {p95 * 1000:8.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure application cold-start latency")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--modules", help="comma-separated module set to measure (default: all, then each alone)")
+    args = parser.parse_args()
+
+    import index
+
+    if args.modules:
+        configurations = {args.modules: args.modules.split(",")}
+    else:
+        configurations = {"all": list(index.MODULE_REGISTRY), "none": []}
+        configurations.update({name: [name] for name in index.MODULE_REGISTRY})
+
+    for label, modules in configurations.items():
+        report(label, [measure(modules) for _ in range(args.runs)])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Concurrency benchmark for transfer_engine.
+#
+# Runs many concurrent transfers skewed towards a small set of hot accounts
+# and reports committed transfers/sec and the conflict (retry) rate. Uses the
+# DATABASE_URL of database.py, defaulting to a local SQLite file.
+#
+#   python bench_transfer_engine.py --accounts 1000 --hot 10 --workers 64 --transfers 20000
+#   python bench_transfer_engine.py --batch 10000      # one payroll-style fan-out batch
+#   DATABASE_URL=mysql+aiomysql://... python bench_transfer_engine.py
+import argparse
+import asyncio
+import os
+import random
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./bench_transfers.db")
+
+from sqlalchemy import delete, insert
+
+import database
+import transfer_engine
+
+async def seed(accounts: int, balance: int):
+    async with database.engine.begin() as conn:
+        await conn.run_sync(transfer_engine.metadata.create_all)
+        await conn.execute(delete(transfer_engine.ledger_entries))
+        await conn.execute(delete(transfer_engine.transactions))
+        await conn.execute(delete(transfer_engine.accounts))
+        await conn.execute(insert(transfer_engine.accounts),
+                           [{"id": account_id, "balance": balance} for account_id in range(1, accounts + 1)])
+
+# Pick an account, hitting the hot set with probability `hot_ratio`
+def pick(accounts: int, hot: int, hot_ratio: float):
+    if random.random() < hot_ratio:
+        return random.randint(1, hot)
+    return random.randint(1, accounts)
+
+async def worker(transfers: int, args):
+    for _ in range(transfers):
+        sender_id = pick(args.accounts, args.hot, args.hot_ratio)
+        receiver_id = pick(args.accounts, args.hot, args.hot_ratio)
+        if sender_id == receiver_id:
+            continue
+        async with database.SessionLocal() as db:
+            try:
+                await transfer_engine.transfer(db, sender_id, receiver_id, random.randint(1, args.max_amount))
+            except transfer_engine.InsufficientFunds:
+                pass
+
+# Fan out one batch from account 1 to random receivers
+async def run_batch(args):
+    items = [(random.randint(2, args.accounts), random.randint(1, args.max_amount)) for _ in range(args.batch)]
+    start = time.perf_counter()
+    async with database.SessionLocal() as db:
+        await transfer_engine.transfer_batch(db, 1, items)
+    return time.perf_counter() - start
+
+async def run(args):
+    await seed(args.accounts, args.balance)
+    for key in transfer_engine.stats:
+        transfer_engine.stats[key] = 0
+
+    if args.batch:
+        elapsed = await run_batch(args)
+        print(f"batch size         {args.batch}")
+        print(f"committed          {transfer_engine.stats['committed']}")
+        print(f"transfers/sec      {transfer_engine.stats['committed'] / elapsed:,.0f}")
+        await database.dispose_engine()
+        return
+
+    per_worker = args.transfers // args.workers
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(per_worker, args) for _ in range(args.workers)))
+    elapsed = time.perf_counter() - start
+
+    stats = transfer_engine.stats
+    attempts = stats["committed"] + stats["insufficient_funds"] + stats["retries"]
+    print(f"backend            {database.engine.dialect.name}")
+    print(f"workers            {args.workers}")
+    print(f"committed          {stats['committed']}")
+    print(f"insufficient funds {stats['insufficient_funds']}")
+    print(f"transfers/sec      {stats['committed'] / elapsed:,.0f}")
+    print(f"conflict rate      {stats['retries'] / max(attempts, 1):.2%}")
+    await database.dispose_engine()
+
+def main():
+    parser = argparse.ArgumentParser(description="Hammer hot accounts with concurrent transfers")
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--hot", type=int, default=10, help="number of hot accounts")
+    parser.add_argument("--hot-ratio", type=float, default=0.8, help="share of picks that hit a hot account")
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--transfers", type=int, default=20000)
+    parser.add_argument("--balance", type=int, default=1_000_000, help="starting balance in minor units")
+    parser.add_argument("--max-amount", type=int, default=5_000, help="largest transfer in minor units")
+    parser.add_argument("--batch", type=int, default=0, help="measure one transfer_batch of this many items instead")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Throughput benchmark for portfolio valuation.
+#
+# Two measurements on synthetic lots:
+#   in memory  value_lots over --lots lot columns, vectorized (numpy) and with
+#              the plain loop used without numpy, to show the cost per lot
+#   nightly    seeds --users users holding --lots lots between them into the
+#              DATABASE_URL of database.py (default a local SQLite file) and
+#              times nightly_valuation.value_all end to end: chunked reads,
+#              batched quotes from the fake feed, valuation and inserts
+# Reports lots per second for each, so a full run over a given book can be
+# estimated from the rate.
+#
+#   python bench_valuation.py --lots 1000000 --users 50000
+#   DATABASE_URL=mysql+aiomysql://... python bench_valuation.py --lots 5000000 --skip-memory
+import argparse
+import asyncio
+import os
+import random
+import time
+from datetime import date, datetime, timedelta
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./bench_valuation.db")
+os.environ.setdefault("QUOTE_FEED", "fake")
+
+from sqlalchemy import delete, insert
+
+import database
+import portfolio_valuation
+from investments import Base, Investment
+from nightly_valuation import VALUATION_USERS_PER_CHUNK, value_all
+from portfolio_valuation import lot_columns, portfolio_valuations, value_lots
+from users import seed_users
+
+SEED_CHUNK_SIZE = 20000
+INVESTMENT_TYPES = ("stock", "etf", "crypto", "mutual_fund")
+
+# (id, user_id, investment_type, symbol, quantity, purchase_price) rows
+def synthetic_lots(lots: int, users: int, symbols: int):
+    for lot_id in range(1, lots + 1):
+        symbol = random.randrange(symbols)
+        yield (lot_id, random.randint(1, users), INVESTMENT_TYPES[symbol % len(INVESTMENT_TYPES)], f"S{symbol}",
+               random.uniform(1, 100), random.uniform(10, 500))
+
+def report(label: str, lots: int, seconds: float):
+    print(f"{label:<22} {lots:>10} lots in {seconds:8.2f} s   {lots / seconds:12,.0f} lots/s")
+
+def bench_memory(args):
+    rows = list(synthetic_lots(args.lots, args.users, args.symbols))
+    prices = {f"S{symbol}": random.uniform(10, 500) for symbol in range(args.symbols)}
+    if portfolio_valuation.numpy is not None:
+        started = time.perf_counter()
+        value_lots(lot_columns(rows), prices, with_lots=False)
+        report("in memory numpy", len(rows), time.perf_counter() - started)
+    numpy, portfolio_valuation.numpy = portfolio_valuation.numpy, None
+    try:
+        started = time.perf_counter()
+        value_lots(lot_columns(rows), prices, with_lots=False)
+        report("in memory loop", len(rows), time.perf_counter() - started)
+    finally:
+        portfolio_valuation.numpy = numpy
+
+async def seed(args):
+    await database.create_all(Base, portfolio_valuations)
+    purchased = datetime.now() - timedelta(days=365)
+    async with database.engine.begin() as conn:
+        await seed_users(conn, args.users)
+        await conn.execute(delete(portfolio_valuations))
+        await conn.execute(delete(Investment.__table__))
+    chunk = []
+    for _, user_id, investment_type, symbol, quantity, price in synthetic_lots(args.lots, args.users, args.symbols):
+        chunk.append({"user_id": user_id, "investment_type": investment_type, "symbol": symbol, "quantity": quantity,
+                      "purchase_price": price, "purchase_date": purchased, "is_open": True})
+        if len(chunk) == SEED_CHUNK_SIZE:
+            async with database.engine.begin() as conn:
+                await conn.execute(insert(Investment.__table__), chunk)
+            chunk = []
+    if chunk:
+        async with database.engine.begin() as conn:
+            await conn.execute(insert(Investment.__table__), chunk)
+
+async def bench_nightly(args):
+    await seed(args)
+    print(f"backend                {database.engine.dialect.name}")
+    started = time.perf_counter()
+    lots = await value_all(date.today(), users_per_chunk=args.users_per_chunk)
+    report("nightly run", lots, time.perf_counter() - started)
+    await database.dispose_engine()
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure portfolio valuation throughput")
+    parser.add_argument("--lots", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--symbols", type=int, default=5000)
+    parser.add_argument("--users-per-chunk", type=int, default=VALUATION_USERS_PER_CHUNK)
+    parser.add_argument("--skip-memory", action="store_true", help="only run the nightly benchmark")
+    parser.add_argument("--skip-nightly", action="store_true", help="only run the in-memory benchmark")
+    args = parser.parse_args()
+    if not args.skip_memory:
+        bench_memory(args)
+    if not args.skip_nightly:
+        asyncio.run(bench_nightly(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# Replay benchmark for the velocity engine.
+#
+# Feeds a historical card_transactions dump (CSV with user_id, amount,
+# transaction_type and date columns, e.g. exported with the database's own
+# CSV export) through score() and record() in time order, using each row's
+# own timestamp as the clock, and reports throughput, per-event latency and
+# how many transactions the rules would have blocked. Without a dump it
+# replays synthetic traffic.
+#
+#   python bench_velocity.py --dump card_transactions.csv
+#   python bench_velocity.py --synthetic 1000000 --users 50000
+import argparse
+import csv
+import random
+import statistics
+import time
+from datetime import datetime
+
+from money import to_minor
+from velocity import VelocityEngine
+
+# (user_id, amount in minor units, epoch seconds) rows from a dump, in file order
+def read_dump(path: str):
+    with open(path, newline="", encoding="utf-8") as source:
+        for row in csv.DictReader(source):
+            yield int(row["user_id"]), to_minor(row["amount"]), datetime.fromisoformat(row["date"]).timestamp()
+
+def synthetic(events: int, users: int, seconds: int):
+    start = time.time() - seconds
+    for index in range(events):
+        yield random.randint(1, users), random.randint(100, 20_000), start + seconds * index / events
+
+def replay(engine: VelocityEngine, rows, sample_every: int):
+    latencies = []
+    events = 0
+    started = time.perf_counter()
+    for user_id, amount, now in rows:
+        if events % sample_every == 0:
+            before = time.perf_counter()
+            verdict = engine.score(user_id, amount, now=now)
+            latencies.append(time.perf_counter() - before)
+        else:
+            verdict = engine.score(user_id, amount, now=now)
+        if verdict.allowed:
+            engine.record(user_id, amount, now=now)
+        events += 1
+    return events, time.perf_counter() - started, latencies
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay card transactions through the velocity engine")
+    parser.add_argument("--dump", help="CSV dump of card_transactions (sorted by date)")
+    parser.add_argument("--synthetic", type=int, default=1_000_000, help="synthetic events when no dump is given")
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--days", type=int, default=7, help="time span of the synthetic events")
+    parser.add_argument("--sample-every", type=int, default=10, help="time one in N scores")
+    args = parser.parse_args()
+
+    rows = read_dump(args.dump) if args.dump else synthetic(args.synthetic, args.users, args.days * 86400)
+    engine = VelocityEngine(max_users=10_000_000)
+    events, elapsed, latencies = replay(engine, rows, args.sample_every)
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"events             {events:,}")
+    print(f"users              {len(engine.users):,}")
+    print(f"events/sec         {events / elapsed:,.0f} (score + record)")
+    print(f"score p50          {quantiles[49] * 1e6:.1f} us")
+    print(f"score p99          {quantiles[98] * 1e6:.1f} us")
+    print(f"blocked            {engine.blocked:,} ({engine.blocked / max(events, 1):.3%})")
+
+if __name__ == "__main__":
+    main()
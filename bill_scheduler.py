@@ -0,0 +1,393 @@
+# Scheduler for recurring bills.
+#
+# A recurring BillPayment row is the schedule: next_run_at is when its next
+# period is paid. Each worker keeps a heap of (next_run_at, id) for the bills
+# due within SCHEDULER_LOOKAHEAD_SECONDS, loaded incrementally: every refresh
+# only reads rows past the last loaded key, plus overdue rows nobody holds
+# (failed runs, expired leases, bills a worker loaded but never claimed).
+#
+# Due bills are claimed in batches with SELECT ... FOR UPDATE SKIP LOCKED and
+# a lease (lease_owner, lease_expires_at), so any number of workers can run
+# against the same table and every period is paid once. Claimed bills run
+# concurrently, at most SCHEDULER_CONCURRENCY at a time; each run records the
+# paid period as its own BillPayment row and moves the schedule to the next
+# period in one transaction. The payee gateway is called between the lease
+# check and that transaction, so no row lock is held while it responds. A
+# worker that dies leaves its leases to expire and the bills are picked up by
+# the others.
+#
+# Workers also resolve payments POST /bill/pay left pending (the payee was
+# unavailable, or the API process died mid-payment): every
+# SCHEDULER_RESOLVE_SECONDS they lease the pending rows older than
+# PENDING_RESEND_AFTER_SECONDS the same way and resend them with their stored
+# key, which the payee deduplicates against the original attempt.
+#
+#   python bill_scheduler.py                     # run a scheduler worker
+#   python bill_scheduler.py --backfill          # schedule recurring bills that predate next_run_at
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import heapq
+import logging
+import os
+import socket
+import time
+
+from sqlalchemy import and_, or_, select, tuple_, update
+
+import metrics
+from bill_payment_gateway import BillPayment, complete_payment, next_due_date, scheduled_run
+from database import SessionLocal, dispose_engine
+from notification_queue import notification_writer, send_notification
+from payee_gateway import PayeeGatewayClient, PayeeRejected, payee_gateway
+
+SCHEDULER_CONCURRENCY = int(os.environ.get("SCHEDULER_CONCURRENCY", "32"))
+SCHEDULER_CLAIM_BATCH = int(os.environ.get("SCHEDULER_CLAIM_BATCH", "200"))
+SCHEDULER_LEASE_SECONDS = int(os.environ.get("SCHEDULER_LEASE_SECONDS", "300"))
+SCHEDULER_LOOKAHEAD_SECONDS = int(os.environ.get("SCHEDULER_LOOKAHEAD_SECONDS", "300"))
+SCHEDULER_REFRESH_SECONDS = 5.0
+SCHEDULER_LOAD_BATCH = 5000
+SCHEDULER_RETRY_SECONDS = 600
+SCHEDULER_RESOLVE_SECONDS = 60.0
+PENDING_RESEND_AFTER_SECONDS = int(os.environ.get("PENDING_RESEND_AFTER_SECONDS", "120"))
+
+logger = logging.getLogger(__name__)
+
+class BillScheduler:
+    def __init__(self, owner: str = None, concurrency: int = SCHEDULER_CONCURRENCY, claim_batch: int = SCHEDULER_CLAIM_BATCH,
+                 lease_seconds: int = SCHEDULER_LEASE_SECONDS, lookahead_seconds: int = SCHEDULER_LOOKAHEAD_SECONDS,
+                 notify: bool = True, gateway: PayeeGatewayClient = None):
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.concurrency = concurrency
+        self.claim_batch = claim_batch
+        self.lease = timedelta(seconds=lease_seconds)
+        self.lookahead = timedelta(seconds=lookahead_seconds)
+        self.notify = notify
+        self.gateway = gateway or payee_gateway
+        self.heap = []  # (next_run_at, bill id)
+        self.loaded_through = None  # (next_run_at, id) of the last row loaded
+        self.running = set()
+        self.last_refresh = 0.0
+        self.last_resolve = 0.0
+        self.claimed = 0
+        self.paid = 0
+        self.rejected = 0
+        self.failed = 0
+        self.lost_claims = 0
+        self.resolved = 0
+        metrics.register(f"bill_scheduler.{self.owner}", self.stats)
+
+    # Load newly due-soon bills past the last loaded key, and unheld overdue ones
+    async def refresh(self):
+        now = datetime.now()
+        horizon = now + self.lookahead
+        async with SessionLocal() as db:
+            while True:
+                query = (select(BillPayment.next_run_at, BillPayment.id)
+                         .where(BillPayment.next_run_at <= horizon)
+                         .order_by(BillPayment.next_run_at, BillPayment.id)
+                         .limit(SCHEDULER_LOAD_BATCH))
+                if self.loaded_through is not None:
+                    query = query.where(tuple_(BillPayment.next_run_at, BillPayment.id) > tuple_(*self.loaded_through))
+                rows = (await db.execute(query)).all()
+                for row in rows:
+                    heapq.heappush(self.heap, (row.next_run_at, row.id))
+                if rows:
+                    self.loaded_through = (rows[-1].next_run_at, rows[-1].id)
+                if len(rows) < SCHEDULER_LOAD_BATCH:
+                    break
+
+            overdue = (await db.execute(
+                select(BillPayment.next_run_at, BillPayment.id)
+                .where(BillPayment.next_run_at <= now,
+                       or_(BillPayment.lease_expires_at == None, BillPayment.lease_expires_at < now))
+                .order_by(BillPayment.next_run_at)
+                .limit(self.claim_batch)
+            )).all()
+            for row in overdue:
+                heapq.heappush(self.heap, (row.next_run_at, row.id))
+        self.last_refresh = time.monotonic()
+
+    # Due bill ids from the top of the heap, at most `limit`
+    def pop_due(self, limit: int):
+        now = datetime.now()
+        due = set()
+        while self.heap and self.heap[0][0] <= now and len(due) < limit:
+            due.add(heapq.heappop(self.heap)[1])
+        return list(due)
+
+    # Lease the given bills to this worker; returns the ids actually claimed
+    async def claim(self, bill_ids):
+        now = datetime.now()
+        # Whole seconds, so the read-back below matches on DATETIME columns without fractions
+        expires = (now + self.lease).replace(microsecond=0)
+        available = and_(BillPayment.next_run_at <= now,
+                         or_(BillPayment.lease_expires_at == None, BillPayment.lease_expires_at < now))
+        async with SessionLocal() as db:
+            # Rows another worker is claiming right now are skipped, not waited for
+            locked = (await db.scalars(
+                select(BillPayment.id)
+                .where(BillPayment.id.in_(bill_ids), available)
+                .with_for_update(skip_locked=True)
+            )).all()
+            if not locked:
+                return []
+            # The conditional update keeps claims exclusive on backends without row locks
+            await db.execute(
+                update(BillPayment)
+                .where(BillPayment.id.in_(locked), available)
+                .values(lease_owner=self.owner, lease_expires_at=expires)
+            )
+            claimed = (await db.scalars(
+                select(BillPayment.id).where(BillPayment.id.in_(locked), BillPayment.lease_owner == self.owner,
+                                             BillPayment.lease_expires_at == expires)
+            )).all()
+            await db.commit()
+        self.claimed += len(claimed)
+        return claimed
+
+    # Pay the current period of one claimed bill and schedule the next
+    async def execute(self, bill_id: int):
+        now = datetime.now()
+        leased = and_(BillPayment.id == bill_id, BillPayment.lease_owner == self.owner, BillPayment.lease_expires_at > now)
+        try:
+            async with SessionLocal() as db:
+                bill = await db.scalar(select(BillPayment).where(leased))
+            if bill is None:
+                self.lost_claims += 1
+                return
+
+            # One key per bill and period: a period retried after a crash or a lost
+            # lease is deduplicated by the payee instead of paid again
+            idempotency_key = f"bill-{bill.id}-{bill.due_date.isoformat()}"
+            try:
+                await self.gateway.pay(bill.payee, bill.amount, idempotency_key, str(bill.user_id))
+                status = "completed"
+            except PayeeRejected:
+                status = "failed"
+
+            async with SessionLocal() as db:
+                bill = await db.scalar(select(BillPayment).where(leased).with_for_update())
+                if bill is None:
+                    self.lost_claims += 1
+                    return
+                db.add(BillPayment(
+                    user_id=bill.user_id,
+                    payee=bill.payee,
+                    amount=bill.amount,
+                    due_date=bill.due_date,
+                    is_recurring=False,
+                    payment_status=status,
+                    idempotency_key=idempotency_key,
+                    date=now
+                ))
+                if bill.due_day is None:
+                    bill.due_day = bill.due_date.day
+                bill.due_date = next_due_date(bill.due_date, bill.due_day)
+                bill.next_run_at = scheduled_run(bill.due_date)
+                bill.lease_owner = None
+                bill.lease_expires_at = None
+                user_id, amount, payee = bill.user_id, bill.amount, bill.payee
+                await db.commit()
+        except Exception:
+            # Includes PayeeUnavailable: the period is retried later with the same key
+            self.failed += 1
+            logger.exception("Recurring bill %s failed; retrying in %s seconds", bill_id, SCHEDULER_RETRY_SECONDS)
+            await self.release(bill_id, now + timedelta(seconds=SCHEDULER_RETRY_SECONDS))
+            return
+
+        if status == "completed":
+            self.paid += 1
+            message = f"Recurring bill payment of {amount} to {payee} completed"
+        else:
+            self.rejected += 1
+            message = f"Recurring bill payment of {amount} to {payee} was rejected by the payee"
+        if self.notify:
+            await send_notification(user_id, message)
+
+    async def release(self, bill_id: int, retry_at: datetime):
+        try:
+            async with SessionLocal() as db:
+                await db.execute(
+                    update(BillPayment)
+                    .where(BillPayment.id == bill_id, BillPayment.lease_owner == self.owner)
+                    .values(next_run_at=retry_at, lease_owner=None, lease_expires_at=None)
+                )
+                await db.commit()
+        except Exception:
+            # The lease expires on its own and another worker takes over
+            logger.exception("Releasing recurring bill %s failed", bill_id)
+
+    # Lease up to `limit` payments POST /bill/pay left pending; returns their ids
+    async def claim_pending(self, limit: int):
+        now = datetime.now()
+        expires = (now + self.lease).replace(microsecond=0)
+        unresolved = and_(BillPayment.payment_status == "pending", BillPayment.next_run_at == None,
+                          BillPayment.idempotency_key != None,
+                          BillPayment.date < now - timedelta(seconds=PENDING_RESEND_AFTER_SECONDS),
+                          or_(BillPayment.lease_expires_at == None, BillPayment.lease_expires_at < now))
+        async with SessionLocal() as db:
+            locked = (await db.scalars(
+                select(BillPayment.id).where(unresolved).order_by(BillPayment.id).limit(limit)
+                .with_for_update(skip_locked=True)
+            )).all()
+            if not locked:
+                return []
+            await db.execute(
+                update(BillPayment)
+                .where(BillPayment.id.in_(locked), unresolved)
+                .values(lease_owner=self.owner, lease_expires_at=expires)
+            )
+            claimed = (await db.scalars(
+                select(BillPayment.id).where(BillPayment.id.in_(locked), BillPayment.lease_owner == self.owner,
+                                             BillPayment.lease_expires_at == expires)
+            )).all()
+            await db.commit()
+        return claimed
+
+    # Resend one leased pending payment with its original key and record the outcome
+    async def resolve(self, payment_id: int):
+        leased = and_(BillPayment.id == payment_id, BillPayment.lease_owner == self.owner,
+                      BillPayment.lease_expires_at > datetime.now())
+        try:
+            async with SessionLocal() as db:
+                payment = await db.scalar(select(BillPayment).where(leased))
+            if payment is None:
+                self.lost_claims += 1
+                return
+            try:
+                await self.gateway.pay(payment.payee, payment.amount, payment.idempotency_key, str(payment.user_id))
+                status = "completed"
+            except PayeeRejected:
+                status = "failed"
+
+            async with SessionLocal() as db:
+                payment = await db.scalar(select(BillPayment).where(leased).with_for_update())
+                if payment is None:
+                    self.lost_claims += 1
+                    return
+                if payment.payment_status != "pending":
+                    status = None  # a retry of the request settled it first
+                elif status == "completed":
+                    complete_payment(db, payment)
+                else:
+                    payment.payment_status = "failed"
+                payment.lease_owner = None
+                payment.lease_expires_at = None
+                user_id, amount, payee = payment.user_id, payment.amount, payment.payee
+                await db.commit()
+        except Exception:
+            # Includes PayeeUnavailable: the lease expires and the payment is resent later
+            self.failed += 1
+            logger.exception("Resolving pending bill payment %s failed", payment_id)
+            return
+
+        self.resolved += 1
+        if self.notify and status:
+            if status == "completed":
+                message = f"Bill payment of {amount} to {payee} completed"
+            else:
+                message = f"Bill payment of {amount} to {payee} was rejected by the payee"
+            await send_notification(user_id, message)
+
+    def start(self, bill_ids, work=None):
+        for bill_id in bill_ids:
+            task = asyncio.create_task((work or self.execute)(bill_id))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    # One scheduling step; returns seconds until the next step is useful
+    async def tick(self):
+        if time.monotonic() - self.last_refresh >= SCHEDULER_REFRESH_SECONDS:
+            await self.refresh()
+
+        # Never lease more than can start now, so leases do not run out while queued
+        free = self.concurrency - len(self.running)
+        if free > 0:
+            due = self.pop_due(min(free, self.claim_batch))
+            if due:
+                self.start(await self.claim(due))
+                return 0
+            if time.monotonic() - self.last_resolve >= SCHEDULER_RESOLVE_SECONDS:
+                self.last_resolve = time.monotonic()
+                self.start(await self.claim_pending(min(free, self.claim_batch)), self.resolve)
+
+        wait = SCHEDULER_REFRESH_SECONDS - (time.monotonic() - self.last_refresh)
+        if self.heap and free > 0:
+            wait = min(wait, (self.heap[0][0] - datetime.now()).total_seconds())
+        return max(wait, 0.01)
+
+    async def run(self, until_idle: bool = False):
+        while True:
+            wait = await self.tick()
+            if until_idle and not self.heap and not self.running:
+                await self.refresh()
+                if not self.heap:
+                    return
+                continue
+            if wait:
+                if self.running:
+                    await asyncio.wait(self.running, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    await asyncio.sleep(wait)
+
+    async def drain(self):
+        if self.running:
+            await asyncio.wait(self.running)
+
+    def stats(self):
+        return {
+            "scheduled": len(self.heap),
+            "running": len(self.running),
+            "claimed": self.claimed,
+            "paid": self.paid,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "lost_claims": self.lost_claims,
+            "resolved": self.resolved,
+        }
+
+# Give recurring bills created before the scheduler existed a next_run_at
+async def backfill(chunk_size: int = SCHEDULER_LOAD_BATCH):
+    scheduled = 0
+    while True:
+        async with SessionLocal() as db:
+            bills = (await db.scalars(
+                select(BillPayment)
+                # Pending and failed first payments are not schedules yet
+                .where(BillPayment.is_recurring == True, BillPayment.next_run_at == None,
+                       BillPayment.payment_status == "completed")
+                .limit(chunk_size)
+            )).all()
+            if not bills:
+                break
+            for bill in bills:
+                bill.next_run_at = scheduled_run(bill.due_date)
+                bill.due_day = bill.due_day or bill.due_date.day
+            await db.commit()
+        scheduled += len(bills)
+    logger.info("Scheduled %s recurring bills", scheduled)
+
+async def main(args):
+    try:
+        if args.backfill:
+            await backfill()
+            return
+        await notification_writer.start()
+        await payee_gateway.start()
+        scheduler = BillScheduler(concurrency=args.concurrency)
+        try:
+            await scheduler.run()
+        finally:
+            await scheduler.drain()
+            await payee_gateway.stop()
+            await notification_writer.stop()
+    finally:
+        await dispose_engine()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pay recurring bills as they come due")
+    parser.add_argument("--concurrency", type=int, default=SCHEDULER_CONCURRENCY)
+    parser.add_argument("--backfill", action="store_true", help="schedule recurring bills without a next_run_at and exit")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parser.parse_args()))
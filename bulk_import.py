@@ -0,0 +1,209 @@
+# Offline bulk registration for migrating a partner's customer base.
+#
+# Streams a CSV or JSONL file (full_name, email, password or password_hash),
+# validates it a batch at a time with the registration regexes, hashes
+# passwords across a process pool and inserts each batch with one executemany
+# in its own transaction. After every committed batch the number of consumed
+# input rows is checkpointed, so an interrupted run resumes where it stopped;
+# rows of a batch that committed just before a crash are skipped on resume as
+# already-registered emails. Emails are lowercased, so duplicates that differ
+# only in case are caught in the file and against the table. A batch whose
+# insert still hits the unique email index (a user registered meanwhile) is
+# retried row by row, and only the conflicting rows are rejected. Rejected
+# rows are appended to a rejects file.
+#
+# Hashing dominates the run time at production bcrypt cost. Partners that can
+# export existing bcrypt hashes should send them as password_hash: those rows
+# are stored as-is and skip hashing entirely.
+#
+#   python bulk_import.py customers.csv --workers 32
+#   python bulk_import.py customers.jsonl --batch-size 10000
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, insert, select
+from sqlalchemy.exc import IntegrityError
+
+from database import SessionLocal, dispose_engine
+from password_pool import pwd_context
+from registration import EMAIL_REGEX, PASSWORD_REGEX, new_user_fields
+
+BATCH_SIZE = 5000
+
+# Columns of the users table written by registration
+users = Table(
+    "users", MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("full_name", String(120)),
+    Column("email", String(120), unique=True),
+    Column("password", String(255)),
+    Column("otp_secret", String(32)),
+    Column("status", String(20)),
+)
+
+# Stream rows as dicts from a CSV or JSONL file
+def read_rows(path: str):
+    with open(path, newline="", encoding="utf-8") as source:
+        if path.endswith((".jsonl", ".ndjson")):
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(source)
+
+def batches(rows, size: int):
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+# Validate a batch column by column; returns (valid rows, rejected rows)
+def validate_batch(rows):
+    names = [(row.get("full_name") or "").strip() for row in rows]
+    emails = [(row.get("email") or "").strip().lower() for row in rows]
+    passwords = [row.get("password") or "" for row in rows]
+    hashes = [row.get("password_hash") or "" for row in rows]
+
+    email_ok = [bool(EMAIL_REGEX.match(email)) for email in emails]
+    hash_ok = [bool(password_hash) and pwd_context.identify(password_hash) == "bcrypt" for password_hash in hashes]
+    password_ok = [hashed or bool(PASSWORD_REGEX.match(password)) for hashed, password in zip(hash_ok, passwords)]
+
+    valid = []
+    rejected = []
+    seen = set()
+    for index, row in enumerate(rows):
+        if not names[index]:
+            reason = "Missing full name"
+        elif not email_ok[index]:
+            reason = "Invalid email format"
+        elif not password_ok[index]:
+            reason = "Weak password"
+        elif emails[index] in seen:
+            reason = "Duplicate email in file"
+        else:
+            seen.add(emails[index])
+            valid.append({"full_name": names[index], "email": emails[index],
+                          "password": passwords[index], "password_hash": hashes[index] if hash_ok[index] else None})
+            continue
+        rejected.append({"email": emails[index], "reason": reason})
+    return valid, rejected
+
+# Runs in a worker process
+def hash_passwords(passwords):
+    return [pwd_context.hash(password) for password in passwords]
+
+# Hash a batch of passwords split evenly across the process pool
+async def hash_batch(pool, passwords, workers: int):
+    if not passwords:
+        return []
+    size = -(-len(passwords) // workers)
+    loop = asyncio.get_running_loop()
+    slices = await asyncio.gather(*(loop.run_in_executor(pool, hash_passwords, passwords[start:start + size])
+                                    for start in range(0, len(passwords), size)))
+    return [hashed for chunk in slices for hashed in chunk]
+
+# The lowercased emails already in the table (matched through the email index,
+# so stored spellings other than lowercase are found under a case-insensitive collation)
+async def existing_emails(db, emails):
+    return {email.lower() for email in (await db.scalars(select(users.c.email).where(users.c.email.in_(emails)))).all()}
+
+# Insert a batch with one executemany; on a unique-index conflict insert it
+# row by row instead. Returns the emails that conflicted.
+async def insert_users(rows):
+    values = [new_user_fields(row["full_name"], row["email"], row["password_hash"]) for row in rows]
+    async with SessionLocal() as db:
+        try:
+            await db.execute(insert(users), values)
+            await db.commit()
+            return set()
+        except IntegrityError:
+            await db.rollback()
+
+        conflicts = set()
+        for row, fields in zip(rows, values):
+            try:
+                async with db.begin_nested():
+                    await db.execute(insert(users), [fields])
+            except IntegrityError:
+                conflicts.add(row["email"])
+        await db.commit()
+        return conflicts
+
+class Checkpoint:
+    def __init__(self, path: str):
+        self.path = path
+        self.state = {"rows": 0, "imported": 0, "rejected": 0}
+        if os.path.exists(path):
+            with open(path) as source:
+                self.state.update(json.load(source))
+
+    # Write atomically so a crash never leaves a torn checkpoint
+    def save(self):
+        with open(self.path + ".tmp", "w") as target:
+            json.dump(self.state, target)
+        os.replace(self.path + ".tmp", self.path)
+
+async def import_users(path: str, checkpoint: Checkpoint, rejects_path: str, batch_size: int, workers: int):
+    rows = read_rows(path)
+    # Skip the rows consumed by a previous run
+    for _ in itertools.islice(rows, checkpoint.state["rows"]):
+        pass
+
+    started = time.perf_counter()
+    imported_at_start = checkpoint.state["imported"]
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(rejects_path, "a") as rejects:
+        for batch in batches(rows, batch_size):
+            valid, rejected = validate_batch(batch)
+
+            if valid:
+                async with SessionLocal() as db:
+                    existing = await existing_emails(db, [row["email"] for row in valid])
+                rejected += [{"email": row["email"], "reason": "Email already registered"} for row in valid if row["email"] in existing]
+                valid = [row for row in valid if row["email"] not in existing]
+
+            # Hash without holding a database connection
+            to_hash = [row for row in valid if not row["password_hash"]]
+            for row, hashed in zip(to_hash, await hash_batch(pool, [row["password"] for row in to_hash], workers)):
+                row["password_hash"] = hashed
+
+            if valid:
+                conflicts = await insert_users(valid)
+                if conflicts:
+                    rejected += [{"email": email, "reason": "Email already registered"} for email in sorted(conflicts)]
+                    valid = [row for row in valid if row["email"] not in conflicts]
+
+            for reject in rejected:
+                rejects.write(json.dumps(reject) + "\n")
+            rejects.flush()
+
+            checkpoint.state["rows"] += len(batch)
+            checkpoint.state["imported"] += len(valid)
+            checkpoint.state["rejected"] += len(rejected)
+            checkpoint.save()
+
+            rate = (checkpoint.state["imported"] - imported_at_start) / (time.perf_counter() - started)
+            print(f"rows {checkpoint.state['rows']:>10,}  imported {checkpoint.state['imported']:>10,}  "
+                  f"rejected {checkpoint.state['rejected']:>8,}  {rate:,.0f} users/sec", flush=True)
+
+async def main(args):
+    checkpoint = Checkpoint(args.checkpoint or args.path + ".checkpoint")
+    try:
+        await import_users(args.path, checkpoint, args.rejects or args.path + ".rejects.jsonl", args.batch_size, args.workers)
+    finally:
+        await dispose_engine()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk-register users from a CSV or JSONL file")
+    parser.add_argument("path")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="password hashing processes")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: <path>.checkpoint)")
+    parser.add_argument("--rejects", help="rejected rows file (default: <path>.rejects.jsonl)")
+    asyncio.run(main(parser.parse_args()))
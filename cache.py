@@ -0,0 +1,139 @@
+from collections import OrderedDict
+import os
+import time
+
+import metrics
+
+# In-process LRU/TTL cache with an optional shared backend behind it.
+#
+# Reads check the local LRU first, then the shared backend, then call the
+# loader. Invalidations are numbered from one counter, and a read-through only
+# stores what it loaded if its key was not invalidated while it was loading,
+# so a read racing with a write cannot put a stale value back. Only the last
+# maxsize invalidated keys are remembered; a load that started before the
+# oldest forgotten one is not stored, which costs a miss but never staleness.
+
+# Shared cache backend interface (e.g. Redis); values must be plain data
+class CacheBackend:
+    async def get(self, key):
+        raise NotImplementedError
+
+    async def set(self, key, value, ttl: float):
+        raise NotImplementedError
+
+    async def delete(self, key):
+        raise NotImplementedError
+
+# Local stand-in for a shared backend, used for tests and single-process setups
+class LocalCacheBackend(CacheBackend):
+    def __init__(self):
+        self.values = {}
+
+    async def get(self, key):
+        entry = self.values.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    async def set(self, key, value, ttl: float):
+        self.values[key] = (value, time.monotonic() + ttl)
+
+    async def delete(self, key):
+        self.values.pop(key, None)
+
+class Cache:
+    def __init__(self, name: str, maxsize: int, ttl: float, backend: CacheBackend = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        self.entries = OrderedDict()
+        self.generations = OrderedDict()  # key -> number of its last invalidation, oldest first
+        self.invalidations = 0
+        self.forgotten = 0  # number of the newest invalidation dropped from generations
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        metrics.register(f"cache.{name}", self.stats)
+
+    # Local lookup; returns (found, value)
+    def get_local(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        value, expires = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            self.evictions += 1
+            return False, None
+        self.entries.move_to_end(key)
+        return True, value
+
+    def set_local(self, key, value):
+        self.entries[key] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get(self, key):
+        found, value = self.get_local(key)
+        if found:
+            self.hits += 1
+            return value
+        if self.backend is not None:
+            value = await self.backend.get(key)
+            if value is not None:
+                self.hits += 1
+                self.set_local(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    # Read-through: return the cached value or load, store and return it
+    async def get_or_load(self, key, loader):
+        value = await self.get(key)
+        if value is not None:
+            return value
+
+        generation = self.generation(key)
+        value = await loader()
+        if value is not None:
+            await self.set(key, value, generation)
+        return value
+
+    # Current generation of a key; pass it to set() when storing a value loaded after reading it
+    def generation(self, key):
+        return self.invalidations
+
+    def invalidated_since(self, key, generation):
+        return self.generations.get(key, self.forgotten) > generation
+
+    # Store a value. With a generation, the value is dropped if the key was
+    # invalidated since that generation was read.
+    async def set(self, key, value, generation=None):
+        if generation is not None and self.invalidated_since(key, generation):
+            return
+        self.set_local(key, value)
+        if self.backend is not None:
+            await self.backend.set(key, value, self.ttl)
+
+    async def invalidate(self, *keys):
+        for key in keys:
+            self.invalidations += 1
+            self.generations[key] = self.invalidations
+            self.generations.move_to_end(key)
+            while len(self.generations) > self.maxsize:
+                _, self.forgotten = self.generations.popitem(last=False)
+            if self.entries.pop(key, None) is not None:
+                self.evictions += 1
+            if self.backend is not None:
+                await self.backend.delete(key)
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+# Wallet balances in minor units, keyed by user id
+BALANCE_CACHE_SIZE = int(os.environ.get("BALANCE_CACHE_SIZE", "100000"))
+BALANCE_CACHE_TTL = float(os.environ.get("BALANCE_CACHE_TTL", "30"))
+balance_cache = Cache("wallet_balance", BALANCE_CACHE_SIZE, BALANCE_CACHE_TTL)
@@ -0,0 +1,333 @@
+from collections import OrderedDict
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+from sqlalchemy import delete, func, insert, select
+
+import metrics
+from batch_writer import BatchWriter, parse_timestamp, timestamp
+from cache import balance_cache
+from database import SessionLocal
+from spending_limits import SpendingLimitExceeded, consume, current_spend, spend_in_memory
+from velocity import velocity_engine
+
+# Card authorization engine.
+#
+# Every card seen is held in an in-memory table of CardState: whether the card
+# is usable, the wallet balance it draws on minus the holds this process has
+# approved but not yet posted, and its spending per limit period. Declines
+# that table can already tell (inactive card, funds or limits exhausted,
+# velocity) cost no database work. An approval is then reserved in the
+# database with one short transaction: a wallet_holds row, checked against the
+# balance minus every other hold under the wallet's row lock, and the card
+# spending counters. Withdrawals and other wallet debits see those holds, and
+# every worker process can authorize safely: the in-memory table is only a
+# pre-filter. The approved authorization is handed to a write-behind
+# BatchWriter, which records CardTransaction rows, posts the wallet debits and
+# deletes their holds in batches.
+#
+# The table is kept fresh by change events: a feed task tails the append-only
+# wallet_transactions ledger, applying every new entry to the cards it
+# affects, whichever process wrote it. A posted card debit lowers the balance
+# and releases its hold in the same step. Card activation changes made in this
+# process apply at once; a state is also reloaded after CARD_STATE_TTL_SECONDS,
+# which bounds how long a change made elsewhere takes to arrive; a
+# reservation the database refuses also forces a reload.
+
+CARD_STATE_TTL_SECONDS = float(os.environ.get("CARD_STATE_TTL_SECONDS", "60"))
+CARD_STATE_MAX_CARDS = int(os.environ.get("CARD_STATE_MAX_CARDS", "1000000"))
+CARD_FEED_INTERVAL_MS = int(os.environ.get("CARD_FEED_INTERVAL_MS", "100"))
+CARD_AUTH_BATCH_SIZE = int(os.environ.get("CARD_AUTH_BATCH_SIZE", "500"))
+CARD_AUTH_FLUSH_MS = int(os.environ.get("CARD_AUTH_FLUSH_MS", "20"))
+CARD_AUTH_SPOOL_PATH = os.environ.get("CARD_AUTH_SPOOL_PATH", "card_authorizations.spool")
+CARD_AUTH_SPOOL_FSYNC = os.environ.get("CARD_AUTH_SPOOL_FSYNC", "true").lower() == "true"
+CARD_FEED_BATCH = 5000
+# Ledger ids are assigned before commit, so entries can become visible out of
+# id order; the feed rescans this many ids below its high-water mark
+CARD_FEED_OVERLAP = 1000
+
+# Wallet entry type of a posted card authorization
+CARD_DEBIT_PREFIX = "card_"
+
+logger = logging.getLogger(__name__)
+
+class CardState:
+    __slots__ = ("user_id", "active", "balance", "held", "spent", "last_entry_id", "loaded_at")
+
+    def __init__(self, user_id: int, active: bool, balance: int, last_entry_id: int, spent: dict = None):
+        self.user_id = user_id
+        self.active = active
+        self.balance = balance  # wallet balance in minor units, as of last_entry_id
+        self.held = 0  # approved authorizations not yet posted to the wallet
+        self.spent = spent or {}  # card spending per limit period, see spending_limits.current_spend
+        self.last_entry_id = last_entry_id
+        self.loaded_at = time.monotonic()
+
+    @property
+    def available(self):
+        return self.balance - self.held
+
+class Decision:
+    __slots__ = ("approved", "reason", "authorization_id")
+
+    def __init__(self, approved: bool, reason: str = None, authorization_id: str = None):
+        self.approved = approved
+        self.reason = reason
+        self.authorization_id = authorization_id
+
+# Load one card's state from the database
+async def load_card_state(user_id: int):
+    from card_services import card_status
+    from digital_wallet import wallet_state
+
+    async with SessionLocal() as db:
+        user = await card_status(db, user_id)
+        if user is None:
+            return None
+        state = await wallet_state(db, user_id)
+        return CardState(user_id, bool(user.has_virtual_card and user.card_activated), state.balance, state.last_entry_id,
+                         await current_spend(db, user_id, "card"))
+
+# Reserve an approved authorization in the database: the wallet hold and the
+# card spending counters in one transaction. Returns the decline reason, or
+# None once reserved.
+async def reserve_authorization(user_id: int, authorization_id: str, amount: int):
+    from digital_wallet import hold_wallet_funds
+
+    async with SessionLocal() as db:
+        if not await hold_wallet_funds(db, user_id, authorization_id, amount):
+            await db.rollback()
+            return "insufficient_funds"
+        try:
+            await consume(db, user_id, "card", amount)
+        except SpendingLimitExceeded:
+            await db.rollback()
+            return "spending_limit"
+        await db.commit()
+    return None
+
+# Post a batch of approved authorizations: card transaction rows and wallet
+# debits, releasing their holds, in one transaction. Only the authorizations
+# whose hold this transaction removes are posted: a batch that is replayed
+# (it committed but the process died before acknowledging it, or a commit
+# error was retried) finds its holds gone and debits nothing twice.
+async def post_authorizations(items):
+    from card_services import CardTransaction
+    from digital_wallet import WalletHold, append_wallet_entry
+    from money import from_minor
+
+    async with SessionLocal() as db:
+        # Locked, so a concurrent replay of the same batch waits and then finds nothing
+        held = set((await db.scalars(
+            select(WalletHold.authorization_id)
+            .where(WalletHold.authorization_id.in_([item["authorization_id"] for item in items]))
+            .with_for_update()
+        )).all())
+        items = [item for item in items if item["authorization_id"] in held]
+        if not items:
+            return
+        await db.execute(delete(WalletHold).where(WalletHold.authorization_id.in_(held)))
+        await db.execute(insert(CardTransaction), [
+            {"user_id": item["user_id"], "amount": from_minor(item["amount"]),
+             "transaction_type": item["transaction_type"], "date": parse_timestamp(item["date"])}
+            for item in items
+        ])
+        # The hold reserved these funds; limits were counted when it was taken
+        for item in sorted(items, key=lambda item: item["user_id"]):
+            await append_wallet_entry(db, item["user_id"], -item["amount"], CARD_DEBIT_PREFIX + item["transaction_type"],
+                                      allow_negative=True)
+        await db.commit()
+    await balance_cache.invalidate(*{item["user_id"] for item in items})
+
+class CardAuthorizer:
+    def __init__(self, load_state=load_card_state, write_batch=post_authorizations, reserve=reserve_authorization,
+                 max_cards: int = CARD_STATE_MAX_CARDS, ttl_seconds: float = CARD_STATE_TTL_SECONDS,
+                 spool_path: str = CARD_AUTH_SPOOL_PATH, feed: bool = True):
+        self.load_state = load_state
+        self.reserve = reserve
+        self.max_cards = max_cards
+        self.ttl = ttl_seconds
+        self.feed = feed
+        self.cards = OrderedDict()  # user_id -> CardState, least recently used first
+        self.loading = {}  # user_id -> Future of a load in progress
+        self.feed_cursor = 0
+        self.feed_applied = OrderedDict()  # recently applied ledger ids, for the overlap rescan
+        self.feed_task = None
+        self.writer = BatchWriter("card_authorizations", write_batch, max_batch=CARD_AUTH_BATCH_SIZE,
+                                  max_delay_ms=CARD_AUTH_FLUSH_MS, spool_path=spool_path, fsync=CARD_AUTH_SPOOL_FSYNC)
+        self.approved = 0
+        self.declined = 0
+        self.loads = 0
+        self.feed_events = 0
+        metrics.register("card_authorizer", self.stats)
+
+    async def start(self):
+        await self.writer.start()
+        if self.feed:
+            async with SessionLocal() as db:
+                from digital_wallet import WalletTransaction
+
+                self.feed_cursor = await db.scalar(select(func.coalesce(func.max(WalletTransaction.id), 0)))
+            self.feed_task = asyncio.create_task(self.run_feed())
+
+    async def stop(self):
+        if self.feed_task is not None:
+            self.feed_task.cancel()
+            self.feed_task = None
+        await self.writer.stop()
+
+    # In-memory state of a card, loaded on first use or when expired
+    async def card(self, user_id: int):
+        state = self.cards.get(user_id)
+        if state is not None and time.monotonic() - state.loaded_at < self.ttl:
+            self.cards.move_to_end(user_id)
+            return state
+
+        # One load per card however many authorizations arrive meanwhile
+        future = self.loading.get(user_id)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self.loading[user_id] = asyncio.get_running_loop().create_future()
+        try:
+            fresh = await self.load_state(user_id)
+            self.loads += 1
+            if fresh is not None:
+                if state is not None:
+                    # Holds and spending of authorizations still queued for posting carry over
+                    fresh.held = state.held
+                    fresh.spent = state.spent
+                self.cards[user_id] = fresh
+                self.cards.move_to_end(user_id)
+                while len(self.cards) > self.max_cards:
+                    self.evict_one()
+            future.set_result(fresh)
+            return fresh
+        except BaseException as error:
+            future.set_exception(error)
+            future.exception()  # retrieved here so unawaited failures are not logged twice
+            raise
+        finally:
+            del self.loading[user_id]
+
+    def evict_one(self):
+        # Never drop a card with outstanding holds: its available balance would be lost
+        for user_id, state in self.cards.items():
+            if not state.held:
+                del self.cards[user_id]
+                return
+        self.cards.popitem(last=False)
+
+    async def authorize(self, user_id: int, amount: int, transaction_type: str = "purchase"):
+        if amount <= 0:
+            self.declined += 1
+            return Decision(False, "invalid_amount")
+        state = await self.card(user_id)
+        if state is None:
+            self.declined += 1
+            return Decision(False, "unknown_card")
+        if not state.active:
+            self.declined += 1
+            return Decision(False, "card_inactive")
+        if state.available < amount:
+            self.declined += 1
+            return Decision(False, "insufficient_funds")
+        verdict = velocity_engine.reserve(user_id, amount)
+        if not verdict.allowed:
+            self.declined += 1
+            return Decision(False, "suspected_fraud")
+        # Counts the amount against the limits when within them
+        if spend_in_memory(state.spent, "card", amount) is not None:
+            velocity_engine.release(verdict.reservation)
+            self.declined += 1
+            return Decision(False, "spending_limit")
+
+        state.held += amount
+        authorization_id = uuid.uuid4().hex
+        try:
+            reason = await self.reserve(user_id, authorization_id, amount)
+            if reason is None:
+                # Once reserved the authorization must be posted, even if the request goes away
+                await asyncio.shield(self.writer.put({"authorization_id": authorization_id, "user_id": user_id,
+                                                      "amount": amount, "transaction_type": transaction_type,
+                                                      "date": timestamp()}))
+        except BaseException:
+            self.release(state, amount)
+            velocity_engine.release(verdict.reservation)
+            raise
+        if reason is not None:
+            # Another process or a withdrawal spent what this table thought was available
+            self.release(state, amount)
+            velocity_engine.release(verdict.reservation)
+            state.loaded_at = float("-inf")
+            self.declined += 1
+            return Decision(False, reason)
+        self.approved += 1
+        return Decision(True, authorization_id=authorization_id)
+
+    # Undo the in-memory hold and spending of an authorization that was not approved
+    def release(self, state: CardState, amount: int):
+        state.held -= amount
+        for entry in state.spent.values():
+            entry[1] -= amount
+
+    # Change event for a card's status
+    def set_card_status(self, user_id: int, active: bool):
+        state = self.cards.get(user_id)
+        if state is not None:
+            state.active = active
+
+    # Apply one wallet ledger entry to the card it belongs to
+    def apply_entry(self, entry_id: int, user_id: int, amount: int, transaction_type: str):
+        state = self.cards.get(user_id)
+        if state is None:
+            return
+        if transaction_type.startswith(CARD_DEBIT_PREFIX):
+            # The hold is released even when a reload already counted the debit in the balance
+            state.held = max(state.held + amount, 0)
+        if entry_id > state.last_entry_id:
+            state.balance += amount
+            state.last_entry_id = entry_id
+        self.feed_events += 1
+
+    async def poll_feed(self):
+        from digital_wallet import WalletTransaction
+
+        async with SessionLocal() as db:
+            rows = (await db.execute(
+                select(WalletTransaction.id, WalletTransaction.user_id, WalletTransaction.amount, WalletTransaction.transaction_type)
+                .where(WalletTransaction.id > max(self.feed_cursor - CARD_FEED_OVERLAP, 0))
+                .order_by(WalletTransaction.id)
+                .limit(CARD_FEED_BATCH + CARD_FEED_OVERLAP)
+            )).all()
+        for entry_id, user_id, amount, transaction_type in rows:
+            if entry_id in self.feed_applied:
+                continue
+            self.feed_applied[entry_id] = None
+            self.apply_entry(entry_id, user_id, amount, transaction_type)
+            self.feed_cursor = max(self.feed_cursor, entry_id)
+        while len(self.feed_applied) > CARD_FEED_OVERLAP * 4:
+            self.feed_applied.popitem(last=False)
+        return len(rows)
+
+    async def run_feed(self):
+        while True:
+            try:
+                await self.poll_feed()
+            except Exception:
+                logger.exception("Polling the wallet ledger failed")
+            await asyncio.sleep(CARD_FEED_INTERVAL_MS / 1000)
+
+    def stats(self):
+        return {
+            "cards": len(self.cards),
+            "approved": self.approved,
+            "declined": self.declined,
+            "loads": self.loads,
+            "feed_events": self.feed_events,
+            "feed_cursor": self.feed_cursor,
+        }
+
+card_authorizer = CardAuthorizer()
@@ -0,0 +1,59 @@
+# Local stand-in for the payee gateway, for development, tests and benchmarks.
+#
+# Accepts POST /payees/{payee}/payments like the real gateway and answers
+# repeated Idempotency-Keys with the original confirmation. Latency and
+# failures are configurable so retries and circuit breaking can be exercised:
+# payees named "reject-*" always refuse, "down-*" always return 503.
+#
+#   FAKE_PAYEE_LATENCY_MS=200 FAKE_PAYEE_FAILURE_RATE=0.05 python fake_payee.py
+#
+# In-process, without a socket:
+#   PayeeGatewayClient("http://fake-payee", transport=httpx.ASGITransport(app=fake_payee.app))
+from fastapi import FastAPI, Header, HTTPException
+from pydantic import BaseModel
+from typing import Optional
+import asyncio
+import os
+import random
+import uuid
+
+FAKE_PAYEE_LATENCY_MS = float(os.environ.get("FAKE_PAYEE_LATENCY_MS", "50"))
+FAKE_PAYEE_FAILURE_RATE = float(os.environ.get("FAKE_PAYEE_FAILURE_RATE", "0"))
+
+app = FastAPI()
+
+# Idempotency-Key -> confirmation
+confirmations = {}
+
+class PaymentCreate(BaseModel):
+    amount: float
+    reference: str
+    account: Optional[str] = None
+
+@app.post("/payees/{payee}/payments")
+async def create_payment(payee: str, data: PaymentCreate, idempotency_key: str = Header(...)):
+    await asyncio.sleep(random.expovariate(1000 / FAKE_PAYEE_LATENCY_MS) if FAKE_PAYEE_LATENCY_MS else 0)
+
+    if payee.startswith("down-") or random.random() < FAKE_PAYEE_FAILURE_RATE:
+        raise HTTPException(status_code=503, detail="Payee temporarily unavailable")
+    if payee.startswith("reject-") or data.amount <= 0:
+        raise HTTPException(status_code=422, detail="Payment refused")
+
+    confirmation = confirmations.get(idempotency_key)
+    if confirmation is None:
+        confirmation = confirmations[idempotency_key] = {
+            "confirmation_id": uuid.uuid4().hex,
+            "payee": payee,
+            "amount": data.amount,
+            "reference": data.reference,
+        }
+    return confirmation
+
+@app.get("/payees/payments/count")
+async def payment_count():
+    return {"payments": len(confirmations)}
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="127.0.0.1", port=int(os.environ.get("FAKE_PAYEE_PORT", "8100")))
@@ -0,0 +1,330 @@
+from sqlalchemy import Column, DateTime, Integer, LargeBinary, MetaData, String, Table, Text, delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from fastapi import HTTPException
+from datetime import datetime, timedelta
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+import metrics
+from auth import token_identity
+from cache import Cache
+from database import SessionLocal, create_all
+
+# Idempotency-Key handling for the money-moving POST endpoints.
+#
+# A request carrying an Idempotency-Key reserves the key in the
+# idempotency_keys table before it runs and stores its response there when it
+# finishes. A retry of a finished request is answered with the stored
+# response (from the in-process LRU in front of the table when it is there)
+# without running the endpoint again. Duplicates arriving while the first
+# request is still running in this process wait for it and get its response;
+# one running in another process gets 409 and retries. A running request holds
+# its key for IDEMPOTENCY_LEASE_SECONDS: if its process dies without storing a
+# response, the first retry after the lease runs out takes the key over and
+# runs the request again. Keys are scoped to the acting user (the bearer
+# token's subject, or the body's current_user_email on the endpoints that take
+# the user from the body) and endpoint, bound to a digest of the request body,
+# and expire after IDEMPOTENCY_TTL_SECONDS. Once the endpoint has run, its key
+# is kept whatever the outcome, since money may have moved: 5xx responses are
+# stored and replayed like any other, and a request whose response cannot be
+# replayed (the endpoint raised or was cancelled, or the body is larger than
+# the column) leaves a 409 marker that answers its retries.
+
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+IDEMPOTENCY_LEASE_SECONDS = int(os.environ.get("IDEMPOTENCY_LEASE_SECONDS", "120"))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "100000"))
+IDEMPOTENCY_MAX_BODY_BYTES = 2 ** 24 - 1  # the body column (MEDIUMBLOB on MySQL)
+# Larger stored bodies are replayed from the table rather than kept in the LRU
+IDEMPOTENCY_CACHE_MAX_BODY_BYTES = int(os.environ.get("IDEMPOTENCY_CACHE_MAX_BODY_BYTES", str(64 * 1024)))
+IDEMPOTENCY_PURGE_SECONDS = 300
+IDEMPOTENCY_PURGE_BATCH = 5000
+
+IDEMPOTENT_PATHS = {
+    "/transfer",
+    "/transfer/batch",
+    "/send_money",
+    "/wallet/deposit",
+    "/wallet/withdraw",
+    "/bill/pay",
+    "/card/transaction",
+    "/investments/buy",
+    "/investments/sell",
+}
+
+# Endpoints that act as the body's current_user_email rather than the token's subject
+BODY_IDENTITY_PATHS = {"/card/transaction", "/bill/pay"}
+
+# Response headers that describe the original delivery, not the response
+UNSTORED_HEADERS = {b"date", b"server", b"content-length", b"set-cookie"}
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+idempotency_keys = Table(
+    "idempotency_keys", metadata,
+    Column("key", String(64), primary_key=True),  # sha256 of scope and client key
+    Column("fingerprint", String(64), nullable=False),  # sha256 of the request body
+    Column("status_code", Integer, nullable=True),  # null while the request is running
+    Column("locked_until", DateTime, nullable=True),  # lease of the running request; taken over once past
+    Column("headers", Text, nullable=True),
+    Column("body", LargeBinary(length=IDEMPOTENCY_MAX_BODY_BYTES), nullable=True),
+    Column("created_at", DateTime, nullable=False),
+    Column("expires_at", DateTime, nullable=False, index=True),
+)
+
+# A finished request's stored response
+class StoredResponse:
+    __slots__ = ("fingerprint", "status_code", "headers", "body")
+
+    def __init__(self, fingerprint: str, status_code: int, headers: list, body: bytes):
+        self.fingerprint = fingerprint
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+class KeyInProgress(Exception):
+    pass
+
+# The key was first used with a different request body
+class KeyMismatch(Exception):
+    pass
+
+class IdempotencyStore:
+    def __init__(self, ttl_seconds: int = IDEMPOTENCY_TTL_SECONDS, cache_size: int = IDEMPOTENCY_CACHE_SIZE,
+                 lease_seconds: int = IDEMPOTENCY_LEASE_SECONDS):
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.lease = timedelta(seconds=lease_seconds)
+        self.responses = Cache("idempotency", cache_size, ttl_seconds)
+        self.in_flight = {}  # key -> Future resolved with the StoredResponse, or None if reserving the key failed
+        self.last_purge = time.monotonic()
+        self.replayed = 0
+        self.coalesced = 0
+        self.conflicts = 0
+        self.takeovers = 0
+        metrics.register("idempotency", self.stats)
+
+    # Returns a StoredResponse to replay, or None once the caller owns the key and must run the request
+    async def reserve(self, key: str, fingerprint: str):
+        while True:
+            found, stored = self.responses.get_local(key)
+            if found:
+                self.replayed += 1
+                return stored
+
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                stored = await asyncio.shield(future)
+                if stored is not None:
+                    return stored
+                continue  # the first attempt could not reserve the key; try again
+
+            future = self.in_flight[key] = asyncio.get_running_loop().create_future()
+            try:
+                stored = await self.reserve_row(key, fingerprint)
+            except BaseException:
+                self.release_future(key, None)
+                raise
+            if stored is not None:
+                self.remember(key, stored)
+                self.release_future(key, stored)
+                self.replayed += 1
+            return stored
+
+    async def reserve_row(self, key: str, fingerprint: str):
+        now = datetime.now()
+        async with SessionLocal() as db:
+            for _ in range(2):
+                try:
+                    await db.execute(insert(idempotency_keys).values(
+                        key=key, fingerprint=fingerprint, locked_until=now + self.lease, created_at=now,
+                        expires_at=now + self.ttl))
+                    await db.commit()
+                    return None
+                except IntegrityError:
+                    await db.rollback()
+
+                row = (await db.execute(select(idempotency_keys).where(idempotency_keys.c.key == key))).first()
+                if row is None:
+                    continue  # expired and purged in between
+                if row.expires_at < now:
+                    await db.execute(delete(idempotency_keys).where(idempotency_keys.c.key == key, idempotency_keys.c.expires_at < now))
+                    await db.commit()
+                    continue
+                if row.status_code is None:
+                    if row.fingerprint != fingerprint:
+                        raise KeyMismatch(key)
+                    if row.locked_until is None or row.locked_until >= now:
+                        self.conflicts += 1
+                        raise KeyInProgress(key)
+                    # The request's process died holding the key: the first retry past the lease runs it
+                    taken = (await db.execute(
+                        update(idempotency_keys)
+                        .where(idempotency_keys.c.key == key, idempotency_keys.c.status_code == None,
+                               idempotency_keys.c.locked_until == row.locked_until)
+                        .values(locked_until=now + self.lease)
+                    )).rowcount
+                    await db.commit()
+                    if taken:
+                        self.takeovers += 1
+                        return None
+                    continue
+                return StoredResponse(row.fingerprint, row.status_code, json.loads(row.headers), row.body)
+        self.conflicts += 1
+        raise KeyInProgress(key)
+
+    # Record the outcome of the request that owns the key
+    async def complete(self, key: str, stored: StoredResponse):
+        try:
+            async with SessionLocal() as db:
+                await db.execute(update(idempotency_keys).where(idempotency_keys.c.key == key).values(
+                    status_code=stored.status_code, headers=json.dumps(stored.headers), body=stored.body))
+                await db.commit()
+        finally:
+            self.remember(key, stored)
+            self.release_future(key, stored)
+        self.maybe_purge()
+
+    def remember(self, key: str, stored: StoredResponse):
+        if len(stored.body) <= IDEMPOTENCY_CACHE_MAX_BODY_BYTES:
+            self.responses.set_local(key, stored)
+
+    def release_future(self, key: str, stored):
+        future = self.in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(stored)
+
+    # Delete expired keys in the background every IDEMPOTENCY_PURGE_SECONDS
+    def maybe_purge(self):
+        if time.monotonic() - self.last_purge < IDEMPOTENCY_PURGE_SECONDS:
+            return
+        self.last_purge = time.monotonic()
+        asyncio.get_running_loop().create_task(self.purge_expired())
+
+    async def purge_expired(self):
+        try:
+            async with SessionLocal() as db:
+                expired = (await db.scalars(select(idempotency_keys.c.key)
+                                            .where(idempotency_keys.c.expires_at < datetime.now())
+                                            .limit(IDEMPOTENCY_PURGE_BATCH))).all()
+                if expired:
+                    await db.execute(delete(idempotency_keys).where(idempotency_keys.c.key.in_(expired)))
+                    await db.commit()
+        except Exception:
+            logger.exception("Purging expired idempotency keys failed")
+
+    def stats(self):
+        return {
+            "in_flight": len(self.in_flight),
+            "replayed": self.replayed,
+            "coalesced": self.coalesced,
+            "conflicts": self.conflicts,
+            "takeovers": self.takeovers,
+            **{f"cache_{name}": value for name, value in self.responses.stats().items()},
+        }
+
+idempotency_store = IdempotencyStore()
+
+def json_response(status_code: int, detail: str, fingerprint: str = ""):
+    body = json.dumps({"detail": detail}).encode()
+    return StoredResponse(fingerprint, status_code, [["content-type", "application/json"]], body)
+
+# Who the request acts as, lowercased like identity.py's cache keys
+def acting_identity(path: str, headers: dict, body: bytes):
+    if path in BODY_IDENTITY_PATHS:
+        try:
+            email = json.loads(body).get("current_user_email")
+        except (ValueError, AttributeError):
+            email = None
+        return f"email:{email.lower()}" if isinstance(email, str) else "email:"
+    authorization = headers.get(b"authorization", b"").decode("latin-1")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() == "bearer" and token:
+        try:
+            return f"email:{token_identity(token).lower()}"
+        except HTTPException:
+            pass  # the endpoint answers 401
+    return f"authorization:{authorization}"
+
+async def send_stored(send, stored: StoredResponse, replayed: bool):
+    headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in stored.headers]
+    headers.append((b"content-length", str(len(stored.body)).encode()))
+    if replayed:
+        headers.append((b"idempotent-replayed", b"true"))
+    await send({"type": "http.response.start", "status": stored.status_code, "headers": headers})
+    await send({"type": "http.response.body", "body": stored.body})
+
+# ASGI middleware applying the store to POSTs on IDEMPOTENT_PATHS that carry an Idempotency-Key
+class IdempotencyMiddleware:
+    def __init__(self, app, store: IdempotencyStore = None, paths=IDEMPOTENT_PATHS):
+        self.app = app
+        self.store = store or idempotency_store
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        client_key = headers.get(b"idempotency-key")
+        if not client_key:
+            return await self.app(scope, receive, send)
+
+        # Read the whole body to fingerprint it, then hand it to the app unchanged
+        messages = []
+        while True:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request" or not message.get("more_body"):
+                break
+        body = b"".join(message.get("body", b"") for message in messages)
+        fingerprint = hashlib.sha256(body).hexdigest()
+        identity = acting_identity(scope["path"], headers, body)
+        key = hashlib.sha256(b"\0".join([identity.encode(), scope["path"].encode(), client_key])).hexdigest()
+
+        try:
+            stored = await self.store.reserve(key, fingerprint)
+        except KeyInProgress:
+            return await send_stored(send, json_response(409, "A request with this Idempotency-Key is in progress"), False)
+        except KeyMismatch:
+            return await send_stored(send, json_response(422, "Idempotency-Key reused with a different request"), False)
+        if stored is not None:
+            if stored.fingerprint != fingerprint:
+                return await send_stored(send, json_response(422, "Idempotency-Key reused with a different request"), False)
+            return await send_stored(send, stored, True)
+
+        async def replay_receive():
+            if messages:
+                return messages.pop(0)
+            return await receive()
+
+        response = {"status": None, "headers": [], "body": []}
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = [[name.decode("latin-1"), value.decode("latin-1")]
+                                       for name, value in message.get("headers", []) if name.lower() not in UNSTORED_HEADERS]
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+            await send(message)
+
+        stored = None
+        try:
+            await self.app(scope, replay_receive, capture_send)
+            body = b"".join(response["body"])
+            if response["status"] is not None and len(body) <= IDEMPOTENCY_MAX_BODY_BYTES:
+                stored = StoredResponse(fingerprint, response["status"], response["headers"], body)
+        finally:
+            # The endpoint has run: the key is never given up, so a retry cannot run it twice
+            if stored is None:
+                stored = json_response(409, "A request with this Idempotency-Key was already processed; "
+                                            "its response is not available", fingerprint)
+            await self.store.complete(key, stored)
+
+if __name__ == '__main__':
+    asyncio.run(create_all(idempotency_keys))
@@ -0,0 +1,87 @@
+from fastapi import HTTPException
+from sqlalchemy import Column, Integer, MetaData, String, Table, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import NamedTuple, Optional
+import os
+
+from cache import Cache
+
+# Shared email -> user id resolution used by every endpoint instead of loading
+# the whole User row. Known emails are cached in a bounded LRU; unknown emails
+# are cached separately for a shorter time so repeated lookups of a bad address
+# do not reach the database either. registration.py invalidates an email when
+# it registers a user or changes their status.
+#
+# Emails are compared case-insensitively whatever the column's collation:
+# cache keys are lowercased, the query matches lower(email) (served by the
+# ix_users_email_lower expression index of users.py) and rows are matched back
+# to every spelling the caller asked for.
+
+IDENTITY_CACHE_SIZE = int(os.environ.get("IDENTITY_CACHE_SIZE", "200000"))
+IDENTITY_CACHE_TTL = float(os.environ.get("IDENTITY_CACHE_TTL", "600"))
+IDENTITY_NEGATIVE_CACHE_SIZE = int(os.environ.get("IDENTITY_NEGATIVE_CACHE_SIZE", "20000"))
+IDENTITY_NEGATIVE_CACHE_TTL = float(os.environ.get("IDENTITY_NEGATIVE_CACHE_TTL", "30"))
+
+# Columns of the users table the resolver reads
+users = Table(
+    "users", MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("email", String(120), unique=True),
+    Column("status", String(20)),
+)
+
+class Identity(NamedTuple):
+    id: int
+    status: str
+
+identity_cache = Cache("identity", IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL)
+unknown_email_cache = Cache("identity_unknown", IDENTITY_NEGATIVE_CACHE_SIZE, IDENTITY_NEGATIVE_CACHE_TTL)
+
+# Resolve a batch of emails with at most one IN query; unknown emails are
+# left out, the rest are keyed by the caller's spelling
+async def resolve_identities(db: AsyncSession, emails):
+    resolved = {}
+    missing = {}  # lowercased email -> the spellings asked for
+    for email in set(emails):
+        key = email.lower()
+        identity = await identity_cache.get(key)
+        if identity is not None:
+            resolved[email] = identity
+        elif await unknown_email_cache.get(key) is None:
+            missing.setdefault(key, []).append(email)
+
+    if missing:
+        generations = {key: (identity_cache.generation(key), unknown_email_cache.generation(key)) for key in missing}
+        rows = (await db.execute(
+            select(users.c.email, users.c.id, users.c.status).where(func.lower(users.c.email).in_(missing.keys()))
+        )).all()
+        found = set()
+        for row in rows:
+            key = row.email.lower()
+            if key not in missing or key in found:
+                continue
+            found.add(key)
+            identity = Identity(row.id, row.status)
+            for email in missing[key]:
+                resolved[email] = identity
+            await identity_cache.set(key, identity, generations[key][0])
+        for key in missing.keys() - found:
+            await unknown_email_cache.set(key, True, generations[key][1])
+
+    return resolved
+
+async def resolve_identity(db: AsyncSession, email: str) -> Optional[Identity]:
+    return (await resolve_identities(db, [email])).get(email)
+
+# Resolve an email to a user id, or raise 404 with the given detail
+async def resolve_user_id(db: AsyncSession, email: str, detail: str = "User not found"):
+    identity = await resolve_identity(db, email) if email else None
+    if identity is None:
+        raise HTTPException(status_code=404, detail=detail)
+    return identity.id
+
+# Drop cached entries (positive and negative) after a user is created or changes status
+async def invalidate_identity(*emails):
+    keys = [email.lower() for email in emails]
+    await identity_cache.invalidate(*keys)
+    await unknown_email_cache.invalidate(*keys)
@@ -1,21 +1,109 @@
-from fastapi import FastAPI
-from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
-
-app = FastAPI()
-
-# Mount the 'static' folder for serving static files (e.g., CSS, JavaScript)
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-# Initialize Jinja2Templates for rendering HTML templates
-templates = Jinja2Templates(directory="templates")
-
-@app.get("/", response_class=HTMLResponse)
-async def index(request: Request):
-    # Use the 'index.html' template
-    return templates.TemplateResponse("index.html", {"request": request})
-
-if __name__ == "__main__":
-    import uvicorn
-
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse
+from fastapi.templating import Jinja2Templates
+from fastapi.staticfiles import StaticFiles
+import importlib
+import metrics
+import os
+
+# Registry of feature modules, keyed by name. Each module exposes a `router`
+# and is only imported when it is enabled, so the dependencies it pulls in
+# (pyotp/jose/passlib for registration, multipart uploads for profile) are
+# not loaded by pods that do not serve it.
+MODULE_REGISTRY = {
+    "registration": "registration",
+    "profile": "profile",
+    "link_bank_accounts": "link_bank_accounts",
+    "money_transfer": "money_transfer",
+    "p2p_payments": "p2p_payments",
+    "money_request": "money_request",
+    "digital_wallet": "digital_wallet",
+    "card_services": "card_services",
+    "bill_payment_gateway": "bill_payment_gateway",
+    "investments": "investments",
+    "notifications_transactions": "notifications_transactions",
+    "statement_export": "statement_export",
+}
+
+# Comma-separated module names; ENABLED_MODULES defaults to every registered module
+def enabled_modules():
+    enabled = os.environ.get("ENABLED_MODULES")
+    names = [name.strip() for name in enabled.split(",") if name.strip()] if enabled else list(MODULE_REGISTRY)
+    disabled = {name.strip() for name in os.environ.get("DISABLED_MODULES", "").split(",") if name.strip()}
+
+    unknown = [name for name in names + list(disabled) if name not in MODULE_REGISTRY]
+    if unknown:
+        raise ValueError(f"Unknown modules: {', '.join(unknown)}")
+
+    return [name for name in names if name not in disabled]
+
+# Import an enabled module and return its router
+def load_router(name: str):
+    module = importlib.import_module(MODULE_REGISTRY[name])
+    return module.router
+
+# Initialize Jinja2Templates for rendering HTML templates
+templates = Jinja2Templates(directory="templates")
+
+async def index(request: Request):
+    # Use the 'index.html' template
+    return templates.TemplateResponse("index.html", {"request": request})
+
+# Counters of the in-process caches, pools and queues
+async def internal_metrics():
+    return metrics.snapshot()
+
+# Two modules serving the same method and path would shadow each other silently
+def check_routes(*sources):
+    seen = set()
+    for route in [route for source in sources for route in source.routes]:
+        for method in getattr(route, "methods", None) or ():
+            if (method, route.path) in seen:
+                raise ValueError(f"{method} {route.path} is served by more than one module")
+            seen.add((method, route.path))
+
+# Application factory: one app, one engine, with every enabled module mounted as a router
+def create_app(modules=None):
+    from database import dispose_engine
+    from idempotency import IdempotencyMiddleware
+    from notification_queue import notification_writer
+
+    if modules is None:
+        modules = enabled_modules()
+
+    app = FastAPI()
+    # Replays retried money-moving POSTs that carry an Idempotency-Key instead of running them again
+    app.add_middleware(IdempotencyMiddleware)
+
+    # Mount the 'static' folder for serving static files (e.g., CSS, JavaScript), when the deployment ships one
+    if os.path.isdir("static"):
+        app.mount("/static", StaticFiles(directory="static"), name="static")
+    app.add_api_route("/", index, methods=["GET"], response_class=HTMLResponse)
+    app.add_api_route("/internal/metrics", internal_metrics, methods=["GET"], response_model=dict, include_in_schema=False)
+
+    routers = [load_router(name) for name in modules]
+    check_routes(app, *routers)
+    for router in routers:
+        app.include_router(router)
+
+    # Background writers and outbound clients start with the app and stop before the engine is disposed
+    app.add_event_handler("startup", notification_writer.start)
+    app.add_event_handler("shutdown", notification_writer.stop)
+    if "bill_payment_gateway" in modules:
+        from payee_gateway import payee_gateway
+
+        app.add_event_handler("startup", payee_gateway.start)
+        app.add_event_handler("shutdown", payee_gateway.stop)
+    if "card_services" in modules:
+        from card_authorization import card_authorizer
+
+        app.add_event_handler("startup", card_authorizer.start)
+        app.add_event_handler("shutdown", card_authorizer.stop)
+    app.add_event_handler("shutdown", dispose_engine)
+    app.state.modules = list(modules)
+    return app
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run("index:create_app", factory=True, host="0.0.0.0", port=8000)
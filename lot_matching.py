@@ -0,0 +1,99 @@
+from datetime import datetime
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Lot matching for investment sales.
+#
+# A sale consumes the open lots (Investment rows with is_open set) of one
+# (user_id, symbol) holding in the order of its matching method:
+#   fifo      oldest purchase first
+#   lifo      newest purchase first
+#   specific  the lots the seller names, in the order named
+# Open lots are read through the (user_id, symbol, is_open, purchase_date, id)
+# index a page at a time and only until the sale is covered, so a sale costs
+# the lots it touches, not the size of the holding. Lots are locked FOR UPDATE
+# (concurrent sales of one holding serialize) and decremented in place; an
+# exhausted lot is closed but kept, since its realized gains point at it.
+# Everything happens in the caller's transaction: a sale and its
+# realized_gains rows commit together or not at all.
+# Existing databases get the column, the index and realized_gains from
+# migrate_investment_lots.py.
+
+SELL_METHODS = ("fifo", "lifo", "specific")
+LOT_PAGE_SIZE = 64
+
+# Quantities are floats; a remainder below this closes the lot
+LOT_QUANTITY_EPSILON = 1e-9
+
+class InsufficientHoldings(Exception):
+    def __init__(self, available: float):
+        super().__init__(f"only {available} available to sell")
+        self.available = available
+
+# Open lots of a holding in matching order, locked
+async def open_lots(db: AsyncSession, user_id: int, symbol: str, method: str, lot_ids: list = None,
+                    page_size: int = LOT_PAGE_SIZE):
+    from investments import Investment
+
+    holding = (Investment.user_id == user_id, Investment.symbol == symbol, Investment.is_open == True)
+    if method == "specific":
+        lots = (await db.scalars(select(Investment).where(*holding, Investment.id.in_(lot_ids)).with_for_update())).all()
+        by_id = {lot.id: lot for lot in lots}
+        for lot_id in dict.fromkeys(lot_ids):
+            if lot_id in by_id:
+                yield by_id[lot_id]
+        return
+
+    position = tuple_(Investment.purchase_date, Investment.id)
+    if method == "lifo":
+        order = (Investment.purchase_date.desc(), Investment.id.desc())
+    else:
+        order = (Investment.purchase_date, Investment.id)
+    after = None
+    while True:
+        query = select(Investment).where(*holding).order_by(*order).limit(page_size).with_for_update()
+        if after is not None:
+            query = query.where(position < tuple_(*after) if method == "lifo" else position > tuple_(*after))
+        page = (await db.scalars(query)).all()
+        for lot in page:
+            yield lot
+        if len(page) < page_size:
+            return
+        after = (page[-1].purchase_date, page[-1].id)
+
+# Sell `quantity` of a holding at `price`: decrement the matched lots and add
+# one RealizedGain per lot touched. Raises InsufficientHoldings when the
+# matched lots do not cover the sale; the caller commits or rolls back.
+async def sell_lots(db: AsyncSession, user_id: int, symbol: str, quantity: float, price: float,
+                    method: str = "fifo", lot_ids: list = None, when: datetime = None):
+    from investments import RealizedGain
+
+    if method not in SELL_METHODS:
+        raise ValueError(f"Unknown sell method {method!r}")
+    when = when or datetime.now()
+    remaining = quantity
+    gains = []
+    lots = open_lots(db, user_id, symbol, method, lot_ids)
+    try:
+        async for lot in lots:
+            take = min(lot.quantity, remaining)
+            lot.quantity -= take
+            if lot.quantity <= LOT_QUANTITY_EPSILON:
+                lot.quantity = 0
+                lot.is_open = False
+            remaining -= take
+            gains.append(RealizedGain(
+                user_id=user_id, investment_id=lot.id, symbol=symbol, method=method, quantity=take,
+                purchase_price=lot.purchase_price, selling_price=price,
+                gain=take * (price - lot.purchase_price), purchase_date=lot.purchase_date, sale_date=when,
+            ))
+            if remaining <= LOT_QUANTITY_EPSILON:
+                break
+    finally:
+        await lots.aclose()
+
+    if remaining > LOT_QUANTITY_EPSILON:
+        raise InsufficientHoldings(quantity - remaining)
+    db.add_all(gains)
+    return gains
@@ -0,0 +1,9 @@
+# Registry of in-process counters (caches, pools, queues) exposed by index.py
+# at GET /internal/metrics. Each source is a callable returning a dict.
+sources = {}
+
+def register(name: str, source):
+    sources[name] = source
+
+def snapshot():
+    return {name: source() for name, source in sources.items()}
@@ -0,0 +1,84 @@
+# One-off migration of the investments table to the lot model of
+# lot_matching.py.
+#
+# Before lot matching, investments had no is_open column, no holdings index
+# and no realized_gains table. Run this once, with the API stopped, before
+# starting the lot matching code:
+#   1. add investments.is_open (BOOLEAN NOT NULL DEFAULT TRUE)
+#   2. close the lots that are already empty (quantity at or below
+#      LOT_QUANTITY_EPSILON), a chunk of ids per transaction
+#   3. create the (user_id, symbol, is_open, purchase_date, id) index that
+#      sales and the nightly valuation read through
+#   4. create realized_gains
+# Every step skips work that is already done, so an interrupted run is rerun
+# as is.
+#
+#   python migrate_investment_lots.py
+import argparse
+import asyncio
+import logging
+
+from sqlalchemy import inspect, select, text, update
+
+from database import SessionLocal, dispose_engine, engine
+from investments import Investment, RealizedGain
+from lot_matching import LOT_QUANTITY_EPSILON
+
+MIGRATION_CHUNK_SIZE = 5000
+HOLDINGS_INDEX = "ix_investments_holding_lots"
+
+logger = logging.getLogger(__name__)
+
+async def inspected(method: str, table: str):
+    async with engine.connect() as conn:
+        return await conn.run_sync(lambda sync: getattr(inspect(sync), method)(table))
+
+async def add_is_open():
+    if "is_open" in {column["name"] for column in await inspected("get_columns", "investments")}:
+        logger.info("investments.is_open already exists")
+        return
+    async with engine.begin() as conn:
+        await conn.execute(text("ALTER TABLE investments ADD COLUMN is_open BOOLEAN NOT NULL DEFAULT TRUE"))
+
+async def close_empty_lots(chunk_size: int):
+    closed = 0
+    while True:
+        async with SessionLocal() as db:
+            lot_ids = (await db.scalars(
+                select(Investment.id)
+                .where(Investment.is_open == True, Investment.quantity <= LOT_QUANTITY_EPSILON)
+                .order_by(Investment.id).limit(chunk_size)
+            )).all()
+            if not lot_ids:
+                break
+            await db.execute(update(Investment).where(Investment.id.in_(lot_ids)).values(is_open=False))
+            await db.commit()
+        closed += len(lot_ids)
+    logger.info("Closed %s empty lots", closed)
+
+async def create_holdings_index():
+    if HOLDINGS_INDEX in {index["name"] for index in await inspected("get_indexes", "investments")}:
+        logger.info("%s already exists", HOLDINGS_INDEX)
+        return
+    index = next(index for index in Investment.__table__.indexes if index.name == HOLDINGS_INDEX)
+    async with engine.begin() as conn:
+        await conn.run_sync(index.create)
+
+async def create_realized_gains():
+    async with engine.begin() as conn:
+        await conn.run_sync(RealizedGain.__table__.create, checkfirst=True)
+
+async def main(args):
+    try:
+        await add_is_open()
+        await close_empty_lots(args.chunk_size)
+        await create_holdings_index()
+        await create_realized_gains()
+    finally:
+        await dispose_engine()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate investments to open lots for lot matching")
+    parser.add_argument("--chunk-size", type=int, default=MIGRATION_CHUNK_SIZE)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,120 @@
+# One-off migration of balances and transfers to the integer minor units of
+# transfer_engine.py.
+#
+# Before the engine, users.balance and transactions.amount were floats in
+# major units, transactions had no batch_id and there was no ledger_entries
+# table. Run this once, with the API stopped, before starting the engine code:
+#   1. add users.balance_minor and fill it a chunk of ids per transaction with
+#      the balance in minor units (a missing balance becomes 0), then swap it in
+#      as balance (BIGINT NOT NULL DEFAULT 0; SQLite keeps it nullable)
+#   2. the same for transactions.amount (BIGINT NOT NULL)
+#   3. add transactions.batch_id and its index, which transfer_batch reads
+#      each chunk's rows back by
+#   4. create ledger_entries; transfers from before the migration keep no
+#      postings, only the ones the engine writes from then on
+# Every step skips work that is already done, so an interrupted run is rerun
+# as is.
+#
+#   python migrate_transfer_ledger.py
+import argparse
+import asyncio
+import logging
+
+from sqlalchemy import BigInteger, Column, Float, Integer, MetaData, Table, bindparam, inspect, select, text, update
+
+from database import SessionLocal, dispose_engine, engine
+from money import to_minor
+from transfer_engine import ledger_entries, transactions
+
+MIGRATION_CHUNK_SIZE = 5000
+
+logger = logging.getLogger(__name__)
+
+# A pre-engine float column next to the minor-unit column it is converted into
+def old_table(table: str, column: str):
+    return Table(
+        table, MetaData(),
+        Column("id", Integer, primary_key=True),
+        Column(column, Float),
+        Column(f"{column}_minor", BigInteger),
+    )
+
+async def inspected(method: str, table: str):
+    async with engine.connect() as conn:
+        return await conn.run_sync(lambda sync: getattr(inspect(sync), method)(table))
+
+async def columns(table: str):
+    return {column["name"]: column["type"] for column in await inspected("get_columns", table)}
+
+async def convert_column(table: str, column: str, chunk_size: int, default: int = None):
+    found = await columns(table)
+    minor = f"{column}_minor"
+    if minor not in found:
+        if isinstance(found[column], Integer):
+            logger.info("%s.%s is already in minor units", table, column)
+            return
+        async with engine.begin() as conn:
+            await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {minor} BIGINT"))
+
+    # Converted in Python with money.to_minor, so 0.285 becomes 29 like a new request would
+    t = old_table(table, column)
+    converted = 0
+    while column in found:
+        async with SessionLocal() as db:
+            rows = (await db.execute(
+                select(t.c.id, t.c[column]).where(t.c[minor] == None).order_by(t.c.id).limit(chunk_size)
+            )).all()
+            if not rows:
+                break
+            await db.execute(update(t).where(t.c.id == bindparam("row_id")).values({minor: bindparam("minor")}), [
+                {"row_id": row.id, "minor": to_minor(row[1] or 0)} for row in rows
+            ])
+            await db.commit()
+        converted += len(rows)
+    logger.info("Converted %s %s.%s values to minor units", converted, table, column)
+
+    # DDL is not transactional on MySQL: a rerun may find the float column already dropped
+    statements = [f"ALTER TABLE {table} DROP COLUMN {column}"] if column in found else []
+    statements.append(f"ALTER TABLE {table} RENAME COLUMN {minor} TO {column}")
+    server_default = "" if default is None else f" DEFAULT {default}"
+    if engine.dialect.name == "mysql":
+        statements.append(f"ALTER TABLE {table} MODIFY {column} BIGINT NOT NULL{server_default}")
+    elif engine.dialect.name == "postgresql":
+        statements.append(f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL")
+        if default is not None:
+            statements.append(f"ALTER TABLE {table} ALTER COLUMN {column} SET{server_default}")
+    async with engine.begin() as conn:
+        for statement in statements:
+            await conn.execute(text(statement))
+
+async def add_batch_id():
+    if "batch_id" in await columns("transactions"):
+        logger.info("transactions.batch_id already exists")
+    else:
+        async with engine.begin() as conn:
+            await conn.execute(text("ALTER TABLE transactions ADD COLUMN batch_id VARCHAR(32)"))
+    index = next(index for index in transactions.indexes if list(index.columns.keys()) == ["batch_id"])
+    if index.name in {found["name"] for found in await inspected("get_indexes", "transactions")}:
+        logger.info("%s already exists", index.name)
+        return
+    async with engine.begin() as conn:
+        await conn.run_sync(index.create)
+
+async def create_ledger_entries():
+    async with engine.begin() as conn:
+        await conn.run_sync(ledger_entries.create, checkfirst=True)
+
+async def main(args):
+    try:
+        await convert_column("users", "balance", args.chunk_size, default=0)
+        await convert_column("transactions", "amount", args.chunk_size)
+        await add_batch_id()
+        await create_ledger_entries()
+    finally:
+        await dispose_engine()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate float balances and transfers to minor units")
+    parser.add_argument("--chunk-size", type=int, default=MIGRATION_CHUNK_SIZE)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parser.parse_args()))
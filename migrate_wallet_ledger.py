@@ -0,0 +1,163 @@
+# One-off migration of existing wallets to the append-only ledger of
+# digital_wallet.py.
+#
+# Before the ledger, users.wallet_balance held each balance as a float and
+# wallet_transactions.amount was a float, positive for withdrawals too. Run
+# this once, with the API stopped, before starting the ledger code:
+#   1. add wallet_transactions.amount_minor and fill it a chunk of ids per
+#      transaction with the amount in signed minor units (withdrawals negative)
+#   2. swap it in as amount (BIGINT NOT NULL; SQLite keeps it nullable)
+#   3. give every user with a wallet_balance an 'opening_balance' entry for the
+#      difference between that balance and their migrated ledger sum, plus a
+#      snapshot at their last entry, so balances carry over to the cent
+#   4. with --drop-balance-column, drop users.wallet_balance
+# Every step skips work that is already done, so an interrupted run is rerun
+# as is. wallet_reconciliation.py verifies the new snapshots afterwards.
+#
+#   python migrate_wallet_ledger.py
+#   python migrate_wallet_ledger.py --drop-balance-column
+import argparse
+import asyncio
+import logging
+from datetime import datetime
+
+from sqlalchemy import BigInteger, Column, Float, Integer, MetaData, String, Table, bindparam, func, inspect, select, text, update
+
+from database import SessionLocal, dispose_engine, engine
+from digital_wallet import WalletBalanceSnapshot, WalletTransaction
+from money import to_minor
+
+MIGRATION_CHUNK_SIZE = 5000
+
+logger = logging.getLogger(__name__)
+
+# The pre-ledger columns
+old_users = Table(
+    "users", MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("wallet_balance", Float),
+)
+old_wallet_transactions = Table(
+    "wallet_transactions", MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("amount", Float),
+    Column("amount_minor", BigInteger),
+    Column("transaction_type", String(20)),
+)
+
+async def columns(table: str):
+    async with engine.connect() as conn:
+        return {column["name"]: column["type"] for column in await conn.run_sync(lambda sync: inspect(sync).get_columns(table))}
+
+async def convert_amounts(chunk_size: int):
+    found = await columns("wallet_transactions")
+    if "amount_minor" not in found:
+        if isinstance(found["amount"], Integer):
+            logger.info("wallet_transactions.amount is already in minor units")
+            return
+        async with engine.begin() as conn:
+            await conn.execute(text("ALTER TABLE wallet_transactions ADD COLUMN amount_minor BIGINT"))
+
+    # Converted in Python with money.to_minor, so 0.285 becomes 29 like a new request would
+    t = old_wallet_transactions
+    converted = 0
+    while "amount" in found:
+        async with SessionLocal() as db:
+            rows = (await db.execute(
+                select(t.c.id, t.c.amount, t.c.transaction_type)
+                .where(t.c.amount_minor == None).order_by(t.c.id).limit(chunk_size)
+            )).all()
+            if not rows:
+                break
+            await db.execute(update(t).where(t.c.id == bindparam("entry_id")).values(amount_minor=bindparam("minor")), [
+                {"entry_id": row.id,
+                 "minor": -to_minor(row.amount) if row.transaction_type == "withdrawal" else to_minor(row.amount)}
+                for row in rows
+            ])
+            await db.commit()
+        converted += len(rows)
+    logger.info("Converted %s wallet entries to signed minor units", converted)
+
+    # DDL is not transactional on MySQL: a rerun may find amount already dropped
+    statements = ["ALTER TABLE wallet_transactions DROP COLUMN amount"] if "amount" in found else []
+    statements.append("ALTER TABLE wallet_transactions RENAME COLUMN amount_minor TO amount")
+    if engine.dialect.name == "mysql":
+        statements.append("ALTER TABLE wallet_transactions MODIFY amount BIGINT NOT NULL")
+    elif engine.dialect.name == "postgresql":
+        statements.append("ALTER TABLE wallet_transactions ALTER COLUMN amount SET NOT NULL")
+    async with engine.begin() as conn:
+        for statement in statements:
+            await conn.execute(text(statement))
+
+# Opening entries and snapshots for the users after `after_user_id`, a chunk of them
+async def open_chunk(after_user_id: int, chunk_size: int):
+    entries = WalletTransaction.__table__
+    snapshots = WalletBalanceSnapshot.__table__
+    async with SessionLocal() as db:
+        users = (await db.execute(
+            select(old_users.c.id, old_users.c.wallet_balance)
+            .where(old_users.c.id > after_user_id).order_by(old_users.c.id).limit(chunk_size)
+        )).all()
+        if not users:
+            return None, 0
+        user_ids = [user.id for user in users]
+        migrated = set((await db.scalars(
+            select(snapshots.c.user_id).distinct().where(snapshots.c.user_id.in_(user_ids))
+        )).all())
+        ledgers = {row.user_id: (row.total, row.last_entry_id) for row in (await db.execute(
+            select(entries.c.user_id, func.sum(entries.c.amount).label("total"), func.max(entries.c.id).label("last_entry_id"))
+            .where(entries.c.user_id.in_(user_ids)).group_by(entries.c.user_id)
+        )).all()}
+
+        now = datetime.now()
+        opened = 0
+        for user in users:
+            if user.id in migrated:
+                continue
+            balance = to_minor(user.wallet_balance or 0)
+            total, last_entry_id = ledgers.get(user.id, (0, None))
+            if balance != total:
+                last_entry_id = (await db.execute(entries.insert().values(
+                    user_id=user.id, amount=balance - total, transaction_type="opening_balance", date=now
+                ))).inserted_primary_key[0]
+            if last_entry_id is None:
+                continue  # no wallet history and nothing to carry over
+            await db.execute(snapshots.insert().values(
+                user_id=user.id, last_entry_id=last_entry_id, balance=balance, date=now, status="pending"))
+            opened += 1
+        await db.commit()
+        return users[-1].id, opened
+
+async def open_balances(chunk_size: int):
+    if "wallet_balance" not in await columns("users"):
+        logger.info("users.wallet_balance is already dropped")
+        return
+    after_user_id = 0
+    opened = 0
+    while True:
+        after_user_id, count = await open_chunk(after_user_id, chunk_size)
+        if after_user_id is None:
+            break
+        opened += count
+    logger.info("Carried over %s wallet balances", opened)
+
+async def drop_balance_column():
+    if "wallet_balance" in await columns("users"):
+        async with engine.begin() as conn:
+            await conn.execute(text("ALTER TABLE users DROP COLUMN wallet_balance"))
+
+async def main(args):
+    try:
+        await convert_amounts(args.chunk_size)
+        await open_balances(args.chunk_size)
+        if args.drop_balance_column:
+            await drop_balance_column()
+    finally:
+        await dispose_engine()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate float wallet balances to the minor-unit ledger")
+    parser.add_argument("--chunk-size", type=int, default=MIGRATION_CHUNK_SIZE)
+    parser.add_argument("--drop-balance-column", action="store_true", help="drop users.wallet_balance when done")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parser.parse_args()))
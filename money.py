@@ -0,0 +1,13 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+# Balances and amounts are stored as integer minor units (cents) so that
+# concurrent debits and credits are exact and can be applied in SQL
+MINOR_UNITS = 100
+
+# Convert a client-supplied decimal amount to minor units
+def to_minor(amount) -> int:
+    return int((Decimal(str(amount)) * MINOR_UNITS).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+# Convert minor units back to a decimal amount for responses
+def from_minor(amount: int) -> float:
+    return float(Decimal(amount) / MINOR_UNITS)
@@ -0,0 +1,101 @@
+# Nightly portfolio valuation.
+#
+# Values every portfolio in the system and stores one portfolio_valuations
+# row per user and asset class for the day. Users are processed in chunks of
+# consecutive user ids: a chunk's lots are loaded as columns with one query
+# (the holdings index), priced with one batched quote lookup and
+# valued with portfolio_valuation.value_lots. Each chunk replaces its own rows
+# for the day and commits, so a rerun (or a run resumed with --after) never
+# double counts.
+#
+# Prices are the quote service's current quotes, so a run can only value
+# holdings as they stand now: --as-of names the day the snapshot is stored
+# under and must not be in the past. Missed days are not backfilled.
+# bench_valuation.py measures a run on synthetic lots.
+#
+#   python nightly_valuation.py                      # value everything as of today
+#   python nightly_valuation.py --after 48000        # resume a run that stopped
+import argparse
+import asyncio
+import logging
+import time
+from datetime import date
+
+from sqlalchemy import delete, insert, select
+
+from database import SessionLocal, dispose_engine
+from investments import Investment
+from portfolio_valuation import portfolio_valuations, lot_columns, value_lots
+from quote_service import quote_service
+
+VALUATION_USERS_PER_CHUNK = 2000
+
+logger = logging.getLogger(__name__)
+
+# Value the users after `after_user_id`, a chunk of them; returns (last user id, lots valued)
+async def value_chunk(as_of: date, after_user_id: int, users_per_chunk: int):
+    async with SessionLocal() as db:
+        user_ids = (await db.scalars(
+            select(Investment.user_id).distinct()
+            .where(Investment.user_id > after_user_id)
+            .order_by(Investment.user_id)
+            .limit(users_per_chunk)
+        )).all()
+        if not user_ids:
+            return None, 0
+        first, last = user_ids[0], user_ids[-1]
+
+        rows = (await db.execute(
+            select(Investment.id, Investment.user_id, Investment.investment_type, Investment.symbol,
+                   Investment.quantity, Investment.purchase_price)
+            .where(Investment.user_id.between(first, last), Investment.is_open == True)
+        )).all()
+        symbols = {}
+        for row in rows:
+            symbols.setdefault(row.symbol, row.investment_type)
+        prices = {symbol: quote.price for symbol, quote in (await quote_service.get_quotes(symbols)).items()}
+
+        _, _, allocation = value_lots(lot_columns(rows), prices, with_lots=False)
+
+        await db.execute(delete(portfolio_valuations).where(
+            portfolio_valuations.c.as_of == as_of, portfolio_valuations.c.user_id.between(first, last)
+        ))
+        if allocation:
+            await db.execute(insert(portfolio_valuations), [
+                {"as_of": as_of, "user_id": totals["user_id"], "investment_type": totals["investment_type"],
+                 "market_value": totals["market_value"], "cost_basis": totals["cost_basis"],
+                 "unrealized_pnl": totals["unrealized_pnl"]}
+                for totals in allocation
+            ])
+        await db.commit()
+        return last, len(rows)
+
+async def value_all(as_of: date, after_user_id: int = 0, users_per_chunk: int = VALUATION_USERS_PER_CHUNK):
+    started = time.monotonic()
+    lots = 0
+    while True:
+        last, count = await value_chunk(as_of, after_user_id, users_per_chunk)
+        if last is None:
+            break
+        after_user_id = last
+        lots += count
+        logger.info("Valued users up to %s (%s lots so far)", last, lots)
+    logger.info("Valued %s lots as of %s in %.1fs", lots, as_of, time.monotonic() - started)
+    return lots
+
+async def main(args):
+    try:
+        await value_all(args.as_of, args.after, args.users_per_chunk)
+    finally:
+        await dispose_engine()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Value every portfolio and store the day's snapshot")
+    parser.add_argument("--as-of", type=date.fromisoformat, default=date.today())
+    parser.add_argument("--after", type=int, default=0, help="resume after this user id")
+    parser.add_argument("--users-per-chunk", type=int, default=VALUATION_USERS_PER_CHUNK)
+    args = parser.parse_args()
+    if args.as_of < date.today():
+        parser.error("--as-of cannot be in the past: holdings are valued at current quotes")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(args))
@@ -0,0 +1,116 @@
+# Retention job for the notifications table.
+#
+# Notifications older than NOTIFICATION_RETENTION_DAYS are copied to a gzip
+# JSONL archive file and then deleted in small chunks, each its own short
+# transaction, with a pause in between so the hot table is never locked for
+# long. Unread counters are decremented in the same transaction as the delete,
+# by the rows each user's `is_read = false` delete actually removed, so a
+# mark-read racing the chunk is never subtracted twice. A row is always archived before it is deleted, so
+# a crash can at worst archive a chunk twice, never lose it.
+#
+#   python notification_compaction.py                   # archive and delete old rows
+#   python notification_compaction.py --rebuild-counters
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, delete, func, select, update
+
+from database import SessionLocal, dispose_engine
+from notifications_transactions import Notification, NotificationCounter
+
+NOTIFICATION_RETENTION_DAYS = int(os.environ.get("NOTIFICATION_RETENTION_DAYS", "180"))
+NOTIFICATION_ARCHIVE_DIR = os.environ.get("NOTIFICATION_ARCHIVE_DIR", "archive")
+COMPACTION_CHUNK_SIZE = 1000
+COMPACTION_PAUSE_SECONDS = 0.05
+
+logger = logging.getLogger(__name__)
+
+# Archive and delete one chunk of expired notifications; returns how many were removed
+async def compact_chunk(archive, cutoff: datetime, chunk_size: int):
+    async with SessionLocal() as db:
+        # Ids grow with time, so walking the primary key finds the oldest rows first
+        rows = (await db.scalars(
+            select(Notification).where(Notification.date < cutoff).order_by(Notification.id).limit(chunk_size)
+        )).all()
+        if not rows:
+            return 0
+
+        for row in rows:
+            archive.write(json.dumps({"id": row.id, "user_id": row.user_id, "message": row.message,
+                                      "date": row.date.isoformat(), "is_read": row.is_read}) + "\n")
+        archive.flush()
+
+        # Unread rows are deleted per user with `is_read = false`, and the counter
+        # drops by what that removed: a row marked read since the select was
+        # already counted down by mark_notifications_read
+        unread_ids = defaultdict(list)
+        for row in rows:
+            if not row.is_read:
+                unread_ids[row.user_id].append(row.id)
+        for user_id, ids in unread_ids.items():
+            count = (await db.execute(
+                delete(Notification).where(Notification.id.in_(ids), Notification.is_read == False)
+            )).rowcount
+            if count:
+                await db.execute(
+                    update(NotificationCounter)
+                    .where(NotificationCounter.user_id == user_id)
+                    .values(unread=case((NotificationCounter.unread > count, NotificationCounter.unread - count), else_=0))
+                )
+        await db.execute(delete(Notification).where(Notification.id.in_([row.id for row in rows])))
+        await db.commit()
+        return len(rows)
+
+async def compact(retention_days: int = NOTIFICATION_RETENTION_DAYS, chunk_size: int = COMPACTION_CHUNK_SIZE):
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    os.makedirs(NOTIFICATION_ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(NOTIFICATION_ARCHIVE_DIR, f"notifications-{datetime.now():%Y%m%d%H%M%S}.jsonl.gz")
+
+    removed = 0
+    with gzip.open(path, "at", encoding="utf-8") as archive:
+        while True:
+            count = await compact_chunk(archive, cutoff, chunk_size)
+            if not count:
+                break
+            removed += count
+            await asyncio.sleep(COMPACTION_PAUSE_SECONDS)
+
+    if not removed:
+        os.remove(path)
+    logger.info("Archived %s notifications older than %s to %s", removed, cutoff, path)
+    return removed
+
+# Recompute every unread counter from the table (initial backfill or repair;
+# run it while the notification writer is paused)
+async def rebuild_counters():
+    async with SessionLocal() as db:
+        counts = (await db.execute(
+            select(Notification.user_id, func.count()).where(Notification.is_read == False).group_by(Notification.user_id)
+        )).all()
+        await db.execute(delete(NotificationCounter))
+        if counts:
+            await db.execute(NotificationCounter.__table__.insert(), [{"user_id": user_id, "unread": count} for user_id, count in counts])
+        await db.commit()
+
+async def main(args):
+    try:
+        if args.rebuild_counters:
+            await rebuild_counters()
+        else:
+            await compact(args.retention_days, args.chunk_size)
+    finally:
+        await dispose_engine()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive and delete old notifications")
+    parser.add_argument("--retention-days", type=int, default=NOTIFICATION_RETENTION_DAYS)
+    parser.add_argument("--chunk-size", type=int, default=COMPACTION_CHUNK_SIZE)
+    parser.add_argument("--rebuild-counters", action="store_true", help="recompute unread counters instead")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,57 @@
+import asyncio
+
+import metrics
+
+# In-process fan-out of new notifications to connected Server-Sent Events
+# clients. The notification writer publishes each notification once it is
+# committed, with its notifications.id as the event id, so ids are the same
+# in every worker and in GET /notifications?since_id=. A client that
+# reconnects with Last-Event-ID is replayed from the table
+# (notifications_transactions.py), not from this process's memory.
+
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+class Subscription:
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+class NotificationHub:
+    def __init__(self):
+        self.subscriptions = {}  # user_id -> set of Subscription
+        self.published = 0
+        self.dropped_subscribers = 0
+
+    # Deliver a stored notification to the user's connected clients
+    def publish(self, user_id: int, event_id: int, event: dict):
+        self.published += 1
+        for subscription in self.subscriptions.get(user_id, ()):
+            try:
+                subscription.queue.put_nowait((event_id, event))
+            except asyncio.QueueFull:
+                # A client this far behind is told to resync instead of holding memory
+                subscription.overflowed = True
+                self.dropped_subscribers += 1
+
+    def subscribe(self, user_id: int):
+        subscription = Subscription(user_id)
+        self.subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self.subscriptions.get(subscription.user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.user_id]
+
+    def stats(self):
+        return {
+            "published": self.published,
+            "subscribers": sum(len(subscriptions) for subscriptions in self.subscriptions.values()),
+            "dropped_subscribers": self.dropped_subscribers,
+        }
+
+notification_hub = NotificationHub()
+metrics.register("notification_hub", notification_hub.stats)
@@ -0,0 +1,58 @@
+from sqlalchemy import insert, select
+from collections import Counter
+import os
+import uuid
+
+from batch_writer import BatchWriter, parse_timestamp, timestamp
+from database import SessionLocal, upsert_add
+from notification_hub import notification_hub
+
+# Notifications are written behind the request: send_notification() only
+# spools and enqueues, and the background writer inserts them in batches and
+# pushes each one to connected clients once it is stored, under its id.
+NOTIFICATION_BATCH_SIZE = int(os.environ.get("NOTIFICATION_BATCH_SIZE", "500"))
+NOTIFICATION_FLUSH_MS = int(os.environ.get("NOTIFICATION_FLUSH_MS", "50"))
+NOTIFICATION_MAX_PENDING = int(os.environ.get("NOTIFICATION_MAX_PENDING", "100000"))
+# Base name: each worker process spools to <path>.<pid>
+NOTIFICATION_SPOOL_PATH = os.environ.get("NOTIFICATION_SPOOL_PATH", "notifications.spool")
+NOTIFICATION_SPOOL_FSYNC = os.environ.get("NOTIFICATION_SPOOL_FSYNC", "false").lower() == "true"
+
+# Multi-row insert of one batch of notifications, bumping the unread counters
+# in the same transaction, then publish the stored rows
+async def write_notifications(items):
+    from notifications_transactions import Notification, NotificationCounter
+
+    batch_id = uuid.uuid4().hex
+    async with SessionLocal() as db:
+        await db.execute(insert(Notification), [
+            {"user_id": item["user_id"], "message": item["message"], "date": parse_timestamp(item["date"]),
+             "is_read": False, "batch_id": batch_id}
+            for item in items
+        ])
+        unread = Counter(item["user_id"] for item in items)
+        await upsert_add(db, NotificationCounter, [{"user_id": user_id, "unread": count} for user_id, count in unread.items()],
+                         ["user_id"], ["unread"])
+        # Read back by batch id for the ids (no INSERT ... RETURNING on MySQL)
+        stored = (await db.execute(
+            select(Notification.id, Notification.user_id, Notification.message, Notification.date)
+            .where(Notification.batch_id == batch_id)
+            .order_by(Notification.id)
+        )).all()
+        await db.commit()
+
+    for row in stored:
+        notification_hub.publish(row.user_id, row.id, {"id": row.id, "message": row.message, "date": timestamp(row.date)})
+
+notification_writer = BatchWriter(
+    "notifications",
+    write_notifications,
+    max_batch=NOTIFICATION_BATCH_SIZE,
+    max_delay_ms=NOTIFICATION_FLUSH_MS,
+    max_pending=NOTIFICATION_MAX_PENDING,
+    spool_path=NOTIFICATION_SPOOL_PATH,
+    fsync=NOTIFICATION_SPOOL_FSYNC,
+)
+
+# Function to send a notification: persisted in the background, then pushed to connected clients
+async def send_notification(user_id: int, message: str):
+    await notification_writer.put({"user_id": user_id, "message": message, "date": timestamp()})
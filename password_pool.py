@@ -0,0 +1,87 @@
+from fastapi import HTTPException
+from concurrent.futures import ThreadPoolExecutor
+from passlib.context import CryptContext
+import asyncio
+import os
+import time
+
+import metrics
+
+# bcrypt hashing and verification off the event loop.
+#
+# Jobs run on a dedicated, fixed-size thread pool (the bcrypt backend releases
+# the GIL while hashing, so threads run in parallel). At most
+# PASSWORD_POOL_MAX_QUEUE jobs may wait behind the running ones; beyond that
+# requests are rejected at once with 503 instead of queueing, so a login storm
+# cannot starve the other endpoints served by the same process.
+
+PASSWORD_POOL_WORKERS = int(os.environ.get("PASSWORD_POOL_WORKERS", str(os.cpu_count() or 2)))
+PASSWORD_POOL_MAX_QUEUE = int(os.environ.get("PASSWORD_POOL_MAX_QUEUE", "64"))
+
+# Password hashing and verification
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+executor = ThreadPoolExecutor(max_workers=PASSWORD_POOL_WORKERS, thread_name_prefix="password")
+
+class PoolStats:
+    def __init__(self):
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.hash_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def release(self):
+        self.pending -= 1
+
+    def snapshot(self):
+        completed = max(self.completed, 1)
+        return {
+            "workers": PASSWORD_POOL_WORKERS,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": self.wait_seconds / completed * 1000,
+            "max_wait_ms": self.max_wait_seconds * 1000,
+            "avg_hash_ms": self.hash_seconds / completed * 1000,
+        }
+
+stats = PoolStats()
+metrics.register("password_pool", stats.snapshot)
+
+# Run a blocking password function on the pool, or fail fast with 503 when saturated
+async def run_in_pool(function, *args):
+    if stats.pending >= PASSWORD_POOL_WORKERS + PASSWORD_POOL_MAX_QUEUE:
+        stats.rejected += 1
+        raise HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": "1"})
+
+    def job():
+        started = time.perf_counter()
+        result = function(*args)
+        return result, started, time.perf_counter()
+
+    # The slot is freed when the job itself is done, not when the awaiting
+    # request goes away: a cancelled request leaves its bcrypt call running
+    loop = asyncio.get_running_loop()
+
+    def release(_):
+        loop.call_soon_threadsafe(stats.release)
+
+    stats.pending += 1
+    enqueued = time.perf_counter()
+    future = executor.submit(job)
+    future.add_done_callback(release)
+    result, started, finished = await asyncio.wrap_future(future)
+
+    stats.completed += 1
+    stats.wait_seconds += started - enqueued
+    stats.max_wait_seconds = max(stats.max_wait_seconds, started - enqueued)
+    stats.hash_seconds += finished - started
+    return result
+
+async def hash_password(password: str):
+    return await run_in_pool(pwd_context.hash, password)
+
+async def verify_password(password: str, hashed_password: str):
+    return await run_in_pool(pwd_context.verify, password, hashed_password)
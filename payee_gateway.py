@@ -0,0 +1,249 @@
+from collections import OrderedDict
+from urllib.parse import quote
+import asyncio
+import itertools
+import logging
+import os
+import random
+import re
+import time
+
+import metrics
+
+# Outbound client for paying bills at utility companies and other payees.
+#
+# One pooled httpx.AsyncClient per process keeps connections to the payee
+# gateway alive across payments, so hundreds of payments can be in flight
+# over a bounded number of sockets. Each payee gets its own in-flight limit
+# and circuit breaker, so one slow or failing payee cannot use up the pool or
+# the retries of the others. Retryable failures (connection errors, timeouts,
+# 429 and 5xx) are retried with full-jitter exponential backoff; every attempt
+# of a payment carries the same Idempotency-Key, so a retry after a lost
+# response is never paid twice. httpx is imported on start so pods that do
+# not pay bills never load it.
+#
+# Payees are validated before anything is sent: against PAYEE_ALLOWLIST when
+# it is set, otherwise against PAYEE_PATTERN, and the id is escaped into the
+# URL either way. Per-payee state is kept for at most PAYEE_MAX_TRACKED
+# payees; the least recently used ones with nothing in flight and a closed
+# circuit are dropped beyond that.
+
+PAYEE_GATEWAY_URL = os.environ.get("PAYEE_GATEWAY_URL", "http://localhost:8100")
+PAYEE_GATEWAY_MAX_CONNECTIONS = int(os.environ.get("PAYEE_GATEWAY_MAX_CONNECTIONS", "100"))
+PAYEE_GATEWAY_TIMEOUT = float(os.environ.get("PAYEE_GATEWAY_TIMEOUT", "10"))
+PAYEE_MAX_IN_FLIGHT = int(os.environ.get("PAYEE_MAX_IN_FLIGHT", "50"))
+PAYEE_MAX_TRACKED = int(os.environ.get("PAYEE_MAX_TRACKED", "10000"))
+PAYEE_PATTERN = re.compile(os.environ.get("PAYEE_PATTERN", r"[A-Za-z0-9][A-Za-z0-9_.-]{0,119}"))
+PAYEE_ALLOWLIST = {payee.strip() for payee in os.environ.get("PAYEE_ALLOWLIST", "").split(",") if payee.strip()}
+PAYEE_GATEWAY_RETRIES = 3
+PAYEE_RETRY_BASE_SECONDS = 0.2
+PAYEE_RETRY_MAX_SECONDS = 5.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 30.0
+
+logger = logging.getLogger(__name__)
+
+class PayeeGatewayError(Exception):
+    pass
+
+# The payee refused the payment; retrying will not help
+class PayeeRejected(PayeeGatewayError):
+    pass
+
+# The outcome is unknown (retries exhausted or circuit open); retry later with the same key
+class PayeeUnavailable(PayeeGatewayError):
+    pass
+
+# Opens after `threshold` consecutive failures and fails calls fast for
+# `reset_seconds`; then lets one trial call through (half-open) and closes
+# again on its success
+class CircuitBreaker:
+    def __init__(self, threshold: int = BREAKER_FAILURE_THRESHOLD, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.failures >= self.threshold or self.opened_at is not None:
+            self.opened_at = time.monotonic()
+
+    # A trial that ended without recording an outcome (cancelled, or an
+    # unexpected error) must not keep the circuit from ever trying again
+    def end_trial(self):
+        self.trial_running = False
+
+# Whether `payee` is a payee id this deployment pays
+def known_payee(payee) -> bool:
+    if not isinstance(payee, str):
+        return False
+    if PAYEE_ALLOWLIST:
+        return payee in PAYEE_ALLOWLIST
+    return PAYEE_PATTERN.fullmatch(payee) is not None
+
+# One payee's in-flight limit and circuit breaker
+class PayeeState:
+    __slots__ = ("limit", "breaker", "active")
+
+    def __init__(self, max_in_flight: int):
+        self.limit = asyncio.Semaphore(max_in_flight)
+        self.breaker = CircuitBreaker()
+        self.active = 0
+
+class PayeeGatewayClient:
+    def __init__(self, base_url: str, max_connections: int = PAYEE_GATEWAY_MAX_CONNECTIONS,
+                 max_in_flight: int = PAYEE_MAX_IN_FLIGHT, timeout: float = PAYEE_GATEWAY_TIMEOUT,
+                 retries: int = PAYEE_GATEWAY_RETRIES, transport=None, name: str = "payee_gateway",
+                 max_payees: int = PAYEE_MAX_TRACKED):
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.max_payees = max_payees
+        self.timeout = timeout
+        self.retries = retries
+        self.transport = transport  # e.g. httpx.ASGITransport(app=fake_payee.app) for tests
+        self.client = None
+        self.payees = OrderedDict()  # payee -> PayeeState, least recently used first
+        self.in_flight = 0
+        self.paid = 0
+        self.rejected = 0
+        self.retried = 0
+        self.unavailable = 0
+        self.short_circuited = 0
+        metrics.register(name, self.stats)
+
+    async def start(self):
+        import httpx
+
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            transport=self.transport,
+        )
+
+    async def stop(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def payee_state(self, payee: str):
+        state = self.payees.get(payee)
+        if state is None:
+            state = self.payees[payee] = PayeeState(self.max_in_flight)
+            self.evict()
+        else:
+            self.payees.move_to_end(payee)
+        return state
+
+    # Drop the least recently used payees beyond max_payees, unless a payment
+    # to them is in flight or their circuit is not closed
+    def evict(self):
+        excess = len(self.payees) - self.max_payees
+        if excess <= 0:
+            return
+        for payee, state in list(itertools.islice(self.payees.items(), excess)):
+            if not state.active and state.breaker.state == "closed":
+                del self.payees[payee]
+
+    # Full jitter: anywhere between 0 and the capped exponential delay
+    def backoff(self, attempt: int):
+        return random.uniform(0, min(PAYEE_RETRY_MAX_SECONDS, PAYEE_RETRY_BASE_SECONDS * 2 ** attempt))
+
+    # Pay `amount` to `payee`; returns the payee's confirmation
+    async def pay(self, payee: str, amount: float, idempotency_key: str, account: str = None):
+        if self.client is None:
+            raise RuntimeError("payee gateway client is not started")
+        if not known_payee(payee):
+            self.rejected += 1
+            raise PayeeRejected(f"Unknown payee {payee!r}")
+        payee_state = self.payee_state(payee)
+        breaker = payee_state.breaker
+        path = f"/payees/{quote(payee, safe='')}/payments"
+        payload = {"amount": amount, "reference": idempotency_key, "account": account}
+
+        payee_state.active += 1
+        try:
+            async with payee_state.limit:
+                return await self.send(payee, path, payload, idempotency_key, breaker)
+        finally:
+            payee_state.active -= 1
+
+    # Post one payment, retrying retryable failures while the payee's circuit allows
+    async def send(self, payee: str, path: str, payload: dict, idempotency_key: str, breaker: CircuitBreaker):
+        import httpx
+
+        for attempt in range(self.retries + 1):
+            if not breaker.allow():
+                self.short_circuited += 1
+                raise PayeeUnavailable(f"Circuit open for payee {payee}")
+
+            trial = breaker.trial_running  # allow() made this call the half-open trial
+            self.in_flight += 1
+            try:
+                response = await self.client.post(path, json=payload, headers={"Idempotency-Key": idempotency_key})
+            except httpx.TransportError as error:
+                failure = error
+            else:
+                if response.status_code < 400:
+                    breaker.record_success()
+                    self.paid += 1
+                    return response.json()
+                if response.status_code != 429 and response.status_code < 500:
+                    # The payee answered: its circuit is healthy even though the payment was refused
+                    breaker.record_success()
+                    self.rejected += 1
+                    raise PayeeRejected(f"Payee {payee} rejected the payment: {response.status_code} {response.text[:200]}")
+                failure = f"HTTP {response.status_code}"
+            finally:
+                self.in_flight -= 1
+                if trial:
+                    breaker.end_trial()
+
+            breaker.record_failure()
+            if attempt < self.retries:
+                self.retried += 1
+                logger.warning("Payment %s to %s failed (%s); retrying", idempotency_key, payee, failure)
+                await asyncio.sleep(self.backoff(attempt))
+
+        self.unavailable += 1
+        raise PayeeUnavailable(f"Payee {payee} unavailable: {failure}")
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "paid": self.paid,
+            "rejected": self.rejected,
+            "retried": self.retried,
+            "unavailable": self.unavailable,
+            "short_circuited": self.short_circuited,
+            "tracked_payees": len(self.payees),
+            "open_circuits": sum(state.breaker.state != "closed" for state in self.payees.values()),
+        }
+
+payee_gateway = PayeeGatewayClient(PAYEE_GATEWAY_URL)
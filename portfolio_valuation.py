@@ -0,0 +1,174 @@
+from collections import defaultdict
+from sqlalchemy import Column, Date, Float, Integer, MetaData, String, Table
+import asyncio
+
+from database import create_all
+
+try:
+    import numpy
+except ImportError:  # optional: lots are then valued with a plain loop
+    numpy = None
+
+# Portfolio valuation.
+#
+# Holdings are valued as columns: one array per Investment field with one
+# element per lot, so market value, cost basis and unrealized P&L are a few
+# vectorized passes, and the per-position and per-asset-class totals are
+# bincount group sums. This is what lets the nightly run (nightly_valuation.py)
+# value millions of lots a chunk of users at a time; bench_valuation.py
+# measures both.
+#
+# Every Investment row is an open lot carrying its own purchase price. Cost
+# basis is reported two ways:
+#   fifo     each lot at its own purchase price
+#   average  each lot at the position's quantity-weighted average price
+# The position totals agree; the methods differ in per-lot basis and P&L.
+# Lots without a market price are carried at cost (zero P&L) and flagged.
+
+COST_BASIS_METHODS = ("fifo", "average")
+
+metadata = MetaData()
+
+# Nightly snapshot: one row per user, day and asset class
+portfolio_valuations = Table(
+    "portfolio_valuations", metadata,
+    Column("as_of", Date, primary_key=True),
+    Column("user_id", Integer, primary_key=True),
+    Column("investment_type", String(50), primary_key=True),
+    Column("market_value", Float, nullable=False),
+    Column("cost_basis", Float, nullable=False),
+    Column("unrealized_pnl", Float, nullable=False),
+)
+
+# Lot rows (id, user_id, investment_type, symbol, quantity, purchase_price) as columns
+def lot_columns(rows):
+    ids, user_ids, types, symbols, quantities, prices = zip(*rows) if rows else ((),) * 6
+    if numpy is None:
+        return {"id": list(ids), "user_id": list(user_ids), "investment_type": list(types), "symbol": list(symbols),
+                "quantity": list(quantities), "purchase_price": list(prices)}
+    return {
+        "id": numpy.array(ids, dtype=numpy.int64),
+        "user_id": numpy.array(user_ids, dtype=numpy.int64),
+        "investment_type": numpy.array(types, dtype=str),
+        "symbol": numpy.array(symbols, dtype=str),
+        "quantity": numpy.array(quantities, dtype=numpy.float64),
+        "purchase_price": numpy.array(prices, dtype=numpy.float64),
+    }
+
+# Value lot columns at `prices` ({symbol: price}). Returns
+# (lots, positions, allocation): per-lot values in input order (only with
+# with_lots), per (user, symbol) positions, and per (user, investment_type)
+# totals with their share of the user's market value.
+def value_lots(columns: dict, prices: dict, method: str = "fifo", with_lots: bool = True):
+    if method not in COST_BASIS_METHODS:
+        raise ValueError(f"Unknown cost basis method {method!r}")
+    if not len(columns["id"]):
+        return [], [], []
+    if numpy is None:
+        return value_lots_loop(columns, prices, method, with_lots)
+
+    quantity = columns["quantity"]
+    symbols, symbol_index = numpy.unique(columns["symbol"], return_inverse=True)
+    users, user_index = numpy.unique(columns["user_id"], return_inverse=True)
+    types, type_index = numpy.unique(columns["investment_type"], return_inverse=True)
+
+    symbol_prices = numpy.array([prices.get(symbol, numpy.nan) for symbol in symbols], dtype=numpy.float64)
+    market_price = symbol_prices[symbol_index]
+    priced = ~numpy.isnan(market_price)
+    lot_cost = quantity * columns["purchase_price"]
+    market_value = numpy.where(priced, quantity * market_price, lot_cost)
+
+    # Positions: group lots by (user, symbol)
+    position_key = user_index * len(symbols) + symbol_index
+    keys, position_index = numpy.unique(position_key, return_inverse=True)
+    position_quantity = numpy.bincount(position_index, weights=quantity)
+    position_cost = numpy.bincount(position_index, weights=lot_cost)
+    position_value = numpy.bincount(position_index, weights=market_value)
+    position_unpriced = numpy.bincount(position_index, weights=~priced)
+    average_cost = numpy.divide(position_cost, position_quantity, out=numpy.zeros_like(position_cost),
+                                where=position_quantity != 0)
+    # A position's asset class is that of its first lot
+    first_lot = numpy.zeros(len(keys), dtype=numpy.int64)
+    first_lot[position_index[::-1]] = numpy.arange(len(position_index))[::-1]
+
+    lots = []
+    if with_lots:
+        basis = lot_cost if method == "fifo" else quantity * average_cost[position_index]
+        lots = [
+            {"id": lot_id, "cost_basis": cost, "market_price": price if is_priced else None,
+             "market_value": value, "unrealized_pnl": value - cost}
+            for lot_id, cost, price, is_priced, value
+            in zip(columns["id"].tolist(), basis.tolist(), market_price.tolist(), priced.tolist(), market_value.tolist())
+        ]
+
+    # Plain Python values for the output rows
+    key_users = users[keys // len(symbols)].tolist()
+    key_symbols = symbols[keys % len(symbols)].tolist()
+    key_types = columns["investment_type"][first_lot].tolist()
+    positions = [
+        {"user_id": user_id, "symbol": symbol, "investment_type": investment_type, "quantity": held,
+         "average_cost": average, "cost_basis": cost, "market_value": value, "unrealized_pnl": value - cost,
+         "priced": not unpriced}
+        for user_id, symbol, investment_type, held, average, cost, value, unpriced
+        in zip(key_users, key_symbols, key_types, position_quantity.tolist(), average_cost.tolist(),
+               position_cost.tolist(), position_value.tolist(), position_unpriced.tolist())
+    ]
+
+    # Allocation: group lots by (user, investment_type)
+    class_key = user_index * len(types) + type_index
+    keys, class_index = numpy.unique(class_key, return_inverse=True)
+    class_value = numpy.bincount(class_index, weights=market_value)
+    class_cost = numpy.bincount(class_index, weights=lot_cost)
+    user_value = numpy.bincount(user_index, weights=market_value)[keys // len(types)]
+    weight = numpy.divide(class_value, user_value, out=numpy.zeros_like(class_value), where=user_value != 0)
+    allocation = [
+        {"user_id": user_id, "investment_type": investment_type, "market_value": value, "cost_basis": cost,
+         "unrealized_pnl": value - cost, "weight": share}
+        for user_id, investment_type, value, cost, share
+        in zip(users[keys // len(types)].tolist(), types[keys % len(types)].tolist(), class_value.tolist(),
+               class_cost.tolist(), weight.tolist())
+    ]
+    return lots, positions, allocation
+
+def value_lots_loop(columns: dict, prices: dict, method: str, with_lots: bool):
+    rows = list(zip(columns["id"], columns["user_id"], columns["investment_type"], columns["symbol"],
+                    columns["quantity"], columns["purchase_price"]))
+    positions = {}
+    for _, user_id, investment_type, symbol, quantity, purchase_price in rows:
+        price = prices.get(symbol)
+        position = positions.setdefault((user_id, symbol), {
+            "user_id": user_id, "symbol": symbol, "investment_type": investment_type, "quantity": 0.0,
+            "average_cost": 0.0, "cost_basis": 0.0, "market_value": 0.0, "unrealized_pnl": 0.0, "priced": True})
+        position["quantity"] += quantity
+        position["cost_basis"] += quantity * purchase_price
+        position["market_value"] += quantity * (price if price is not None else purchase_price)
+        position["priced"] = position["priced"] and price is not None
+    for position in positions.values():
+        position["unrealized_pnl"] = position["market_value"] - position["cost_basis"]
+        if position["quantity"]:
+            position["average_cost"] = position["cost_basis"] / position["quantity"]
+
+    lots = []
+    classes = defaultdict(lambda: [0.0, 0.0])
+    user_values = defaultdict(float)
+    for lot_id, user_id, investment_type, symbol, quantity, purchase_price in rows:
+        price = prices.get(symbol)
+        value = quantity * (price if price is not None else purchase_price)
+        if with_lots:
+            basis = quantity * (purchase_price if method == "fifo" else positions[(user_id, symbol)]["average_cost"])
+            lots.append({"id": lot_id, "cost_basis": basis, "market_price": price, "market_value": value,
+                         "unrealized_pnl": value - basis})
+        totals = classes[(user_id, investment_type)]
+        totals[0] += value
+        totals[1] += quantity * purchase_price
+        user_values[user_id] += value
+
+    allocation = [
+        {"user_id": user_id, "investment_type": investment_type, "market_value": value, "cost_basis": cost,
+         "unrealized_pnl": value - cost, "weight": value / user_values[user_id] if user_values[user_id] else 0.0}
+        for (user_id, investment_type), (value, cost) in sorted(classes.items())
+    ]
+    return lots, sorted(positions.values(), key=lambda position: (position["user_id"], position["symbol"])), allocation
+
+if __name__ == '__main__':
+    asyncio.run(create_all(portfolio_valuations))
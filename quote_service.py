@@ -0,0 +1,221 @@
+import asyncio
+import csv
+import json
+import os
+import random
+import time
+
+import metrics
+
+# Market prices for investments.
+#
+# get_quotes() answers from a per-symbol cache whose TTL depends on the asset
+# class (crypto moves faster than mutual funds). Misses are not fetched one
+# by one: every symbol missed within QUOTE_BATCH_WINDOW_MS, by any number of
+# concurrent requests, goes to the feed in one batched call, and a symbol
+# already being fetched is awaited rather than requested again (single
+# flight). A portfolio page therefore costs at most one feed call.
+#
+# The feed is pluggable (QuoteFeed). QUOTE_FEED selects a built-in one:
+#   QUOTE_FEED=file:quotes.csv   symbol,price rows (or a JSON object), reread when the file changes
+#   QUOTE_FEED=fake              deterministic random-walk prices, for tests and benchmarks only
+# There is no default: without QUOTE_FEED, and whenever the feed fails,
+# lookups raise QuotesUnavailable and the endpoints answer 503 rather than
+# trade or value at made-up prices.
+
+QUOTE_FEED = os.environ.get("QUOTE_FEED", "")
+QUOTE_BATCH_WINDOW_MS = float(os.environ.get("QUOTE_BATCH_WINDOW_MS", "5"))
+QUOTE_MAX_BATCH = int(os.environ.get("QUOTE_MAX_BATCH", "500"))
+QUOTE_CACHE_SIZE = int(os.environ.get("QUOTE_CACHE_SIZE", "100000"))
+
+# Seconds a price stays fresh, by investment_type
+QUOTE_TTLS = {
+    "crypto": 5,
+    "stock": 15,
+    "etf": 15,
+    "bond": 300,
+    "mutual_fund": 3600,
+}
+QUOTE_DEFAULT_TTL = 60
+
+class Quote:
+    __slots__ = ("symbol", "price", "as_of")
+
+    def __init__(self, symbol: str, price: float, as_of: float):
+        self.symbol = symbol
+        self.price = price
+        self.as_of = as_of  # epoch seconds
+
+# No price could be fetched: the feed is not configured or failed
+class QuotesUnavailable(Exception):
+    pass
+
+# Market data source interface; fetch returns {symbol: price} for the symbols it knows
+class QuoteFeed:
+    async def fetch(self, symbols: list):
+        raise NotImplementedError
+
+class FileQuoteFeed(QuoteFeed):
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = None
+        self.prices = {}
+
+    def load(self):
+        mtime = os.path.getmtime(self.path)
+        if mtime == self.mtime:
+            return
+        with open(self.path, newline="", encoding="utf-8") as source:
+            if self.path.endswith(".json"):
+                prices = {symbol: float(price) for symbol, price in json.load(source).items()}
+            else:
+                prices = {row["symbol"]: float(row["price"]) for row in csv.DictReader(source)}
+        self.prices, self.mtime = prices, mtime
+
+    async def fetch(self, symbols: list):
+        self.load()
+        return {symbol: self.prices[symbol] for symbol in symbols if symbol in self.prices}
+
+class FakeQuoteFeed(QuoteFeed):
+    def __init__(self, latency_ms: float = 0, volatility: float = 0.001):
+        self.latency = latency_ms / 1000
+        self.volatility = volatility
+        self.prices = {}
+
+    async def fetch(self, symbols: list):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for symbol in symbols:
+            price = self.prices.get(symbol)
+            if price is None:
+                # Same starting price for a symbol in every process
+                price = random.Random(symbol).uniform(5, 500)
+            self.prices[symbol] = round(price * (1 + random.gauss(0, self.volatility)), 4)
+        return {symbol: self.prices[symbol] for symbol in symbols}
+
+# Stands in when QUOTE_FEED is unset, so every lookup fails closed
+class UnconfiguredQuoteFeed(QuoteFeed):
+    async def fetch(self, symbols: list):
+        raise QuotesUnavailable("QUOTE_FEED is not configured")
+
+def configured_feed(setting: str = QUOTE_FEED):
+    if not setting:
+        return UnconfiguredQuoteFeed()
+    if setting.startswith("file:"):
+        return FileQuoteFeed(setting[len("file:"):])
+    if setting == "fake":
+        return FakeQuoteFeed()
+    raise ValueError(f"Unknown QUOTE_FEED {setting!r}")
+
+class QuoteService:
+    def __init__(self, feed: QuoteFeed, batch_window_ms: float = QUOTE_BATCH_WINDOW_MS,
+                 max_batch: int = QUOTE_MAX_BATCH, max_symbols: int = QUOTE_CACHE_SIZE):
+        self.feed = feed
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch = max_batch
+        self.max_symbols = max_symbols
+        self.quotes = {}  # symbol -> (Quote, expires at)
+        self.pending = {}  # symbol -> Future of the fetch it is part of
+        self.queued = []  # symbols waiting for the next batch
+        self.flush_handle = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.fetches = 0
+        self.fetched_symbols = 0
+        metrics.register("quotes", self.stats)
+
+    # Quotes for {symbol: investment_type}; symbols the feed does not know are
+    # left out. Raises QuotesUnavailable when the feed cannot be reached.
+    async def get_quotes(self, symbols: dict):
+        now = time.time()
+        quotes = {}
+        waiting = {}
+        for symbol in symbols:
+            cached = self.quotes.get(symbol)
+            if cached is not None and cached[1] > now:
+                self.hits += 1
+                quotes[symbol] = cached[0]
+                continue
+            self.misses += 1
+            future = self.pending.get(symbol)
+            if future is not None:
+                self.coalesced += 1
+            else:
+                future = self.pending[symbol] = asyncio.get_running_loop().create_future()
+                self.queued.append(symbol)
+            waiting[symbol] = future
+
+        if waiting:
+            self.schedule_flush()
+            results = await asyncio.gather(*(asyncio.shield(future) for future in waiting.values()), return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            for symbol, quote in zip(waiting, results):
+                if quote is not None:
+                    ttl = QUOTE_TTLS.get(symbols[symbol], QUOTE_DEFAULT_TTL)
+                    self.store(quote, ttl)
+                    quotes[symbol] = quote
+        return quotes
+
+    async def get_quote(self, symbol: str, investment_type: str = None):
+        return (await self.get_quotes({symbol: investment_type})).get(symbol)
+
+    def store(self, quote: Quote, ttl: float):
+        expires = quote.as_of + ttl
+        cached = self.quotes.get(quote.symbol)
+        if cached is not None and cached[1] >= expires:
+            return
+        if cached is None and len(self.quotes) >= self.max_symbols:
+            # Drop expired entries, or an arbitrary one if none has expired
+            now = time.time()
+            expired = [symbol for symbol, (_, until) in self.quotes.items() if until <= now]
+            for symbol in expired or [next(iter(self.quotes))]:
+                del self.quotes[symbol]
+        self.quotes[quote.symbol] = (quote, expires)
+
+    def schedule_flush(self):
+        if len(self.queued) >= self.max_batch:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self.flush)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        while self.queued:
+            batch, self.queued = self.queued[:self.max_batch], self.queued[self.max_batch:]
+            asyncio.get_running_loop().create_task(self.fetch(batch))
+
+    async def fetch(self, symbols: list):
+        self.fetches += 1
+        self.fetched_symbols += len(symbols)
+        try:
+            prices = await self.feed.fetch(symbols)
+        except Exception as error:
+            if not isinstance(error, QuotesUnavailable):
+                unavailable = QuotesUnavailable(f"Quote feed failed: {error!r}")
+                unavailable.__cause__ = error
+                error = unavailable
+            for symbol in symbols:
+                future = self.pending.pop(symbol)
+                future.set_exception(error)
+            return
+        now = time.time()
+        for symbol in symbols:
+            price = prices.get(symbol)
+            self.pending.pop(symbol).set_result(Quote(symbol, price, now) if price is not None else None)
+
+    def stats(self):
+        return {
+            "symbols": len(self.quotes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "fetches": self.fetches,
+            "avg_batch": self.fetched_symbols / self.fetches if self.fetches else 0,
+        }
+
+quote_service = QuoteService(configured_feed())
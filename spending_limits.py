@@ -0,0 +1,123 @@
+from sqlalchemy import BigInteger, Column, Date, Integer, MetaData, String, Table, and_, case, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import date, datetime
+import asyncio
+import os
+
+from database import create_all
+
+# Daily and monthly spending limits.
+#
+# Every user has one spending_counters row per (scope, period) holding the
+# start of the current period and the amount spent in it, so a check is a
+# primary-key update no matter how large the transaction tables grow. A
+# period rolls over lazily: the first spend of a new period resets the counter
+# in the same conditional UPDATE that adds to it. The counters are updated in
+# the transaction of the write they limit, so a rolled-back write never
+# counts.
+
+def configured_limit(name: str, default: int):
+    return int(os.environ.get(name, str(default)))
+
+# (scope, period) -> limit in minor units
+SPENDING_LIMITS = {
+    ("card", "day"): configured_limit("CARD_DAILY_LIMIT", 500_000),
+    ("card", "month"): configured_limit("CARD_MONTHLY_LIMIT", 5_000_000),
+    ("wallet_withdrawal", "day"): configured_limit("WALLET_WITHDRAWAL_DAILY_LIMIT", 1_000_000),
+    ("wallet_withdrawal", "month"): configured_limit("WALLET_WITHDRAWAL_MONTHLY_LIMIT", 10_000_000),
+}
+
+metadata = MetaData()
+
+spending_counters = Table(
+    "spending_counters", metadata,
+    Column("user_id", Integer, primary_key=True),
+    Column("scope", String(20), primary_key=True),
+    Column("period", String(5), primary_key=True),  # 'day' or 'month'
+    Column("period_start", Date, nullable=False),
+    Column("total", BigInteger, nullable=False, default=0),
+)
+
+class SpendingLimitExceeded(Exception):
+    def __init__(self, scope: str, period: str):
+        super().__init__(f"{scope} {period} limit exceeded")
+        self.scope = scope
+        self.period = period
+
+def period_start(period: str, day: date):
+    return day.replace(day=1) if period == "month" else day
+
+def scope_periods(scope: str):
+    return [period for limit_scope, period in SPENDING_LIMITS if limit_scope == scope]
+
+# Add `amount` to one counter, resetting it first if its period is over.
+# With enforce, the update only happens if the result stays within the limit;
+# returns whether it was applied.
+async def add_to_counter(db: AsyncSession, user_id: int, scope: str, period: str, amount: int, day: date, enforce: bool = True):
+    start = period_start(period, day)
+    counter = spending_counters.c
+    current = case((counter.period_start == start, counter.total), else_=0)
+    key = and_(counter.user_id == user_id, counter.scope == scope, counter.period == period)
+
+    # total first: MySQL evaluates SET assignments left to right against the updated row
+    statement = update(spending_counters).ordered_values((counter.total, current + amount), (counter.period_start, start))
+    if enforce:
+        statement = statement.where(key, current + amount <= SPENDING_LIMITS[(scope, period)])
+    else:
+        statement = statement.where(key)
+    if (await db.execute(statement)).rowcount:
+        return True
+
+    exists = await db.scalar(select(counter.user_id).where(key))
+    if exists is not None:
+        return False
+    if enforce and amount > SPENDING_LIMITS[(scope, period)]:
+        return False
+    try:
+        async with db.begin_nested():
+            await db.execute(insert(spending_counters).values(user_id=user_id, scope=scope, period=period,
+                                                              period_start=start, total=amount))
+        return True
+    except IntegrityError:
+        # Created concurrently: apply to the row that now exists
+        return await add_to_counter(db, user_id, scope, period, amount, day, enforce)
+
+# Count a spend against every limit of its scope, or raise SpendingLimitExceeded.
+# Call it in the transaction of the write; the caller rolls back on the exception.
+async def consume(db: AsyncSession, user_id: int, scope: str, amount: int, when: datetime = None, enforce: bool = True):
+    day = (when or datetime.now()).date()
+    for period in scope_periods(scope):
+        if not await add_to_counter(db, user_id, scope, period, amount, day, enforce):
+            raise SpendingLimitExceeded(scope, period)
+
+# Current spend per period of a scope, for in-memory checks: {period: [period_start, total]}
+async def current_spend(db: AsyncSession, user_id: int, scope: str):
+    counter = spending_counters.c
+    rows = (await db.execute(
+        select(counter.period, counter.period_start, counter.total).where(counter.user_id == user_id, counter.scope == scope)
+    )).all()
+    return {period: [start, total] for period, start, total in rows}
+
+# In-memory counterpart of consume() on a current_spend() dict; returns the
+# period whose limit `amount` would exceed, or None after counting it
+def spend_in_memory(spent: dict, scope: str, amount: int, day: date = None):
+    day = day or date.today()
+    periods = scope_periods(scope)
+    for period in periods:
+        start, total = spent.get(period) or (None, 0)
+        if start != period_start(period, day):
+            total = 0
+        if total + amount > SPENDING_LIMITS[(scope, period)]:
+            return period
+    for period in periods:
+        start = period_start(period, day)
+        entry = spent.get(period)
+        if entry is None or entry[0] != start:
+            spent[period] = [start, amount]
+        else:
+            entry[1] += amount
+    return None
+
+if __name__ == '__main__':
+    asyncio.run(create_all(spending_counters))
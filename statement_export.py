@@ -0,0 +1,269 @@
+# Full account statements across transfers, wallet entries and card
+# transactions, as one stream ordered by time.
+#
+# Each source is read through its own session with a server-side cursor
+# (yield_per), and the sources are merged lazily with a k-way heap merge, so
+# only one fetch batch per source and one output chunk are held in memory no
+# matter how long the history is. CSV is written in chunks, optionally
+# gzip-compressed on the fly; Parquet (requires pyarrow) is written one row
+# group at a time.
+#
+#   python statement_export.py user@example.com --output statement.csv.gz --gzip
+#   python statement_export.py user@example.com --format parquet --output statement.parquet
+from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Optional
+import argparse
+import asyncio
+import csv
+import heapq
+import io
+import zlib
+from auth import get_jwt_identity
+from card_services import CardTransaction
+from database import SessionLocal, dispose_engine, get_db
+from digital_wallet import WalletTransaction
+from identity import resolve_user_id
+from money import MINOR_UNITS
+from money_transfer import Transaction, users
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # optional: only needed for format=parquet
+    pyarrow = None
+
+router = APIRouter()
+
+# Rows fetched per server-side cursor batch, and rows per CSV chunk / Parquet row group
+STATEMENT_FETCH_SIZE = 1000
+STATEMENT_CHUNK_ROWS = 10000
+
+STATEMENT_COLUMNS = ["date", "source", "id", "type", "amount", "counterparty", "status"]
+STATEMENT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+CENTS = Decimal("0.01")
+
+def minor_amount(amount: int):
+    return (Decimal(amount) / MINOR_UNITS).quantize(CENTS)
+
+def in_range(query, column, start: Optional[date], end: Optional[date]):
+    if start is not None:
+        query = query.where(column >= datetime.combine(start, datetime.min.time()))
+    if end is not None:
+        query = query.where(column < datetime.combine(end + timedelta(days=1), datetime.min.time()))
+    return query
+
+# One query per source, each ordered by (date, id) and normalized to statement rows
+def statement_sources(user_id: int, start: Optional[date], end: Optional[date]):
+    sent = (select(Transaction.id, Transaction.date, Transaction.amount, Transaction.status, users.c.email)
+            .join(users, users.c.id == Transaction.receiver_id)
+            .where(Transaction.sender_id == user_id)
+            .order_by(Transaction.date, Transaction.id))
+    received = (select(Transaction.id, Transaction.date, Transaction.amount, Transaction.status, users.c.email)
+                .join(users, users.c.id == Transaction.sender_id)
+                .where(Transaction.receiver_id == user_id)
+                .order_by(Transaction.date, Transaction.id))
+    wallet = (select(WalletTransaction.id, WalletTransaction.date, WalletTransaction.amount, WalletTransaction.transaction_type)
+              .where(WalletTransaction.user_id == user_id)
+              .order_by(WalletTransaction.date, WalletTransaction.id))
+    card = (select(CardTransaction.id, CardTransaction.date, CardTransaction.amount, CardTransaction.transaction_type)
+            .where(CardTransaction.user_id == user_id)
+            .order_by(CardTransaction.date, CardTransaction.id))
+
+    return [
+        (in_range(sent, Transaction.date, start, end),
+         lambda row: (row.date, "transfer", row.id, "transfer_out", -minor_amount(row.amount), row.email, row.status)),
+        (in_range(received, Transaction.date, start, end),
+         lambda row: (row.date, "transfer", row.id, "transfer_in", minor_amount(row.amount), row.email, row.status)),
+        (in_range(wallet, WalletTransaction.date, start, end),
+         lambda row: (row.date, "wallet", row.id, row.transaction_type, minor_amount(row.amount), None, "completed")),
+        # Card amounts are stored as positive decimal spends
+        (in_range(card, CardTransaction.date, start, end),
+         lambda row: (row.date, "card", row.id, row.transaction_type, -Decimal(str(row.amount)).quantize(CENTS), None, "completed")),
+    ]
+
+# Stream one source from its own session, so every source keeps its own open cursor
+async def source_rows(query, to_row):
+    async with SessionLocal() as db:
+        result = await db.stream(query.execution_options(yield_per=STATEMENT_FETCH_SIZE))
+        async for row in result:
+            yield to_row(row)
+
+# Lazy k-way merge of async iterators that are each sorted by key (heapq.merge for async streams)
+async def merge_streams(streams, key):
+    try:
+        heap = []
+        for index, stream in enumerate(streams):
+            async for row in stream:
+                heap.append((key(row), index, row))
+                break
+        heapq.heapify(heap)
+
+        while heap:
+            _, index, row = heap[0]
+            yield row
+            async for following in streams[index]:
+                heapq.heapreplace(heap, (key(following), index, following))
+                break
+            else:
+                heapq.heappop(heap)
+    finally:
+        # Close every source's cursor and session, also when the client goes away mid-export
+        for stream in streams:
+            await stream.aclose()
+
+def statement_rows(user_id: int, start: Optional[date] = None, end: Optional[date] = None):
+    streams = [source_rows(query, to_row) for query, to_row in statement_sources(user_id, start, end)]
+    return merge_streams(streams, key=lambda row: (row[0], row[1], row[2]))
+
+async def csv_chunks(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(STATEMENT_COLUMNS)
+    count = 0
+    async for row in rows:
+        writer.writerow((row[0].isoformat(), *row[1:]))
+        count += 1
+        if count % STATEMENT_CHUNK_ROWS == 0:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue().encode()
+
+async def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+# Write-only file object handing the Parquet writer's output back in pieces;
+# tell() keeps counting so the footer offsets stay right after each drain
+class ChunkSink:
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def parquet_schema():
+    return pyarrow.schema([
+        ("date", pyarrow.timestamp("us")),
+        ("source", pyarrow.string()),
+        ("id", pyarrow.int64()),
+        ("type", pyarrow.string()),
+        ("amount", pyarrow.decimal128(20, 2)),
+        ("counterparty", pyarrow.string()),
+        ("status", pyarrow.string()),
+    ])
+
+async def parquet_chunks(rows, compression: str = "snappy"):
+    schema = parquet_schema()
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression=compression)
+
+    def write_group(group):
+        columns = list(zip(*group)) if group else [[] for _ in STATEMENT_COLUMNS]
+        writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type)
+                                                     for column, field in zip(columns, schema)], schema=schema))
+
+    group = []
+    async for row in rows:
+        group.append(row)
+        if len(group) == STATEMENT_CHUNK_ROWS:
+            write_group(group)
+            group = []
+            yield sink.drain()
+    if group:
+        write_group(group)
+    writer.close()
+    yield sink.drain()
+
+# Encoded statement as an async iterator of byte chunks
+def export_statement(user_id: int, format: str = "csv", compress: bool = False,
+                     start: Optional[date] = None, end: Optional[date] = None):
+    rows = statement_rows(user_id, start, end)
+    if format == "parquet":
+        # Parquet compresses its column chunks itself
+        return parquet_chunks(rows, "gzip" if compress else "snappy")
+    chunks = csv_chunks(rows)
+    return gzip_chunks(chunks) if compress else chunks
+
+# API Endpoint to Export a Full Statement (CSV or Parquet, optionally gzip-compressed CSV)
+@router.get("/statements/export")
+async def export_statement_endpoint(
+    format: str = "csv",
+    gzip: bool = False,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    current_user_email: str = Depends(get_jwt_identity),
+    db: AsyncSession = Depends(get_db)
+):
+    if format not in STATEMENT_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be csv or parquet")
+    if format == "parquet" and pyarrow is None:
+        raise HTTPException(status_code=501, detail="Parquet export is not available")
+    user_id = await resolve_user_id(db, current_user_email)
+    # Release the pooled connection; each source opens its own for the stream
+    await db.close()
+
+    media_type, extension = STATEMENT_FORMATS[format]
+    headers = {"Content-Disposition": f'attachment; filename="statement.{extension}"'}
+    if gzip and format == "csv":
+        media_type = "application/gzip"
+        headers["Content-Disposition"] = f'attachment; filename="statement.{extension}.gz"'
+
+    return StreamingResponse(export_statement(user_id, format, gzip, start, end), media_type=media_type, headers=headers)
+
+async def main(args):
+    try:
+        async with SessionLocal() as db:
+            user_id = await resolve_user_id(db, args.email)
+        with open(args.output, "wb") as target:
+            async for chunk in export_statement(user_id, args.format, args.gzip, args.start, args.end):
+                target.write(chunk)
+    finally:
+        await dispose_engine()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a user's full statement")
+    parser.add_argument("email")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--format", choices=sorted(STATEMENT_FORMATS), default="csv")
+    parser.add_argument("--gzip", action="store_true", help="gzip CSV output (Parquet uses gzip column compression)")
+    parser.add_argument("--start", type=date.fromisoformat)
+    parser.add_argument("--end", type=date.fromisoformat)
+    args = parser.parse_args()
+    if args.format == "parquet" and pyarrow is None:
+        parser.error("Parquet export requires pyarrow")
+    asyncio.run(main(args))
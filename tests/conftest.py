@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# The modules build their engine at import: point them at a scratch SQLite
+# database before any test imports them
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/test.db")
+os.environ.setdefault("NOTIFICATION_SPOOL_PATH", f"{tempfile.mkdtemp()}/notifications.spool")
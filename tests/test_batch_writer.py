@@ -0,0 +1,43 @@
+import asyncio
+
+from batch_writer import BatchWriter
+
+# A writer whose spool was truncated after a drain must still recover what
+# was spooled afterwards
+def test_recovers_items_spooled_after_a_drain(tmp_path):
+    spool_path = str(tmp_path / "items.spool")
+    written = []
+    stalled = asyncio.Event()
+
+    async def write_batch(items):
+        if items[0]["n"] >= 3:
+            stalled.set()
+            await asyncio.Event().wait()  # the process dies before this batch is written
+        written.extend(items)
+
+    async def crash():
+        writer = BatchWriter("test_spool", write_batch, max_delay_ms=1, spool_path=spool_path)
+        await writer.start()
+        for n in range(3):
+            await writer.put({"n": n})
+        await writer.queue.join()  # drained: the spool is truncated
+        for n in range(3, 6):
+            await writer.put({"n": n})
+        await stalled.wait()
+        writer.task.cancel()
+        writer.spool.close()
+
+    async def recover():
+        replayed = []
+
+        async def write_replay(items):
+            replayed.extend(items)
+
+        writer = BatchWriter("test_spool", write_replay, max_delay_ms=1, spool_path=spool_path)
+        await writer.start()
+        await writer.stop()
+        return replayed
+
+    asyncio.run(crash())
+    assert [item["n"] for item in written] == [0, 1, 2]
+    assert [item["n"] for item in asyncio.run(recover())] == [3, 4, 5]
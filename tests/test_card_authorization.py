@@ -0,0 +1,35 @@
+import asyncio
+
+from sqlalchemy import func, insert, select
+
+import card_services
+import database
+import digital_wallet
+import spending_limits
+from batch_writer import timestamp
+from card_authorization import post_authorizations, reserve_authorization
+from users import users
+
+# A batch posted twice (committed, then replayed from the spool) debits once
+def test_replayed_batch_is_posted_once():
+    async def run():
+        await database.create_all(card_services.Base, digital_wallet.Base, spending_limits)
+        async with database.engine.begin() as conn:
+            await conn.execute(insert(users).values(id=2001, email="card@test.invalid", has_virtual_card=True,
+                                                    card_activated=True))
+        async with database.SessionLocal() as db:
+            await digital_wallet.append_wallet_entry(db, 2001, 10000, "deposit")
+            await db.commit()
+        assert await reserve_authorization(2001, "replayed-1", 2500) is None
+        batch = [{"authorization_id": "replayed-1", "user_id": 2001, "amount": 2500, "transaction_type": "purchase",
+                  "date": timestamp()}]
+        await post_authorizations(batch)
+        await post_authorizations(batch)
+        async with database.SessionLocal() as db:
+            balance = await digital_wallet.wallet_balance(db, 2001)
+            posted = await db.scalar(select(func.count()).select_from(card_services.CardTransaction)
+                                     .where(card_services.CardTransaction.user_id == 2001))
+        await database.dispose_engine()
+        return balance, posted
+
+    assert asyncio.run(run()) == (7500, 1)
@@ -0,0 +1,45 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+import database
+from idempotency import IdempotencyMiddleware, IdempotencyStore, idempotency_keys
+
+# An endpoint that has run keeps its key: a retry never runs it again, even
+# after a 5xx or an exception
+def test_key_is_kept_after_failed_runs():
+    runs = {"/transfer": 0, "/send_money": 0}
+    app = FastAPI()
+
+    @app.post("/transfer")
+    async def transfer():
+        runs["/transfer"] += 1
+        return JSONResponse({"detail": "Transfer failed"}, status_code=500)
+
+    @app.post("/send_money")
+    async def send_money():
+        runs["/send_money"] += 1
+        raise RuntimeError("connection lost after the commit")
+
+    async def run():
+        await database.create_all(idempotency_keys)
+        transport = httpx.ASGITransport(IdempotencyMiddleware(app, store=IdempotencyStore()))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            headers = {"Idempotency-Key": "payroll-2026-10", "Authorization": "Bearer x"}
+            failed = [await client.post("/transfer", json={"amount": 10}, headers=headers) for _ in range(2)]
+            with pytest.raises(RuntimeError):
+                await client.post("/send_money", json={"amount": 10}, headers=headers)
+            marker = await client.post("/send_money", json={"amount": 10}, headers=headers)
+            mismatch = await client.post("/send_money", json={"amount": 99}, headers=headers)
+        await database.dispose_engine()
+        return failed, marker, mismatch
+
+    failed, marker, mismatch = asyncio.run(run())
+    assert runs == {"/transfer": 1, "/send_money": 1}
+    assert [response.status_code for response in failed] == [500, 500]
+    assert failed[1].headers["idempotent-replayed"] == "true"
+    assert marker.status_code == 409
+    assert mismatch.status_code == 422
@@ -0,0 +1,26 @@
+import asyncio
+
+from sqlalchemy import insert
+
+import database
+import transfer_engine
+from identity import identity_cache, resolve_identities
+from users import users
+
+# Lookups match the stored email whatever its case, even on a backend that
+# compares strings case-sensitively (SQLite)
+def test_emails_resolve_case_insensitively():
+    async def run():
+        await database.create_all(transfer_engine)
+        async with database.engine.begin() as conn:
+            await conn.execute(insert(users).values(id=9001, email="Mixed.Case@Test.Invalid", status="active"))
+        async with database.SessionLocal() as db:
+            resolved = await resolve_identities(db, ["mixed.case@test.invalid", "MIXED.CASE@TEST.INVALID"])
+            await identity_cache.invalidate("mixed.case@test.invalid")
+            original = await resolve_identities(db, ["Mixed.Case@Test.Invalid"])
+        await database.dispose_engine()
+        return resolved, original
+
+    resolved, original = asyncio.run(run())
+    assert {email: identity.id for email, identity in {**resolved, **original}.items()} == {
+        "mixed.case@test.invalid": 9001, "MIXED.CASE@TEST.INVALID": 9001, "Mixed.Case@Test.Invalid": 9001}
@@ -0,0 +1,89 @@
+import asyncio
+import random
+
+from sqlalchemy import insert, select
+
+import database
+import notifications_transactions
+import transfer_engine
+from money_transfer import TransferBatchCreate, TransferCreate, initiate_transfer_batch
+from notification_queue import notification_writer
+from users import users
+from velocity import batch_velocity_engine
+
+EMPLOYER_ID = 3000
+EMPLOYEES = 2000
+
+# A payroll run pays every employee in one batch; the per-payment velocity
+# rules would have stopped it after a handful of items
+def test_payroll_batch_is_paid_in_full():
+    salaries = [round(random.uniform(1800, 6500), 2) for _ in range(EMPLOYEES)]
+
+    async def run():
+        await database.create_all(transfer_engine, notifications_transactions.Base)
+        async with database.engine.begin() as conn:
+            await conn.execute(insert(users), [{"id": EMPLOYER_ID, "email": "payroll@test.invalid", "balance": 2_000_000_000}] + [
+                {"id": EMPLOYER_ID + n, "email": f"employee{n}@test.invalid", "balance": 0} for n in range(1, EMPLOYEES + 1)
+            ])
+        await notification_writer.start()
+        try:
+            async with database.SessionLocal() as db:
+                response = await initiate_transfer_batch(TransferBatchCreate(transfers=[
+                    TransferCreate(receiver_email=f"employee{n}@test.invalid", amount=salary)
+                    for n, salary in enumerate(salaries, start=1)
+                ]), "payroll@test.invalid", db)
+            async with database.SessionLocal() as db:
+                balances = dict((await db.execute(
+                    select(users.c.id, users.c.balance).where(users.c.id.between(EMPLOYER_ID, EMPLOYER_ID + EMPLOYEES))
+                )).all())
+        finally:
+            await notification_writer.stop()
+            await database.dispose_engine()
+        return response, balances
+
+    response, balances = asyncio.run(run())
+    assert [result["status"] for result in response["results"]] == ["completed"] * EMPLOYEES
+    paid = [round(salary * 100) for salary in salaries]
+    assert [balances[EMPLOYER_ID + n] for n in range(1, EMPLOYEES + 1)] == paid
+    assert balances[EMPLOYER_ID] == 2_000_000_000 - sum(paid)
+
+# A chunk failing after earlier chunks committed reports per-item status:
+# the committed chunk stays paid and counted, the rest come back failed
+def test_batch_reports_items_of_a_failed_chunk(monkeypatch):
+    sender_id, receivers = 6000, 1500
+    apply_batch_chunk = transfer_engine.apply_batch_chunk
+    chunks = []
+
+    async def failing_second_chunk(db, sender_id, chunk):
+        chunks.append(chunk)
+        if len(chunks) == 2:
+            raise RuntimeError("connection lost")
+        return await apply_batch_chunk(db, sender_id, chunk)
+
+    monkeypatch.setattr(transfer_engine, "apply_batch_chunk", failing_second_chunk)
+
+    async def run():
+        await database.create_all(transfer_engine, notifications_transactions.Base)
+        async with database.engine.begin() as conn:
+            await conn.execute(insert(users), [{"id": sender_id, "email": "chunks@test.invalid", "balance": 10_000_000}] + [
+                {"id": sender_id + n, "email": f"chunk{n}@test.invalid", "balance": 0} for n in range(1, receivers + 1)
+            ])
+        await notification_writer.start()
+        try:
+            async with database.SessionLocal() as db:
+                response = await initiate_transfer_batch(TransferBatchCreate(transfers=[
+                    TransferCreate(receiver_email=f"chunk{n}@test.invalid", amount=10) for n in range(1, receivers + 1)
+                ]), "chunks@test.invalid", db)
+            async with database.SessionLocal() as db:
+                balance = await db.scalar(select(users.c.balance).where(users.c.id == sender_id))
+        finally:
+            await notification_writer.stop()
+            await database.dispose_engine()
+        return response, balance
+
+    response, balance = asyncio.run(run())
+    committed = len(chunks[0])
+    assert [result["status"] for result in response["results"]] == (
+        ["completed"] * committed + ["failed"] * (receivers - committed))
+    assert balance == 10_000_000 - committed * 1000
+    assert batch_velocity_engine.features(sender_id)["sum_1h"] == committed * 1000
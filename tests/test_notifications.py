@@ -0,0 +1,28 @@
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import insert
+
+import database
+import notifications_transactions
+from notifications_transactions import Notification, get_notifications
+from users import users
+
+# Both the first fetch and the since_id fetches are pages of at most `limit`, oldest first
+def test_notifications_are_paged_with_and_without_since_id():
+    async def run():
+        await database.create_all(notifications_transactions.Base)
+        async with database.engine.begin() as conn:
+            await conn.execute(insert(users).values(id=9101, email="inbox@test.invalid"))
+            await conn.execute(insert(Notification), [
+                {"user_id": 9101, "message": f"message {n}", "date": datetime.now(), "is_read": False} for n in range(5)
+            ])
+        async with database.SessionLocal() as db:
+            first = await get_notifications(since_id=None, limit=2, current_user_email="inbox@test.invalid", db=db)
+            rest = await get_notifications(since_id=first[-1]["id"], limit=10, current_user_email="inbox@test.invalid", db=db)
+        await database.dispose_engine()
+        return first, rest
+
+    first, rest = asyncio.run(run())
+    assert [notification["message"] for notification in first + rest] == [f"message {n}" for n in range(5)]
+    assert len(first) == 2
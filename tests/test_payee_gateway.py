@@ -0,0 +1,34 @@
+import asyncio
+
+import httpx
+
+from payee_gateway import PayeeGatewayClient, PayeeState
+
+# A half-open trial that is cancelled or fails unexpectedly must not block
+# the payee for good: the next call after it gets to try
+def test_interrupted_trial_frees_the_circuit():
+    async def handler(request):
+        if request.headers["Idempotency-Key"] == "cancelled":
+            await asyncio.Event().wait()
+        if request.headers["Idempotency-Key"] == "broken":
+            raise RuntimeError("unexpected error")
+        return httpx.Response(200, json={"status": "paid"})
+
+    async def run():
+        client = PayeeGatewayClient("http://payees.test", transport=httpx.MockTransport(handler), name="test_payees")
+        await client.start()
+        breaker = client.payees.setdefault("water-co", PayeeState(client.max_in_flight)).breaker
+        trials_left_running = []
+        try:
+            for key in ("cancelled", "broken"):
+                breaker.opened_at = -breaker.reset_seconds  # past the reset: half-open
+                trial = asyncio.create_task(client.pay("water-co", 10.0, key))
+                await asyncio.sleep(0.01)
+                trial.cancel()
+                await asyncio.gather(trial, return_exceptions=True)
+                trials_left_running.append(breaker.trial_running)
+            return trials_left_running, await client.pay("water-co", 10.0, "after")
+        finally:
+            await client.stop()
+
+    assert asyncio.run(run()) == ([False, False], {"status": "paid"})
@@ -0,0 +1,69 @@
+# Catch-up job for transaction_rollups.
+#
+# Rollups are maintained in batches only: nothing folds rows in as they are
+# written. Every transaction (new rows, imports, manual fixes, history from
+# before the rollups existed: the column defaults to false on migration)
+# starts with rolled_up = false and is picked up here oldest id first, a chunk
+# per transaction: the rollup increments and the rolled_up flag are committed
+# together, so each row is counted exactly once. GET /transactions/summary
+# lags the table by up to one run, so keep this running with --every. Run one
+# instance at a time.
+#
+#   python transaction_rollups.py                # catch up once
+#   python transaction_rollups.py --every 60     # keep catching up
+import argparse
+import asyncio
+import logging
+
+from sqlalchemy import select, update
+
+from database import SessionLocal, dispose_engine
+from notifications_transactions import Transaction, add_to_rollups
+
+ROLLUP_CHUNK_SIZE = 5000
+
+logger = logging.getLogger(__name__)
+
+# Roll up one chunk of pending transactions; returns how many were processed
+async def catch_up_chunk(chunk_size: int):
+    async with SessionLocal() as db:
+        rows = (await db.execute(
+            select(Transaction.id, Transaction.user_id, Transaction.transaction_type, Transaction.date, Transaction.amount)
+            .where(Transaction.rolled_up == False)
+            .order_by(Transaction.id)
+            .limit(chunk_size)
+        )).all()
+        if not rows:
+            return 0
+
+        await add_to_rollups(db, [(user_id, transaction_type, when, amount) for _, user_id, transaction_type, when, amount in rows])
+        await db.execute(update(Transaction).where(Transaction.id.in_([row.id for row in rows])).values(rolled_up=True))
+        await db.commit()
+        return len(rows)
+
+async def catch_up(chunk_size: int = ROLLUP_CHUNK_SIZE):
+    processed = 0
+    while True:
+        count = await catch_up_chunk(chunk_size)
+        if not count:
+            break
+        processed += count
+    logger.info("Rolled up %s transactions", processed)
+    return processed
+
+async def main(args):
+    try:
+        while True:
+            await catch_up(args.chunk_size)
+            if not args.every:
+                break
+            await asyncio.sleep(args.every)
+    finally:
+        await dispose_engine()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fold pending transactions into the summary rollups")
+    parser.add_argument("--chunk-size", type=int, default=ROLLUP_CHUNK_SIZE)
+    parser.add_argument("--every", type=int, help="repeat every N seconds")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,243 @@
+from sqlalchemy import BigInteger, Column, DateTime, ForeignKey, Integer, MetaData, String, Table, bindparam, insert, select, update
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from collections import defaultdict
+from datetime import datetime
+import asyncio
+import logging
+import random
+import uuid
+
+from users import users_table
+
+# Transfer engine shared by money_transfer.py and p2p_payments.py.
+#
+# Both account rows are locked with SELECT ... FOR UPDATE in ascending id
+# order, so two opposite transfers can never wait on each other, and the debit
+# is a conditional UPDATE ... WHERE balance >= :amount as a second guard (the
+# only one on SQLite, which ignores FOR UPDATE). Every transfer writes one
+# transactions row plus a debit and a credit ledger entry in the same commit.
+# Deadlocks and lock wait timeouts are retried a bounded number of times.
+
+metadata = MetaData()
+
+# The users table (users.py); the engine touches id and balance, in integer minor units
+accounts = users_table(metadata)
+
+transactions = Table(
+    "transactions", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("sender_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("receiver_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("amount", BigInteger, nullable=False),
+    Column("date", DateTime, nullable=False),
+    Column("status", String(20), default='pending'),
+    Column("batch_id", String(32), index=True),  # set on rows written by transfer_batch
+)
+
+# Double-entry postings: every transfer debits one account and credits another
+ledger_entries = Table(
+    "ledger_entries", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("transaction_id", Integer, ForeignKey("transactions.id"), nullable=False, index=True),
+    Column("account_id", Integer, ForeignKey("users.id"), nullable=False, index=True),
+    Column("amount", BigInteger, nullable=False),  # negative for the debit, positive for the credit
+    Column("date", DateTime, nullable=False),
+)
+
+# Retry configuration for deadlocks and lock wait timeouts
+DEADLOCK_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 0.005
+
+# MySQL deadlock / lock wait timeout error codes and PostgreSQL serialization SQLSTATEs
+RETRYABLE_MYSQL_CODES = {1205, 1213}
+RETRYABLE_SQLSTATES = {"40001", "40P01"}
+
+# Transfers committed together by transfer_batch
+BATCH_CHUNK_SIZE = 1000
+
+# Counters read by the concurrency benchmark
+stats = {"committed": 0, "retries": 0, "insufficient_funds": 0, "failed": 0}
+
+logger = logging.getLogger(__name__)
+
+class TransferError(Exception):
+    pass
+
+class InvalidAmount(TransferError):
+    pass
+
+class AccountNotFound(TransferError):
+    pass
+
+class InsufficientFunds(TransferError):
+    pass
+
+# Whether a database error is a lock conflict that is safe to retry
+def is_retryable(error: DBAPIError):
+    orig = error.orig
+    if orig is None:
+        return False
+    if getattr(orig, "args", None) and orig.args[0] in RETRYABLE_MYSQL_CODES:
+        return True
+    if getattr(orig, "sqlstate", None) in RETRYABLE_SQLSTATES or getattr(orig, "pgcode", None) in RETRYABLE_SQLSTATES:
+        return True
+    return "database is locked" in str(orig)
+
+# Lock both accounts in id order, then debit, credit and record the postings
+async def apply_transfer(db: AsyncSession, sender_id: int, receiver_id: int, amount: int, status: str = 'completed'):
+    locked = (await db.execute(
+        select(accounts.c.id, accounts.c.balance)
+        .where(accounts.c.id.in_(sorted({sender_id, receiver_id})))
+        .order_by(accounts.c.id)
+        .with_for_update()
+    )).all()
+    balances = {row.id: row.balance for row in locked}
+
+    if sender_id not in balances or receiver_id not in balances:
+        raise AccountNotFound()
+    if balances[sender_id] < amount:
+        raise InsufficientFunds()
+
+    debited = await db.execute(
+        update(accounts)
+        .where(accounts.c.id == sender_id, accounts.c.balance >= amount)
+        .values(balance=accounts.c.balance - amount)
+    )
+    if debited.rowcount != 1:
+        raise InsufficientFunds()
+    await db.execute(update(accounts).where(accounts.c.id == receiver_id).values(balance=accounts.c.balance + amount))
+
+    now = datetime.now()
+    result = await db.execute(insert(transactions).values(
+        sender_id=sender_id, receiver_id=receiver_id, amount=amount, date=now, status=status))
+    transaction_id = result.inserted_primary_key[0]
+    await db.execute(insert(ledger_entries), [
+        {"transaction_id": transaction_id, "account_id": sender_id, "amount": -amount, "date": now},
+        {"transaction_id": transaction_id, "account_id": receiver_id, "amount": amount, "date": now},
+    ])
+    return transaction_id
+
+# Lock the sender and a chunk of receivers, debit the sender once for every transfer
+# that fits its balance, credit each receiver once and bulk-insert the rows.
+# Returns 'completed' or 'insufficient_funds' for each item of the chunk.
+async def apply_batch_chunk(db: AsyncSession, sender_id: int, chunk: list):
+    locked = (await db.execute(
+        select(accounts.c.id, accounts.c.balance)
+        .where(accounts.c.id.in_(sorted({sender_id, *(receiver_id for receiver_id, _ in chunk)})))
+        .order_by(accounts.c.id)
+        .with_for_update()
+    )).all()
+    balances = {row.id: row.balance for row in locked}
+    if sender_id not in balances:
+        raise AccountNotFound()
+
+    # Accept transfers in request order while the sender can cover them
+    available = balances[sender_id]
+    accepted = []
+    statuses = []
+    for receiver_id, amount in chunk:
+        if receiver_id in balances and amount <= available:
+            available -= amount
+            accepted.append((receiver_id, amount))
+            statuses.append('completed')
+        else:
+            statuses.append('insufficient_funds')
+    if not accepted:
+        return statuses
+
+    total = sum(amount for _, amount in accepted)
+    debited = await db.execute(
+        update(accounts)
+        .where(accounts.c.id == sender_id, accounts.c.balance >= total)
+        .values(balance=accounts.c.balance - total)
+    )
+    if debited.rowcount != 1:
+        raise InsufficientFunds()
+
+    credits = defaultdict(int)
+    for receiver_id, amount in accepted:
+        credits[receiver_id] += amount
+    await db.execute(
+        update(accounts)
+        .where(accounts.c.id == bindparam("account_id"))
+        .values(balance=accounts.c.balance + bindparam("credit")),
+        [{"account_id": receiver_id, "credit": amount} for receiver_id, amount in credits.items()],
+    )
+
+    now = datetime.now()
+    batch_id = uuid.uuid4().hex
+    await db.execute(insert(transactions), [
+        {"sender_id": sender_id, "receiver_id": receiver_id, "amount": amount, "date": now, "status": 'completed',
+         "batch_id": batch_id}
+        for receiver_id, amount in accepted
+    ])
+
+    # Read the chunk's ids back by its batch id instead of relying on
+    # executemany RETURNING support (MySQL has none)
+    inserted = (await db.execute(
+        select(transactions.c.id, transactions.c.receiver_id, transactions.c.amount)
+        .where(transactions.c.batch_id == batch_id)
+    )).all()
+    postings = []
+    for row in inserted:
+        postings.append({"transaction_id": row.id, "account_id": sender_id, "amount": -row.amount, "date": now})
+        postings.append({"transaction_id": row.id, "account_id": row.receiver_id, "amount": row.amount, "date": now})
+    await db.execute(insert(ledger_entries), postings)
+    return statuses
+
+# Run `operation` and commit, retrying the whole transaction on lock conflicts
+async def run_with_retries(db: AsyncSession, operation, max_retries: int = DEADLOCK_RETRIES):
+    for attempt in range(max_retries + 1):
+        try:
+            result = await operation()
+            await db.commit()
+            return result
+        except TransferError:
+            await db.rollback()
+            raise
+        except DBAPIError as e:
+            await db.rollback()
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            stats["retries"] += 1
+            # Jittered exponential backoff so colliding transfers do not retry in lockstep
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+# Move `amount` minor units from sender to receiver atomically and return the transaction id
+async def transfer(db: AsyncSession, sender_id: int, receiver_id: int, amount: int, max_retries: int = DEADLOCK_RETRIES):
+    if amount <= 0 or sender_id == receiver_id:
+        raise InvalidAmount()
+
+    try:
+        transaction_id = await run_with_retries(
+            db, lambda: apply_transfer(db, sender_id, receiver_id, amount), max_retries)
+    except InsufficientFunds:
+        stats["insufficient_funds"] += 1
+        raise
+    stats["committed"] += 1
+    return transaction_id
+
+# Fan out (receiver_id, amount) pairs from one sender, committing every
+# BATCH_CHUNK_SIZE transfers. Returns one status per item, in order:
+# 'completed', 'insufficient_funds', or 'failed' for the items of a chunk that
+# could not be committed and of every chunk after it, so the caller can tell
+# what was paid. An error before any chunk committed is raised as is.
+async def transfer_batch(db: AsyncSession, sender_id: int, items: list, chunk_size: int = BATCH_CHUNK_SIZE,
+                         max_retries: int = DEADLOCK_RETRIES):
+    statuses = []
+    for start in range(0, len(items), chunk_size):
+        chunk = items[start:start + chunk_size]
+        try:
+            chunk_statuses = await run_with_retries(db, lambda: apply_batch_chunk(db, sender_id, chunk), max_retries)
+        except Exception:
+            if not statuses:
+                raise
+            logger.exception("Transfer batch of sender %s stopped after %s of %s items", sender_id, start, len(items))
+            stats["failed"] += len(items) - start
+            statuses.extend(['failed'] * (len(items) - start))
+            break
+        stats["committed"] += chunk_statuses.count('completed')
+        stats["insufficient_funds"] += chunk_statuses.count('insufficient_funds')
+        statuses.extend(chunk_statuses)
+    return statuses
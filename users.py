@@ -0,0 +1,42 @@
+from sqlalchemy import BigInteger, Boolean, Column, Index, Integer, MetaData, String, Table, func, insert, select
+
+# The users table, defined once for the feature modules.
+#
+# Registration writes the identity columns; transfer_engine.py owns balance
+# and card_services.py the card flags. Modules with their own metadata copy
+# the table into it with users_table(metadata), so their users.id foreign
+# keys resolve and create_all builds the whole table whichever module runs
+# it first. Modules that only read a few columns and never create tables
+# (identity.py, bulk_import.py) keep their own narrower Table.
+
+metadata = MetaData()
+
+users = Table(
+    "users", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("full_name", String(120)),
+    Column("email", String(120), unique=True),
+    Column("password", String(255)),
+    Column("otp_secret", String(32)),
+    Column("status", String(20)),
+    Column("balance", BigInteger, nullable=False, default=0, server_default="0"),  # minor units
+    Column("has_virtual_card", Boolean, default=False),
+    Column("card_activated", Boolean, default=False),
+)
+
+# identity.py looks emails up case-insensitively, by lower(email)
+Index("ix_users_email_lower", func.lower(users.c.email))
+
+# The users table as a member of another MetaData (once per metadata)
+def users_table(metadata: MetaData):
+    return metadata.tables["users"] if "users" in metadata.tables else users.to_metadata(metadata)
+
+# Benchmarks: make sure users 1..count exist, so seeded rows satisfy their
+# users.id foreign keys on backends that enforce them
+async def seed_users(conn, count: int, chunk_size: int = 10000):
+    existing = set((await conn.scalars(select(users.c.id).where(users.c.id <= count))).all())
+    for start in range(1, count + 1, chunk_size):
+        rows = [{"id": user_id, "email": f"user{user_id}@bench.invalid"}
+                for user_id in range(start, min(start + chunk_size, count + 1)) if user_id not in existing]
+        if rows:
+            await conn.execute(insert(users), rows)
@@ -0,0 +1,276 @@
+from collections import OrderedDict
+import os
+import time
+
+import metrics
+
+# Streaming velocity checks for money leaving an account.
+#
+# Every outgoing transfer and wallet withdrawal is scored here before it is
+# written, with no database query. reserve() counts an allowed payment in the
+# same step, so concurrent payments of one user are scored against each
+# other rather than all against the state before any of them; a payment that
+# then fails to be written is taken out again with release(). Each user keeps three ring buffers of time
+# buckets (1 minute in 5 s buckets, 1 hour in 1 min buckets, 24 hours in
+# 15 min buckets) holding a count and a sum per bucket plus running totals, so
+# recording and reading a window are O(1) amortized. Distinct counterparties
+# are tracked as last-seen times of at most VELOCITY_MAX_COUNTERPARTIES
+# recent counterparties per user: exact below that bound, saturated above it.
+#
+# State is per process. Scores are only complete when a user's outgoing
+# payments are handled by one process; otherwise each process sees its share.
+
+VELOCITY_MAX_USERS = int(os.environ.get("VELOCITY_MAX_USERS", "1000000"))
+VELOCITY_MAX_COUNTERPARTIES = 64
+VELOCITY_BLOCK_SCORE = float(os.environ.get("VELOCITY_BLOCK_SCORE", "1.0"))
+
+# (name, window seconds, bucket seconds)
+VELOCITY_WINDOWS = (("1m", 60, 5), ("1h", 3600, 60), ("24h", 86400, 900))
+
+# Rule thresholds; amounts in minor units
+VELOCITY_RULES = {
+    "max_count_1m": 10,
+    "max_count_1h": 60,
+    "max_count_24h": 200,
+    "max_sum_1h": 500_000,
+    "max_sum_24h": 2_000_000,
+    "max_new_counterparties_1h": 10,
+    "spike_multiple": 5,  # amount vs the 24h average
+    "spike_min_amount": 50_000,
+}
+
+# Payout batches (/transfer/batch) are scored once per batch, as one payment
+# of the batch total, against their own engine and thresholds: under the
+# rules above a payroll would stop after max_count_1m items
+VELOCITY_BATCH_RULES = {
+    "max_count_1m": 2,
+    "max_count_1h": 10,
+    "max_count_24h": 20,
+    "max_sum_1h": int(os.environ.get("VELOCITY_BATCH_MAX_SUM_1H", "2000000000")),
+    "max_sum_24h": int(os.environ.get("VELOCITY_BATCH_MAX_SUM_24H", "5000000000")),
+    "max_new_counterparties_1h": 10,  # batches are scored without a counterparty
+    "spike_multiple": 5,
+    "spike_min_amount": 50_000_000,
+}
+
+class Ring:
+    __slots__ = ("bucket_seconds", "epochs", "counts", "sums", "count", "sum")
+
+    def __init__(self, window_seconds: int, bucket_seconds: int):
+        size = window_seconds // bucket_seconds
+        self.bucket_seconds = bucket_seconds
+        self.epochs = [-1] * size
+        self.counts = [0] * size
+        self.sums = [0] * size
+        self.count = 0
+        self.sum = 0
+
+    # Drop the slot of `epoch` if it still holds an older bucket
+    def slot(self, epoch: int):
+        index = epoch % len(self.epochs)
+        if self.epochs[index] != epoch:
+            self.count -= self.counts[index]
+            self.sum -= self.sums[index]
+            self.epochs[index] = epoch
+            self.counts[index] = 0
+            self.sums[index] = 0
+        return index
+
+    # Expire every bucket that has left the window as of `now`
+    def advance(self, now: float):
+        epoch = int(now // self.bucket_seconds)
+        oldest = epoch - len(self.epochs)
+        for index, bucket_epoch in enumerate(self.epochs):
+            if 0 <= bucket_epoch <= oldest:
+                self.count -= self.counts[index]
+                self.sum -= self.sums[index]
+                self.epochs[index] = -1
+                self.counts[index] = 0
+                self.sums[index] = 0
+        return epoch
+
+    def add(self, now: float, amount: int):
+        index = self.slot(int(now // self.bucket_seconds))
+        self.counts[index] += 1
+        self.sums[index] += amount
+        self.count += 1
+        self.sum += amount
+
+    # Take back an add() at `at`, unless its bucket has expired since
+    def remove(self, at: float, amount: int):
+        epoch = int(at // self.bucket_seconds)
+        index = epoch % len(self.epochs)
+        if self.epochs[index] == epoch:
+            self.counts[index] -= 1
+            self.sums[index] -= amount
+            self.count -= 1
+            self.sum -= amount
+
+class UserVelocity:
+    __slots__ = ("rings", "counterparties", "last_advance")
+
+    def __init__(self):
+        self.rings = {name: Ring(window, bucket) for name, window, bucket in VELOCITY_WINDOWS}
+        self.counterparties = OrderedDict()  # counterparty -> last seen, oldest first
+        self.last_advance = {name: -1 for name, _, _ in VELOCITY_WINDOWS}
+
+    # Expire old buckets; each ring is scanned at most once per bucket period
+    def advance(self, now: float):
+        for name, ring in self.rings.items():
+            epoch = int(now // ring.bucket_seconds)
+            if epoch != self.last_advance[name]:
+                ring.advance(now)
+                self.last_advance[name] = epoch
+
+    def record(self, now: float, amount: int, counterparty=None):
+        self.advance(now)
+        for ring in self.rings.values():
+            ring.add(now, amount)
+        if counterparty is not None:
+            self.counterparties[counterparty] = now
+            self.counterparties.move_to_end(counterparty)
+            if len(self.counterparties) > VELOCITY_MAX_COUNTERPARTIES:
+                self.counterparties.popitem(last=False)
+
+    def unrecord(self, at: float, amount: int, counterparty=None, previously_seen: float = None):
+        for ring in self.rings.values():
+            ring.remove(at, amount)
+        if counterparty is not None and self.counterparties.get(counterparty) == at:
+            if previously_seen is None:
+                del self.counterparties[counterparty]
+            else:
+                self.counterparties[counterparty] = previously_seen
+
+    def distinct_counterparties(self, now: float, window_seconds: int):
+        cutoff = now - window_seconds
+        return sum(1 for seen in self.counterparties.values() if seen >= cutoff)
+
+class Verdict:
+    __slots__ = ("allowed", "score", "reasons", "reservation")
+
+    def __init__(self, allowed: bool, score: float, reasons: list, reservation=None):
+        self.allowed = allowed
+        self.score = score
+        self.reasons = reasons
+        self.reservation = reservation  # set by reserve() when the payment was counted
+
+# A payment reserve() counted, for release()
+class Reservation:
+    __slots__ = ("user_id", "amount", "counterparty", "at", "previously_seen")
+
+    def __init__(self, user_id: int, amount: int, counterparty, at: float, previously_seen: float):
+        self.user_id = user_id
+        self.amount = amount
+        self.counterparty = counterparty
+        self.at = at
+        self.previously_seen = previously_seen
+
+class VelocityEngine:
+    def __init__(self, max_users: int = VELOCITY_MAX_USERS, rules: dict = None, block_score: float = VELOCITY_BLOCK_SCORE,
+                 name: str = "velocity"):
+        self.max_users = max_users
+        self.rules = {**VELOCITY_RULES, **(rules or {})}
+        self.block_score = block_score
+        self.users = OrderedDict()  # user_id -> UserVelocity, least recently active first
+        self.scored = 0
+        self.blocked = 0
+        self.recorded = 0
+        self.released = 0
+        metrics.register(name, self.stats)
+
+    def user(self, user_id: int):
+        velocity = self.users.get(user_id)
+        if velocity is None:
+            velocity = self.users[user_id] = UserVelocity()
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        self.users.move_to_end(user_id)
+        return velocity
+
+    # Record a completed outgoing payment
+    def record(self, user_id: int, amount: int, counterparty=None, now: float = None):
+        self.user(user_id).record(time.time() if now is None else now, amount, counterparty)
+        self.recorded += 1
+
+    # Window aggregates of one user as of `now`
+    def features(self, user_id: int, now: float = None):
+        now = time.time() if now is None else now
+        velocity = self.users.get(user_id)
+        if velocity is None:
+            return {f"{kind}_{name}": 0 for name, _, _ in VELOCITY_WINDOWS for kind in ("count", "sum", "distinct")}
+        velocity.advance(now)
+        features = {}
+        for name, window, _ in VELOCITY_WINDOWS:
+            ring = velocity.rings[name]
+            features[f"count_{name}"] = ring.count
+            features[f"sum_{name}"] = ring.sum
+            features[f"distinct_{name}"] = velocity.distinct_counterparties(now, window)
+        return features
+
+    # Score a payment before it is written; the payment counts as if it had happened
+    def score(self, user_id: int, amount: int, counterparty=None, now: float = None):
+        now = time.time() if now is None else now
+        features = self.features(user_id, now)
+        rules = self.rules
+        velocity = self.users.get(user_id)
+
+        score = 0.0
+        reasons = []
+        if features["count_1m"] + 1 > rules["max_count_1m"]:
+            score += 0.6
+            reasons.append("count_1m")
+        if features["count_1h"] + 1 > rules["max_count_1h"]:
+            score += 0.4
+            reasons.append("count_1h")
+        if features["count_24h"] + 1 > rules["max_count_24h"]:
+            score += 0.3
+            reasons.append("count_24h")
+        if features["sum_1h"] + amount > rules["max_sum_1h"]:
+            score += 0.5
+            reasons.append("sum_1h")
+        if features["sum_24h"] + amount > rules["max_sum_24h"]:
+            score += 0.5
+            reasons.append("sum_24h")
+        if (counterparty is not None and (velocity is None or counterparty not in velocity.counterparties)
+                and features["distinct_1h"] + 1 > rules["max_new_counterparties_1h"]):
+            score += 0.5
+            reasons.append("new_counterparties_1h")
+        if (features["count_24h"] and amount >= rules["spike_min_amount"]
+                and amount > rules["spike_multiple"] * features["sum_24h"] / features["count_24h"]):
+            score += 0.3
+            reasons.append("amount_spike")
+
+        allowed = score < self.block_score
+        self.scored += 1
+        if not allowed:
+            self.blocked += 1
+        return Verdict(allowed, score, reasons)
+
+    # Score a payment and, when it is allowed, record it in the same step. The
+    # caller writes the payment and calls release(verdict.reservation) if that fails.
+    def reserve(self, user_id: int, amount: int, counterparty=None, now: float = None):
+        now = time.time() if now is None else now
+        verdict = self.score(user_id, amount, counterparty, now)
+        if verdict.allowed:
+            velocity = self.user(user_id)
+            previously_seen = velocity.counterparties.get(counterparty) if counterparty is not None else None
+            velocity.record(now, amount, counterparty)
+            self.recorded += 1
+            verdict.reservation = Reservation(user_id, amount, counterparty, now, previously_seen)
+        return verdict
+
+    # Undo a reservation whose payment was not written
+    def release(self, reservation: Reservation):
+        if reservation is None:
+            return
+        velocity = self.users.get(reservation.user_id)
+        if velocity is not None:
+            velocity.unrecord(reservation.at, reservation.amount, reservation.counterparty, reservation.previously_seen)
+        self.released += 1
+
+    def stats(self):
+        return {"users": len(self.users), "scored": self.scored, "blocked": self.blocked, "recorded": self.recorded,
+                "released": self.released}
+
+velocity_engine = VelocityEngine()
+batch_velocity_engine = VelocityEngine(rules=VELOCITY_BATCH_RULES, name="velocity_batches")
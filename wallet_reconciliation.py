@@ -0,0 +1,98 @@
+# Incremental reconciliation job for wallet balance snapshots.
+#
+# Each run only looks at snapshots that are still 'pending': it starts from the
+# user's latest verified snapshot and re-adds the ledger entries between
+# consecutive snapshots, so already-verified history is never rescanned.
+#
+#   python wallet_reconciliation.py              # one pass over all pending snapshots
+#   python wallet_reconciliation.py --every 300  # keep running every 5 minutes
+import argparse
+import asyncio
+import logging
+
+from sqlalchemy import func, select
+
+from database import SessionLocal, dispose_engine
+from digital_wallet import WalletBalanceSnapshot, WalletTransaction
+
+# Users reconciled per database session
+RECONCILE_BATCH_USERS = 500
+
+logger = logging.getLogger(__name__)
+
+# Verify the pending snapshots of one user; returns the ids of mismatching snapshots
+async def reconcile_user(db, user_id: int):
+    verified = await db.scalar(
+        select(WalletBalanceSnapshot)
+        .where(WalletBalanceSnapshot.user_id == user_id, WalletBalanceSnapshot.status == 'verified')
+        .order_by(WalletBalanceSnapshot.last_entry_id.desc())
+        .limit(1)
+    )
+    balance, after_id = (verified.balance, verified.last_entry_id) if verified else (0, 0)
+
+    pending = (await db.scalars(
+        select(WalletBalanceSnapshot)
+        .where(WalletBalanceSnapshot.user_id == user_id,
+               WalletBalanceSnapshot.status == 'pending',
+               WalletBalanceSnapshot.last_entry_id > after_id)
+        .order_by(WalletBalanceSnapshot.last_entry_id)
+    )).all()
+
+    mismatches = []
+    for snapshot in pending:
+        delta = await db.scalar(
+            select(func.coalesce(func.sum(WalletTransaction.amount), 0))
+            .where(WalletTransaction.user_id == user_id,
+                   WalletTransaction.id > after_id,
+                   WalletTransaction.id <= snapshot.last_entry_id)
+        )
+        expected = balance + delta
+        if snapshot.balance == expected:
+            snapshot.status = 'verified'
+        else:
+            snapshot.status = 'mismatch'
+            mismatches.append(snapshot.id)
+            logger.error("Wallet snapshot %s for user %s has balance %s, ledger gives %s",
+                         snapshot.id, user_id, snapshot.balance, expected)
+        # Continue from the ledger-derived balance so one bad snapshot does not cascade
+        balance, after_id = expected, snapshot.last_entry_id
+
+    return mismatches
+
+# One pass over every user with pending snapshots; returns the number of mismatches found
+async def reconcile_pending(batch_users: int = RECONCILE_BATCH_USERS):
+    mismatches = 0
+    last_user_id = 0
+    while True:
+        async with SessionLocal() as db:
+            user_ids = (await db.scalars(
+                select(WalletBalanceSnapshot.user_id)
+                .where(WalletBalanceSnapshot.status == 'pending', WalletBalanceSnapshot.user_id > last_user_id)
+                .group_by(WalletBalanceSnapshot.user_id)
+                .order_by(WalletBalanceSnapshot.user_id)
+                .limit(batch_users)
+            )).all()
+            if not user_ids:
+                return mismatches
+
+            for user_id in user_ids:
+                mismatches += len(await reconcile_user(db, user_id))
+            await db.commit()
+            last_user_id = user_ids[-1]
+
+async def main(every: int = 0):
+    try:
+        while True:
+            mismatches = await reconcile_pending()
+            logger.info("Wallet reconciliation finished with %s mismatches", mismatches)
+            if not every:
+                return mismatches
+            await asyncio.sleep(every)
+    finally:
+        await dispose_engine()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verify pending wallet balance snapshots against the ledger")
+    parser.add_argument("--every", type=int, default=0, help="repeat every N seconds instead of running once")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parser.parse_args().every))